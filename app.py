@@ -1,12 +1,13 @@
 # app.py (Final Version)
 import streamlit as st
 import pandas as pd
-import os
 import config
 
 # We now import the main functions directly from our other modules
-from main import process_all_invoices
+from main import INVOICE_EXTENSIONS, process_uploaded_invoices
 from correlator import reconcile_sheets
+from bank_importer import STATEMENT_EXTENSIONS, import_bank_statement
+from provider_limits import get_provider_status
 
 # --- Page Configuration ---
 st.set_page_config(page_title="Ibiza AI Invoice Processor", page_icon="🤖", layout="wide")
@@ -17,36 +18,52 @@ st.markdown("Welcome! This tool automates your invoice processing and reconcilia
 
 # --- Main Workflow ---
 st.header("Step 1: Upload Invoices")
-st.write(f"Files will be saved to: `{config.INVOICE_FOLDER}`")
+st.write(f"Processed files will be saved to: `{config.INVOICE_FOLDER}`")
 
 uploaded_files = st.file_uploader(
     "Choose your invoice files (PDFs or images)",
     accept_multiple_files=True,
-    type=['pdf', 'png', 'jpg', 'jpeg']
+    type=[extension.lstrip(".") for extension in INVOICE_EXTENSIONS]
 )
 
 if st.button("Process Uploaded Invoices", type="primary"):
     if uploaded_files:
-        saved_count = 0
-        with st.spinner("Saving uploaded files to the processing folder..."):
-            for uploaded_file in uploaded_files:
-                # Construct the destination path
-                dest_path = os.path.join(config.INVOICE_FOLDER, uploaded_file.name)
-                # Write the file's content to the destination
-                with open(dest_path, "wb") as f:
-                    f.write(uploaded_file.getvalue())
-                saved_count += 1
-        st.success(f"{saved_count} file(s) saved to the processing folder.")
-
         # --- NOW, WE RUN OUR EXISTING, ROBUST BACKEND ENGINE ---
+        # The uploaded files go straight from memory into the engine; each file is
+        # saved to the 'archive' or 'failed' folder once it has been processed.
         st.write("--- Starting Invoice Processing Engine ---")
-        # We can use st.expander to show the detailed log in a collapsible box
-        with st.expander("Click to see the detailed processing log"):
-            # We will need to adapt our scripts to "log" to the UI.
-            # For now, we tell the user to check the console.
-            st.info("Processing is running. Please check your PyCharm console for detailed logs.")
-            process_all_invoices()
-            st.success("Invoice processing complete! Files have been moved to the 'archive' or 'failed' folders.")
+        progress_bar = st.progress(0.0, text="Starting...")
+        provider_caption = st.empty()
+        status_table = st.empty()
+        file_statuses = [{"File": uploaded_file.name, "Status": "⏳ queued", "Seconds": None, "Supplier": None,
+                          "Total": None} for uploaded_file in uploaded_files]
+        finished_files = 0
+        successful_files = 0
+
+        for event in process_uploaded_invoices(uploaded_files, hedged=config.HEDGED_EXTRACTION_FOR_UPLOADS):
+            file_status = file_statuses[event["index"]]
+            if event["status"] == "processing":
+                file_status["Status"] = "⚙️ processing"
+            else:
+                finished_files += 1
+                successful_files += event["status"] == "success"
+                file_status.update({
+                    "Status": "✅ success" if event["status"] == "success" else "❌ failed",
+                    "Seconds": event["seconds"],
+                    "Supplier": event["supplier"],
+                    "Total": event["total"],
+                })
+                progress_bar.progress(finished_files / len(uploaded_files),
+                                      text=f"{finished_files} of {len(uploaded_files)} file(s) processed")
+            # Show how busy (or throttled) each API is right now.
+            provider_caption.caption(" · ".join(
+                f"{provider}: {status['in_flight']} running, {status['waiting']} waiting"
+                + (f", paused {status['paused_for_seconds']}s" if status['paused_for_seconds'] else "")
+                for provider, status in get_provider_status().items()))
+            status_table.dataframe(pd.DataFrame(file_statuses), hide_index=True, use_container_width=True)
+
+        st.success(f"Invoice processing complete! {successful_files} of {len(uploaded_files)} file(s) succeeded. "
+                   f"Files have been saved to the 'archive' or 'failed' folders.")
 
     else:
         st.warning("Please upload at least one invoice file.")
@@ -55,6 +72,26 @@ if st.button("Process Uploaded Invoices", type="primary"):
 st.header("Step 2: Run Reconciliation")
 st.write("This will compare all processed invoices in your Google Sheet with the bank payments.")
 
+bank_files = st.file_uploader(
+    "Optionally, load new bank statements first (CSV, Excel or Norma 43)",
+    accept_multiple_files=True,
+    type=[extension.lstrip(".") for extension in STATEMENT_EXTENSIONS]
+)
+
+if st.button("Import Bank Statements"):
+    if bank_files:
+        for bank_file in bank_files:
+            try:
+                result = import_bank_statement(bank_file, bank_file.name)
+            except ValueError as e:
+                st.error(f"{bank_file.name}: {e}")
+                continue
+            st.write(f"`{bank_file.name}`: {result['added']} new payment(s), "
+                     f"{result['skipped']} already loaded, {result['credits']} credit(s) left out.")
+        st.success("Bank statements imported!")
+    else:
+        st.warning("Please upload at least one bank statement.")
+
 if st.button("Run Reconciliation"):
     with st.spinner("Running reconciliation... Please check your PyCharm console for detailed logs."):
         reconcile_sheets()
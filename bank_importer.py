@@ -0,0 +1,435 @@
+# bank_importer.py
+# Loads bank statements into the bank payments ledger.
+#
+# Reads the statements Spanish banks export: CSV files (any delimiter, UTF-8 or
+# Windows-1252), Excel workbooks (.xlsx) and AEB Norma 43 (Cuaderno 43) files,
+# the 80-character fixed-width format every Spanish bank offers. Files are read
+# one row at a time, so a statement of any size is loaded in constant memory.
+#
+# Each movement gets the types the correlator expects: a date, and an exact
+# amount where money paid out of the account is positive (bank exports show it
+# as negative). Money paid in is skipped unless config.BANK_IMPORT_INCLUDE_CREDITS.
+#
+# A movement is identified by its date, amount and description (see
+# ledger_store.movement_key()), numbered when the same movement appears several
+# times on one statement. Movements that are already loaded (e.g. an overlapping
+# statement, or the same file imported twice) are skipped. New movements are
+# written in batches of config.BANK_IMPORT_BATCH_ROWS: to the local ledger
+# (which the ledger sync appends to the bank sheet in bulk), or straight to the
+# bank sheet when the ledger store is disabled.
+#
+# Example:
+#     python bank_importer.py statement.n43 movimientos.xlsx
+#     result = import_bank_file("movimientos.csv")  # {"read": 120, "added": 45, ...}
+
+import argparse
+import codecs
+import csv
+import datetime
+import io
+import os
+import re
+import unicodedata
+import zipfile
+from dataclasses import dataclass
+from decimal import Decimal
+
+import config
+import ledger_store
+from instrumentation import logger, timed, count
+from invoice_model import format_amount, parse_amount, parse_date
+from provider_limits import call_provider
+from providers import lazy_import
+from sheets_connector import flush_sheet, get_sheets_session
+
+# openpyxl is only imported when the first Excel statement is read.
+openpyxl = lazy_import("openpyxl")
+
+EXCEL_EXTENSIONS = (".xlsx", ".xlsm")
+NORMA43_EXTENSIONS = (".n43", ".q43", ".c43", ".aeb", ".txt")
+# Every file extension a statement can have (e.g. for an upload form).
+STATEMENT_EXTENSIONS = (".csv",) + EXCEL_EXTENSIONS + NORMA43_EXTENSIONS
+# The start of an old binary Excel file (.xls), which we cannot read.
+OLD_EXCEL_SIGNATURE = b"\xd0\xcf\x11\xe0"
+# The file type and encoding are detected from this many bytes at the start of the file.
+SAMPLE_BYTES = 64 * 1024
+CSV_DELIMITERS = ";,\t|"
+# The header row is looked for in this many rows at the top of a CSV or Excel statement.
+MAX_HEADER_ROWS = 30
+
+# The column titles each field goes by (without accents, in lower case, only words),
+# in order of preference: e.g. the operation date is used rather than the value date.
+DATE_HEADERS = ("fecha operacion", "f operacion", "fecha de operacion", "fecha contable", "fecha", "date",
+                "fecha valor", "f valor")
+AMOUNT_HEADERS = ("importe", "cantidad", "amount", "importe operacion")
+DEBIT_HEADERS = ("cargo", "cargos", "debe", "debit", "reintegros")
+CREDIT_HEADERS = ("abono", "abonos", "haber", "credit", "ingresos")
+DESCRIPTION_HEADERS = ("concepto", "descripcion", "movimiento", "concepto comun", "description", "detalle")
+DETAILS_HEADERS = ("mas datos", "observaciones", "concepto propio", "referencia", "referencia 1", "referencia 2",
+                   "beneficiario", "ordenante", "remitente", "informacion adicional")
+# Words left out of column titles, e.g. "Importe (EUR)" -> "importe".
+IGNORED_HEADER_WORDS = {"eur", "euros", "en"}
+
+# Norma 43: the first record of an account ("11" + bank, office and account numbers + dates).
+NORMA43_START = re.compile(r"^11\d{30}")
+# The descriptions of the Norma 43 common concepts (used when a movement has no concept text).
+NORMA43_CONCEPTS = {
+    "01": "TALONES - REINTEGROS",
+    "02": "ABONARES - ENTREGAS - INGRESOS",
+    "03": "DOMICILIADOS - RECIBOS - LETRAS - PAGOS POR SU CTA.",
+    "04": "GIROS - TRANSFERENCIAS - TRASPASOS - CHEQUES",
+    "05": "AMORTIZACIONES PRESTAMOS, CREDITOS, ETC.",
+    "06": "REMESAS EFECTOS",
+    "07": "SUSCRIPCIONES - DIV. PASIVOS - CANJES",
+    "08": "DIV. CUPONES - PRIMA JUNTA - AMORTIZACIONES",
+    "09": "OPERACIONES DE BOLSA Y/O COMPRA/VENTA VALORES",
+    "10": "CHEQUES GASOLINA",
+    "11": "CAJERO AUTOMATICO",
+    "12": "TARJETAS DE CREDITO - TARJETAS DE DEBITO",
+    "13": "OPERACIONES EXTRANJERO",
+    "14": "DEVOLUCIONES E IMPAGADOS",
+    "15": "NOMINAS - SEGUROS SOCIALES",
+    "16": "TIMBRES - CORRETAJE - POLIZA",
+    "17": "INTERESES - COMISIONES - CUSTODIA - GASTOS E IMPUESTOS",
+    "98": "ANULACIONES - CORRECCIONES ASIENTO",
+    "99": "VARIOS",
+}
+
+
+@dataclass
+class BankMovement:
+    """One movement of a bank statement."""
+    date: datetime.date
+    # Positive for money paid out of the account (a payment), negative for money paid in.
+    amount: Decimal
+    description: str
+    details1: str = ""
+    details2: str = ""
+
+
+# --- FIELDS ---
+
+def _signed_amount(value):
+    """Turns an amount as the bank shows it ("-1.234,56", "1.234,56-", "(12,00)", -12.5) into a Decimal."""
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return Decimal(str(value))
+    text = str(value or "").strip().replace("−", "-")
+    amount = parse_amount(text)
+    if amount is None:
+        return None
+    if text.endswith("-") or (text.startswith("(") and text.endswith(")")):
+        return -abs(amount)
+    return amount
+
+
+def _movement_date(value):
+    """Turns a date cell (text, or a date from Excel) into a date. Returns None if it is not a date."""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return parse_date(value)
+
+
+def _text(value):
+    return " ".join(str(value).split()) if value is not None else ""
+
+
+def _header_name(value):
+    """A column title without accents, case, punctuation or currency words: "Fecha Operación" -> "fecha operacion"."""
+    text = unicodedata.normalize("NFKD", _text(value)).encode("ascii", "ignore").decode().lower()
+    return " ".join(word for word in re.findall(r"[a-z0-9]+", text) if word not in IGNORED_HEADER_WORDS)
+
+
+def _find_column(names, synonyms, taken=()):
+    """The position of the column with the most preferred title, or None."""
+    for synonym in synonyms:
+        for position, name in enumerate(names):
+            if name == synonym and position not in taken:
+                return position
+    return None
+
+
+# --- CSV AND EXCEL STATEMENTS ---
+
+def _find_columns(row):
+    """
+    Recognises a header row. Returns {field: column position} for the date,
+    description and either the amount or the debit/credit columns, or None if
+    the row is not a header.
+    """
+    names = [_header_name(cell) for cell in row]
+    columns = {"date": _find_column(names, DATE_HEADERS),
+               "description": _find_column(names, DESCRIPTION_HEADERS),
+               "amount": _find_column(names, AMOUNT_HEADERS),
+               "debit": _find_column(names, DEBIT_HEADERS),
+               "credit": _find_column(names, CREDIT_HEADERS)}
+    if columns["date"] is None or columns["description"] is None:
+        return None
+    if columns["amount"] is None and columns["debit"] is None and columns["credit"] is None:
+        return None
+    taken = {position for position in columns.values() if position is not None}
+    columns["details1"] = _find_column(names, DETAILS_HEADERS, taken)
+    columns["details2"] = _find_column(names, DETAILS_HEADERS, taken | {columns["details1"]})
+    return columns
+
+
+def _movements_from_rows(rows, file_name):
+    """Yields the BankMovements of a table (any iterable of rows): the rows below its header row."""
+    columns = None
+    for row_number, row in enumerate(rows, start=1):
+        if columns is None:
+            columns = _find_columns(row)
+            if columns is None and row_number >= MAX_HEADER_ROWS:
+                raise ValueError(f"No header row with a date, a description and an amount in {file_name}.")
+            continue
+
+        def cell(field):
+            position = columns[field]
+            return row[position] if position is not None and position < len(row) else None
+
+        # Rows without a date are blank lines, totals or notes.
+        date = _movement_date(cell("date"))
+        if date is None:
+            continue
+        if columns["amount"] is not None:
+            amount = _signed_amount(cell("amount"))
+        else:
+            debit, credit = _signed_amount(cell("debit")), _signed_amount(cell("credit"))
+            if debit is None and credit is None:
+                amount = None
+            else:
+                amount = abs(credit or 0) - abs(debit or 0)
+        if amount is None:
+            logger.warning("  --> %s, row %d: no amount. Skipping.", file_name, row_number)
+            continue
+        # The bank shows money paid out as negative; for the ledger, a payment is positive.
+        yield BankMovement(date, -amount, _text(cell("description")), _text(cell("details1")),
+                           _text(cell("details2")))
+    if columns is None:
+        raise ValueError(f"No header row with a date, a description and an amount in {file_name}.")
+
+
+def _csv_encoding(sample):
+    """The encoding of a CSV sample: UTF-8 (with or without BOM) if it decodes as such, otherwise Windows-1252."""
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        # An incremental decoder does not fail on a character cut in two at the end of the sample.
+        codecs.getincrementaldecoder("utf-8")().decode(sample)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1252"
+
+
+def _read_csv(stream, sample, file_name):
+    encoding = _csv_encoding(sample)
+    sample_text = sample.decode(encoding, errors="ignore")
+    delimiter = max(CSV_DELIMITERS, key=sample_text.count)
+    text = io.TextIOWrapper(stream, encoding=encoding, errors="replace", newline="")
+    try:
+        yield from _movements_from_rows(csv.reader(text, delimiter=delimiter), file_name)
+    finally:
+        # Leave the caller's stream open.
+        text.detach()
+
+
+def _read_excel(stream, file_name):
+    # A read-only workbook is read row by row instead of being loaded whole.
+    workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    try:
+        yield from _movements_from_rows(workbook.active.iter_rows(values_only=True), file_name)
+    finally:
+        workbook.close()
+
+
+# --- NORMA 43 STATEMENTS ---
+
+def _norma43_movement(record, concepts):
+    """Builds a BankMovement from a Norma 43 movement record ("22") and its concept records ("23")."""
+    date = datetime.datetime.strptime(record[10:16], "%y%m%d").date()
+    amount = Decimal(int(record[28:42])).scaleb(-2)
+    # '1' is a debit (money paid out: a payment), '2' a credit.
+    if record[27] != "1":
+        amount = -amount
+    reference1, reference2 = record[52:64].strip(), record[64:80].strip()
+    if concepts:
+        description, details2 = " ".join(concepts[:2]), reference2
+    else:
+        description, details2 = reference2 or NORMA43_CONCEPTS.get(record[22:24], ""), ""
+    details1 = " ".join(concepts[2:]) or reference1
+    return BankMovement(date, amount, _text(description), _text(details1), _text(details2))
+
+
+def _read_norma43(stream, file_name):
+    text = io.TextIOWrapper(stream, encoding="latin-1", newline=None)
+    record, concepts = None, []
+    try:
+        for line_number, line in enumerate(text, start=1):
+            line = line.rstrip("\r\n").ljust(80)
+            code = line[:2]
+            if code == "23" and record is not None:
+                concepts += [concept for concept in (line[4:42].strip(), line[42:80].strip()) if concept]
+                continue
+            if record is not None:
+                yield _norma43_movement(record, concepts)
+                record, concepts = None, []
+            if code == "22":
+                if not (line[10:16].isdigit() and line[28:42].isdigit()):
+                    logger.warning("  --> %s, line %d: no date or amount. Skipping.", file_name, line_number)
+                    continue
+                record = line
+            elif code not in ("11", "24", "33", "88", "  "):
+                logger.warning("  --> %s, line %d: unknown Norma 43 record '%s'. Skipping.",
+                               file_name, line_number, code)
+        if record is not None:
+            yield _norma43_movement(record, concepts)
+    finally:
+        text.detach()
+
+
+# --- READING ---
+
+def _as_value_errors(movements, file_name):
+    """Yields the movements, turning the errors of a damaged file (e.g. a broken .xlsx) into ValueErrors."""
+    try:
+        yield from movements
+    except (zipfile.BadZipFile, KeyError, EOFError, csv.Error,
+            openpyxl.utils.exceptions.InvalidFileException) as e:
+        raise ValueError(f"{file_name} could not be read as a bank statement ({e}).") from e
+
+
+def read_bank_statement(stream, file_name):
+    """
+    Yields the BankMovements of a statement, one at a time. Takes a binary,
+    seekable stream (an open file, a BytesIO or an uploaded file) and the file
+    name (its extension helps tell the format). A file that cannot be read
+    raises ValueError (possibly after some movements were yielded).
+    """
+    return _as_value_errors(_read_statement(stream, file_name), file_name)
+
+
+def _read_statement(stream, file_name):
+    """Tells the format of a statement from its first bytes and name, and returns the matching reader."""
+    sample = stream.read(SAMPLE_BYTES)
+    stream.seek(0)
+    extension = os.path.splitext(file_name)[1].lower()
+    if sample.startswith(OLD_EXCEL_SIGNATURE):
+        raise ValueError(f"{file_name} is an old Excel (.xls) file. Save it as .xlsx or .csv first.")
+    if extension in EXCEL_EXTENSIONS or sample.startswith(b"PK"):
+        return _read_excel(stream, file_name)
+    first_line = sample.lstrip().split(b"\n", 1)[0].decode("latin-1")
+    if NORMA43_START.match(first_line) or (extension in NORMA43_EXTENSIONS and first_line.startswith("11")):
+        return _read_norma43(stream, file_name)
+    return _read_csv(stream, sample, file_name)
+
+
+def _numbered(movements):
+    """
+    Yields (movement, occurrence) pairs, where 'occurrence' counts the same
+    movement (date, amount and description) on this statement: 1, 2...
+    Statements are in date order, so the counts are kept for one day at a time.
+    """
+    counts, day = {}, None
+    for movement in movements:
+        if movement.date != day:
+            counts, day = {}, movement.date
+        key = ledger_store.movement_key(movement.date, movement.amount, movement.description)
+        counts[key] = counts.get(key, 0) + 1
+        yield movement, counts[key]
+
+
+def _batches(movements, result):
+    """Groups the movements to load into batches, counting what is read and what is left out."""
+    batch = []
+    for movement, occurrence in _numbered(movements):
+        result["read"] += 1
+        if movement.amount < 0 and not config.BANK_IMPORT_INCLUDE_CREDITS:
+            result["credits"] += 1
+            continue
+        batch.append((movement, occurrence))
+        if len(batch) >= config.BANK_IMPORT_BATCH_ROWS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# --- LOADING ---
+
+def _load_into_ledger(movements, result):
+    for batch in _batches(movements, result):
+        with timed("bank_import_write"):
+            result["added"] += ledger_store.add_payments(
+                (movement.date, movement.amount, movement.description, movement.details1, movement.details2,
+                 occurrence) for movement, occurrence in batch)
+
+
+def _load_into_sheet(movements, result):
+    """Without the ledger store: appends the new movements straight to the bank sheet."""
+    worksheet = get_sheets_session().get_client().open(config.BANK_SHEET_NAME).sheet1
+    with timed("sheet_read"):
+        rows = call_provider("sheets", worksheet.get_all_values)
+    # The movements already in the sheet, numbered the same way.
+    loaded, counts = set(), {}
+    for row in rows[1:]:
+        row = (list(row) + [""] * 3)[:3]
+        key = ledger_store.movement_key(parse_date(row[0]), parse_amount(row[1]), row[2])
+        counts[key] = counts.get(key, 0) + 1
+        loaded.add((key, counts[key]))
+    del rows, counts
+
+    for batch in _batches(movements, result):
+        new_rows = []
+        for movement, occurrence in batch:
+            if (ledger_store.movement_key(movement.date, movement.amount, movement.description),
+                    occurrence) in loaded:
+                continue
+            new_rows.append([movement.date.strftime("%d-%m-%Y"), format_amount(movement.amount),
+                             movement.description, "", "", movement.details1, movement.details2])
+        if new_rows:
+            with timed("sheet_write"):
+                call_provider("sheets", worksheet.append_rows, new_rows)
+            count("sheet_rows_written", len(new_rows))
+            result["added"] += len(new_rows)
+
+
+def import_bank_statement(stream, file_name):
+    """
+    Loads a bank statement (see read_bank_statement()) into the bank payments.
+    Returns {"read": movements on the statement, "added": new payments loaded,
+    "skipped": movements that were already loaded, "credits": money paid in, left out}.
+    With the ledger store, call sheets_connector.flush_sheet() (or wait for the
+    background sync) to copy the new payments to the bank sheet.
+    """
+    result = {"read": 0, "added": 0, "skipped": 0, "credits": 0}
+    movements = read_bank_statement(stream, file_name)
+    with timed("bank_import"):
+        if config.LEDGER_STORE_ENABLED:
+            _load_into_ledger(movements, result)
+        else:
+            _load_into_sheet(movements, result)
+    result["skipped"] = result["read"] - result["credits"] - result["added"]
+    count("bank_movements_imported", result["added"])
+    logger.info("Imported %s: %d movement(s) read, %d new, %d already loaded, %d credit(s) left out.",
+                file_name, result["read"], result["added"], result["skipped"], result["credits"])
+    return result
+
+
+def import_bank_file(path):
+    """Loads the bank statement at 'path'. Returns the same counts as import_bank_statement()."""
+    with open(path, "rb") as stream:
+        return import_bank_statement(stream, os.path.basename(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loads bank statements (CSV, XLSX or Norma 43) into the bank "
+                                                 "payments.")
+    parser.add_argument("files", nargs="+", metavar="FILE", help="the bank statement file(s) to load")
+    args = parser.parse_args()
+
+    for path in args.files:
+        try:
+            import_bank_file(path)
+        except ValueError as e:
+            logger.error("Could not import %s: %s", path, e)
+    if config.LEDGER_STORE_ENABLED:
+        flush_sheet()
@@ -0,0 +1,626 @@
+# benchmark.py
+# An offline benchmark of the batch runner and the reconciliation engine.
+#
+# Nothing here talks to OpenAI, Document AI or Google Sheets: the real clients
+# are swapped for the local stand-ins (FakeOpenAIClient, FakeDocumentProcessor,
+# FakeSheetsClient) that answer with recorded responses after a configurable
+# delay. The invoices are synthetic Spanish PDFs (digital ones, read through the
+# text layer, and "scanned" ones, which go to the vision model) and the bank
+# ledgers are synthetic sheets with a known share of matching payments.
+#
+# Each scenario reports its throughput, p50/p99 latency and peak Python memory
+# (measured with tracemalloc, which does not see PyMuPDF's own allocations).
+# All state (cache, journal, folders) lives in a temporary folder. The
+# "startup" scenario imports each entry point in a fresh interpreter and fails
+# the run when one takes longer than the import-time budget.
+#
+# Run it with:
+#     python benchmark.py --scale 1k
+#     python benchmark.py --scale 10k --output results.json
+#     python benchmark.py --scale 10k --baseline results.json   # exits with 1 on a regression
+#     python benchmark.py --scenarios startup                    # exits with 1 over the import-time budget
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from datetime import date, timedelta
+
+import fitz  # This is the PyMuPDF library
+
+import config
+
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+SCENARIOS = ["startup", "single", "batch", "reconcile"]
+# The entry points whose import time is measured, and the libraries we report as loaded by them.
+STARTUP_MODULES = ["correlator", "main", "watcher", "core_processing"]
+HEAVY_LIBRARIES = ["openai", "google.cloud.documentai", "gspread", "fitz", "PIL.Image", "pandas"]
+# A reconciliation-only or fully cached run should start well within this.
+IMPORT_TIME_BUDGET_SECONDS = 1.0
+STARTUP_SCRIPT = """
+import json, sys, time
+started_at = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started_at
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {libraries!r} if name in sys.modules]}}))
+"""
+
+# Recorded replies of the primary agent, returned in turn for "scanned" invoices.
+# The last one has no total, so every fifth scanned invoice falls back to the specialist.
+RECORDED_OPENAI_REPLIES = [
+    '{"supplier": "Exluib S.A.", "supplier_nif": "B12345674", "date": "16-08-2025", "invoice_id": "A-5899", "total": "484.10", '
+    '"subtotal": "420.00", "iva_breakdown": [{"base": "200.00", "cuota": "42.00"}, {"base": "220.00", "cuota": "22.10"}]}',
+    '{"supplier": "Makro Autoservicio Mayorista S.A.", "supplier_nif": "A28647451", "date": "02-09-2025", "invoice_id": "0/0(024)0012/001842", '
+    '"total": "1524.60", "subtotal": "1260.00", "total_tax": "264.60"}',
+    '{"supplier": "Bodegas Can Rich S.L.", "supplier_nif": "B57123457", "date": "21-07-2025", "invoice_id": "FV25-0311", "total": "726.00", '
+    '"subtotal": "600.00", "iva_breakdown": [{"base": "600.00", "cuota": "126.00"}]}',
+    '```json\n{"supplier": "Panadería Can Pep S.L.", "supplier_nif": "B07654329", "date": "30-06-2025", "invoice_id": "T-1187", "total": "93.60", '
+    '"subtotal": "90.00", "total_tax": "3.60"}\n```',
+    '{"supplier": "Aguas de Ibiza S.A.", "date": "11-08-2025", "invoice_id": "R-22871"}',
+]
+# Recorded entities of the specialist agent.
+RECORDED_DOCUMENTAI_ENTITIES = {
+    "supplier_name": "Aguas de Ibiza S.A.", "supplier_tax_id": "A07011234", "invoice_date": "11-08-2025", "invoice_id": "R-22871",
+    "total_amount": "60.50", "net_amount": "55.00", "total_tax_amount": "5.50",
+}
+
+# Suppliers of the synthetic invoices and ledgers, with valid-looking CIFs.
+SUPPLIERS = [
+    ("Distribuciones Exluib S.L.", "B12345674"),
+    ("Makro Autoservicio Mayorista S.A.", "A28647451"),
+    ("Bodegas Can Rich S.L.", "B57123457"),
+    ("Panadería Can Pep S.L.", "B07654329"),
+    ("Aguas de Ibiza S.A.", "A07011234"),
+    ("Ferretería Juan Marí S.L.", "B07998871"),
+    ("Gas Natural Comercializadora S.A.", "A61797536"),
+    ("Telefónica de España S.A.U.", "A82018474"),
+    ("Frutas y Verduras Es Mercat S.L.", "B57845121"),
+    ("Limpiezas Pitiusas S.L.", "B57002219"),
+]
+INVOICE_HEADER = ['Supplier Name', 'Invoice Date', 'Invoice Number', 'Tax', 'Total Amount', 'Paid On', 'Filename',
+                  'Match Percentage']
+BANK_HEADER = ['Date', 'Amount', 'Description', 'Matched Invoice ID', 'Matched Filename', 'Bank Details 1',
+               'Bank Details 2']
+# How many distinct "scanned" page images are rendered; the files themselves stay unique.
+SCANNED_TEMPLATES = 16
+SCANNED_DPI = 100
+# One shared font: a TextWriter with a prepared font is many times faster than page.insert_text().
+INVOICE_FONT = fitz.Font("helv")
+
+
+# --- SYNTHETIC DATA ---
+
+def _spanish_amount(amount):
+    """Formats an amount the Spanish way, e.g. 1.524,60."""
+    return f"{amount:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def make_invoice(rng, number, prefix="B"):
+    """Returns the data of one synthetic invoice (a dictionary)."""
+    supplier, cif = rng.choice(SUPPLIERS)
+    lines = [(f"Producto {rng.randint(1, 999)}", round(rng.uniform(5, 400), 2)) for _ in range(rng.randint(1, 8))]
+    subtotal = round(sum(amount for _, amount in lines), 2)
+    tax = round(subtotal * 0.21, 2)
+    invoice_date = date(2025, 1, 1) + timedelta(days=rng.randint(0, 300))
+    return {"supplier": supplier, "cif": cif, "invoice_id": f"{prefix}-{number:06d}", "date": invoice_date,
+            "lines": lines, "subtotal": subtotal, "tax": tax, "total": round(subtotal + tax, 2)}
+
+
+def make_invoice_pdf(invoice):
+    """Renders an invoice as a digitally generated PDF (with a text layer), like most suppliers send."""
+    doc = fitz.open()
+    page = doc.new_page()
+    text_writer = fitz.TextWriter(page.rect)
+    y = 60
+
+    def write(x, text):
+        text_writer.append((x, y), text, font=INVOICE_FONT, fontsize=10)
+
+    write(50, invoice["supplier"])
+    write(350, config.MY_COMPANY_NAME)
+    y += 14
+    write(50, f"CIF: {invoice['cif']}")
+    write(350, f"NIF {config.MY_COMPANY_CIF}")
+    y += 14
+    write(50, "C/ Mayor 1, 07800 Ibiza")
+    y += 30
+    write(50, f"Factura Nº: {invoice['invoice_id']}")
+    y += 14
+    write(50, f"Fecha factura: {invoice['date'].strftime('%d/%m/%Y')}")
+    y += 30
+    for description, amount in invoice["lines"]:
+        write(50, description)
+        write(400, _spanish_amount(amount))
+        y += 14
+    y += 30
+    write(300, "Base Imponible")
+    write(450, _spanish_amount(invoice["subtotal"]))
+    y += 14
+    write(300, "Cuota IVA 21%")
+    write(450, _spanish_amount(invoice["tax"]))
+    y += 14
+    write(300, "Total Factura")
+    write(450, f"{_spanish_amount(invoice['total'])} €")
+    text_writer.write_text(page)
+    return doc.tobytes()
+
+
+class ScannedInvoiceFactory:
+    """
+    Makes "scanned" PDFs (a page image, no text layer). Rendering is the slow
+    part, so a few page images are rendered once and reused; each PDF still
+    gets unique bytes (its title), so the cache and the journal treat it as a new file.
+    """
+
+    def __init__(self, rng):
+        self.page_images = []
+        for number in range(SCANNED_TEMPLATES):
+            with fitz.open(stream=make_invoice_pdf(make_invoice(rng, number, "S")), filetype="pdf") as doc:
+                pixmap = doc.load_page(0).get_pixmap(dpi=SCANNED_DPI)
+                self.page_images.append((doc.load_page(0).rect, pixmap.tobytes("jpeg")))
+
+    def make_pdf(self, invoice):
+        rect, image = self.page_images[zlib.crc32(invoice["invoice_id"].encode()) % len(self.page_images)]
+        doc = fitz.open()
+        doc.new_page(width=rect.width, height=rect.height).insert_image(rect, stream=image)
+        doc.set_metadata({"title": invoice["invoice_id"]})
+        return doc.tobytes()
+
+
+def generate_invoice_files(count, scanned_share, seed, prefix):
+    """Yields (file_name, file_content) for 'count' synthetic invoices, a share of them scanned."""
+    rng = random.Random(seed)
+    scanned_factory = ScannedInvoiceFactory(rng) if scanned_share > 0 else None
+    for number in range(count):
+        invoice = make_invoice(rng, number, prefix)
+        if scanned_factory and rng.random() < scanned_share:
+            yield f"{invoice['invoice_id']}-scan.pdf", scanned_factory.make_pdf(invoice)
+        else:
+            yield f"{invoice['invoice_id']}.pdf", make_invoice_pdf(invoice)
+
+
+def generate_ledgers(count, seed, paid_share=0.6, noise_share=0.3, group_share=0.2):
+    """
+    Returns the values (header included) of a synthetic invoice sheet with
+    'count' invoices and a bank sheet with a payment for 'paid_share' of them
+    (some of it dated a little off, described in various ways) plus unrelated payments.
+    'group_share' of the other invoices are paid in instalments, or together
+    with the supplier's next unpaid invoice.
+    """
+    rng = random.Random(seed)
+    # A separate generator, so the rest of the ledgers stay the same as without groups.
+    group_rng = random.Random(seed + 1)
+    invoice_values = [list(INVOICE_HEADER)]
+    bank_values = [list(BANK_HEADER)]
+    unpaid_by_supplier = {}
+    for number in range(count):
+        invoice = make_invoice(rng, number, "L")
+        already_paid = rng.random() < 0.1
+        invoice_values.append([
+            invoice["supplier"], invoice["date"].strftime("%d-%m-%Y"), invoice["invoice_id"], f"{invoice['tax']:.2f}",
+            f"{invoice['total']:.2f}", "01-01-2025" if already_paid else "", f"{invoice['invoice_id']}.pdf", ""])
+        if already_paid:
+            continue
+        if rng.random() >= paid_share:
+            unpaid_by_supplier.setdefault(invoice["supplier"], []).append(invoice)
+            continue
+        payment_date = invoice["date"] + timedelta(days=rng.randint(-3, 45))
+        first_word = invoice["supplier"].split()[0]
+        description = rng.choice([invoice["supplier"].upper(), f"TRANSF {first_word.upper()}",
+                                  f"RECIBO {invoice['supplier']}", "PAGO TARJETA"])
+        bank_values.append([payment_date.strftime("%d-%m-%Y"), f"{_spanish_amount(invoice['total']).replace('.', '')} €",
+                            description, "", "", rng.choice(["", invoice["supplier"]]), rng.choice(["", "ES12"])])
+    for supplier, invoices in unpaid_by_supplier.items():
+        invoices.sort(key=lambda invoice: invoice["date"])
+        while invoices:
+            invoice = invoices.pop(0)
+            if group_rng.random() >= group_share:
+                continue
+            cents = int(round(invoice["total"] * 100))
+            if invoices and (invoices[0]["date"] - invoice["date"]).days <= 30 and group_rng.random() < 0.5:
+                # One transfer for this invoice and the next.
+                other = invoices.pop(0)
+                payments = [(other["date"] + timedelta(days=group_rng.randint(0, 20)),
+                             cents + int(round(other["total"] * 100)))]
+            else:
+                # Two or three instalments.
+                parts = group_rng.randint(2, 3)
+                shares = sorted(group_rng.sample(range(1, cents), parts - 1)) if cents > parts else []
+                amounts = [high - low for low, high in zip([0] + shares, shares + [cents])]
+                payments = [(invoice["date"] + timedelta(days=group_rng.randint(0, 30 * (k + 1)) // 2), amount)
+                            for k, amount in enumerate(amounts)]
+            for payment_date, amount in payments:
+                bank_values.append([payment_date.strftime("%d-%m-%Y"),
+                                    _spanish_amount(amount / 100).replace('.', '') + " €",
+                                    f"TRANSF {supplier.upper()}", "", "", "", ""])
+    for _ in range(int(count * noise_share)):
+        payment_date = date(2025, 1, 1) + timedelta(days=rng.randint(0, 330))
+        bank_values.append([payment_date.strftime("%d-%m-%Y"), f"{rng.uniform(1, 3000):.2f}".replace(".", ",") + " €",
+                            rng.choice(["COMISION MANTENIMIENTO", "PAGO TARJETA", "TRANSF NOMINA", "RECIBO SEGURO"]),
+                            "", "", "", ""])
+    # Bank exports are ordered by date.
+    bank_values[1:] = sorted(bank_values[1:], key=lambda row: (row[0][6:], row[0][3:5], row[0][:2]))
+    return invoice_values, bank_values
+
+
+# --- MEASURING ---
+
+def _percentile(samples, percentile):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+
+@contextlib.contextmanager
+def measure(result, track_memory=True):
+    """Fills in 'seconds' and 'peak_memory_mb' of a result dictionary for the 'with' block."""
+    if track_memory:
+        tracemalloc.start()
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        result["seconds"] = round(time.perf_counter() - started_at, 3)
+        if track_memory:
+            result["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+            tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Sends the pipeline's console output to nowhere while a scenario runs."""
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+# --- SCENARIOS ---
+
+class Benchmark:
+    """Runs the scenarios against the local stand-ins, with all state in 'workdir'."""
+
+    def __init__(self, count, workdir, args):
+        self.count = count
+        self.workdir = workdir
+        self.args = args
+        self._isolate_state()
+        # Imported only now: main.py derives its folders from config at import time.
+        import extractor
+        import google_ai_connector
+        import instrumentation
+        import ledger_store
+        import main
+        import sheets_connector
+        from correlator import reconcile_sheets
+        from core_processing import process_single_invoice
+        from matching_engine import GROUP_MATCH_SCORE
+        self.main = main
+        self.instrumentation = instrumentation
+        self.ledger_store = ledger_store
+        self.sheets_connector = sheets_connector
+        self.reconcile_sheets = reconcile_sheets
+        self.group_match_score = GROUP_MATCH_SCORE
+        self.process_single_invoice = process_single_invoice
+
+        self.openai = extractor.FakeOpenAIClient(args.replies, latency_seconds=args.openai_latency)
+        extractor.use_client(self.openai)
+        self.documentai = google_ai_connector.FakeDocumentProcessor(args.entities, latency_seconds=args.documentai_latency)
+        google_ai_connector.use_client(self.documentai)
+        # Keep every latency sample, so the percentiles cover the whole run.
+        instrumentation.MAX_SAMPLES_PER_STAGE = max(instrumentation.MAX_SAMPLES_PER_STAGE, count)
+
+    def _isolate_state(self):
+        """Points every file and folder the pipeline uses into the temporary folder."""
+        config.INVOICE_FOLDER = os.path.join(self.workdir, "invoices")
+        config.ARCHIVE_FOLDER = os.path.join(config.INVOICE_FOLDER, "archive")
+        config.FAILED_FOLDER = os.path.join(config.INVOICE_FOLDER, "failed")
+        config.PROCESSING_FOLDER = os.path.join(config.INVOICE_FOLDER, "processing")
+        config.RECONCILED_FOLDER = os.path.join(config.ARCHIVE_FOLDER, "reconciled")
+        config.EXTRACTION_CACHE_FILE = os.path.join(self.workdir, "extraction_cache.sqlite")
+        config.JOB_JOURNAL_FILE = os.path.join(self.workdir, "job_journal.sqlite")
+        config.NAME_SCORE_CACHE_FILE = os.path.join(self.workdir, "name_scores.sqlite")
+        config.SUPPLIER_DIRECTORY_FILE = os.path.join(self.workdir, "supplier_directory.sqlite")
+        config.LEDGER_STORE_FILE = os.path.join(self.workdir, "ledger.sqlite")
+        config.RECONCILIATION_STATE_FILE = os.path.join(self.workdir, "reconciliation_state.json")
+        config.METRICS_EXPORT_FILE = None
+        config.METRICS_ENABLED = True
+        os.makedirs(config.INVOICE_FOLDER)
+        if self.args.ledger_store:
+            config.LEDGER_STORE_ENABLED = True
+        if not self.args.rate_limits:
+            # The stand-ins have no quotas; only the concurrency limits stay in place.
+            config.PROVIDER_RATE_LIMITS = {provider: 1_000_000 for provider in ("openai", "documentai", "sheets")}
+
+    def _use_fake_sheets(self, invoice_values, bank_values=None):
+        """Gives the shared sheets session fresh in-memory sheets; returns the invoice and bank worksheets."""
+        worksheets = {
+            config.INVOICE_SHEET_NAME: self.sheets_connector.FakeWorksheet(
+                invoice_values, config.INVOICE_SHEET_NAME, self.args.sheets_latency),
+            config.BANK_SHEET_NAME: self.sheets_connector.FakeWorksheet(
+                bank_values or [list(BANK_HEADER)], config.BANK_SHEET_NAME, self.args.sheets_latency),
+        }
+        self.sheets_connector.get_sheets_session().use_client(self.sheets_connector.FakeSheetsClient(worksheets))
+        return worksheets[config.INVOICE_SHEET_NAME], worksheets[config.BANK_SHEET_NAME]
+
+    def _invoice_result(self, name, seconds_key="seconds"):
+        """Throughput and latency of an invoice scenario, from the per-invoice timings."""
+        metrics = self.instrumentation.export_json()
+        invoice_stage = metrics["stages"].get("invoice", {})
+        outcomes = {counter["labels"].get("outcome"): counter["value"]
+                    for counter in metrics["counters"] if counter["name"] == "invoices"}
+        prompt_tokens = sum(counter["value"] for counter in metrics["counters"]
+                            if counter["name"] == "openai_prompt_tokens")
+        return {
+            "scenario": name,
+            "items": self.count,
+            "succeeded": outcomes.get("success", 0),
+            "failed": outcomes.get("failed", 0),
+            "p50_seconds": invoice_stage.get("p50_seconds", 0.0),
+            "p99_seconds": invoice_stage.get("p99_seconds", 0.0),
+            "llm_calls": len(self.openai.requests),
+            "prompt_tokens_per_invoice": round(prompt_tokens / self.count, 1),
+            "specialist_calls": len(self.documentai.requests),
+        }
+
+    def run_startup(self):
+        """
+        Imports each entry point in a fresh interpreter, 'repeat' times, without
+        any API key in the environment (nothing may need one at import time).
+        """
+        environment = {name: value for name, value in os.environ.items()
+                       if name not in ("OPENAI_API_KEY", "GOOGLE_APPLICATION_CREDENTIALS")}
+        project_folder = os.path.dirname(os.path.abspath(__file__))
+        imports = {}
+        for module in STARTUP_MODULES:
+            script = STARTUP_SCRIPT.format(module=module, libraries=HEAVY_LIBRARIES)
+            samples, loaded = [], []
+            for _ in range(self.args.repeat):
+                output = subprocess.run([sys.executable, "-c", script], cwd=project_folder, env=environment,
+                                        capture_output=True, text=True, check=True).stdout
+                measurement = json.loads(output.splitlines()[-1])
+                samples.append(measurement["seconds"])
+                loaded = measurement["loaded"]
+            imports[module] = {"p50_seconds": round(_percentile(samples, 50), 4), "loaded": loaded}
+        all_samples = [entry["p50_seconds"] for entry in imports.values()]
+        return {
+            "scenario": "startup",
+            "items": len(imports),
+            "seconds": round(sum(all_samples), 3),
+            "p50_seconds": round(_percentile(all_samples, 50), 4),
+            "p99_seconds": round(max(all_samples), 4),
+            "imports": imports,
+            "over_budget": [f"{module}: {entry['p50_seconds']}s" for module, entry in imports.items()
+                            if entry["p50_seconds"] > self.args.import_budget],
+        }
+
+    def run_single(self):
+        """process_single_invoice() on one invoice after the other, straight from memory."""
+        worksheet, _ = self._use_fake_sheets([list(INVOICE_HEADER)])
+        self.instrumentation.reset_metrics()
+        self.openai.requests.clear()
+        self.documentai.requests.clear()
+        files = generate_invoice_files(self.count, self.args.scanned_share, self.args.seed, "SGL")
+        # Generating the PDFs is not part of the measurement.
+        generation_seconds = 0.0
+        result = {}
+        with _quiet(), measure(result, self.args.memory):
+            while True:
+                generation_started_at = time.perf_counter()
+                file_name, file_content = next(files, (None, None))
+                generation_seconds += time.perf_counter() - generation_started_at
+                if file_name is None:
+                    break
+                self.process_single_invoice(file_content, file_name)
+            self.sheets_connector.flush_sheet()
+        result["seconds"] = round(result["seconds"] - generation_seconds, 3)
+        result.update(self._invoice_result("single"), rows_written=worksheet.row_count - 1)
+        return result
+
+    def run_batch(self):
+        """process_all_invoices() over a folder of invoice files, with the configured number of workers."""
+        worksheet, _ = self._use_fake_sheets([list(INVOICE_HEADER)])
+        for file_name, file_content in generate_invoice_files(self.count, self.args.scanned_share,
+                                                              self.args.seed + 1, "BAT"):
+            with open(os.path.join(config.INVOICE_FOLDER, file_name), "wb") as f:
+                f.write(file_content)
+        self.instrumentation.reset_metrics()
+        self.openai.requests.clear()
+        self.documentai.requests.clear()
+        result = {}
+        with _quiet(), measure(result, self.args.memory):
+            self.main.process_all_invoices(max_workers=self.args.workers, batched=self.args.batched,
+                                           use_batch_api=self.args.batch_api)
+        result.update(self._invoice_result("batch"), rows_written=worksheet.row_count - 1)
+        return result
+
+    def run_reconcile(self):
+        """
+        reconcile_sheets() over synthetic ledgers (a full run, from fresh sheets
+        and a fresh ledger store, 'repeat' times, until the matches are in the
+        sheets). The latency percentiles are over the repeats. With the ledger
+        store, one more incremental run on the last ledger shows a rerun's time.
+        """
+        invoice_values, bank_values = generate_ledgers(self.count, self.args.seed + 2)
+        run_seconds = []
+        matched = group_matched = 0
+        rerun_seconds = None
+        result = {}
+        with _quiet(), measure(result, self.args.memory):
+            for repeat in range(self.args.repeat):
+                invoice_sheet, _ = self._use_fake_sheets(invoice_values, bank_values)
+                self.ledger_store.use_ledger_file(os.path.join(self.workdir, f"ledger-reconcile-{repeat}.sqlite"))
+                self.instrumentation.reset_metrics()
+                started_at = time.perf_counter()
+                self.reconcile_sheets(incremental=False)
+                self.sheets_connector.flush_sheet()
+                run_seconds.append(time.perf_counter() - started_at)
+                matched = sum(1 for original, row in zip(invoice_values[1:], invoice_sheet.values[1:])
+                              if row[5] and not original[5])
+                group_matched = sum(1 for row in invoice_sheet.values[1:] if row[7:8] == [str(self.group_match_score)])
+            if config.LEDGER_STORE_ENABLED:
+                started_at = time.perf_counter()
+                self.reconcile_sheets(incremental=True)
+                rerun_seconds = round(time.perf_counter() - started_at, 4)
+                self.sheets_connector.flush_sheet()
+        phases = {stage: stats["total_seconds"] for stage, stats in self.instrumentation.export_json()["stages"].items()
+                  if stage.startswith("reconcile_")}
+        result.update({
+            "scenario": "reconcile",
+            "items": self.count,
+            "payments": len(bank_values) - 1,
+            "matched": matched,
+            "group_matched": group_matched,
+            "p50_seconds": round(_percentile(run_seconds, 50), 4),
+            "p99_seconds": round(_percentile(run_seconds, 99), 4),
+            "last_run_phases": phases,
+            "rerun_seconds": rerun_seconds,
+        })
+        # Throughput of one reconciliation run: invoices reconciled per second.
+        result["seconds"] = round(sum(run_seconds) / len(run_seconds), 3)
+        return result
+
+    def run(self, scenarios):
+        results = []
+        for scenario in scenarios:
+            print(f"Running '{scenario}' with {self.count} item(s)...", flush=True)
+            result = getattr(self, f"run_{scenario}")()
+            result["throughput_per_second"] = round(result["items"] / result["seconds"], 1) if result["seconds"] else 0.0
+            results.append(result)
+        return results
+
+
+# --- REPORTING ---
+
+def print_report(results):
+    print(f"\n{'scenario':<10} {'items':>8} {'seconds':>9} {'items/s':>9} {'p50 s':>8} {'p99 s':>8} {'peak MB':>8}")
+    for result in results:
+        print(f"{result['scenario']:<10} {result['items']:>8} {result['seconds']:>9.2f} "
+              f"{result['throughput_per_second']:>9.1f} {result['p50_seconds']:>8.3f} {result['p99_seconds']:>8.3f} "
+              f"{result['peak_memory_mb'] if 'peak_memory_mb' in result else '-':>8}")
+    for result in results:
+        if "imports" in result:
+            print("startup: " + ", ".join(
+                f"{module} {entry['p50_seconds']:.2f}s" + (f" (loads {', '.join(entry['loaded'])})" if entry['loaded'] else "")
+                for module, entry in result["imports"].items()) + ".")
+        elif "succeeded" in result:
+            print(f"{result['scenario']}: {result['succeeded']} succeeded, {result['failed']} failed, "
+                  f"{result['rows_written']} row(s) written, {result['llm_calls']} LLM call(s) "
+                  f"({result['prompt_tokens_per_invoice']} prompt tokens per invoice), "
+                  f"{result['specialist_calls']} specialist call(s).")
+        else:
+            print(f"{result['scenario']}: {result['matched']} of {result['items']} invoice(s) matched "
+                  f"({result['group_matched']} by split or combined payments) against {result['payments']} payment(s)"
+                  + (f"; an incremental rerun on the ledger store took {result['rerun_seconds']:.3f}s."
+                     if result.get('rerun_seconds') is not None else "."))
+
+
+def find_regressions(results, baseline, max_regression):
+    """
+    Compares the results with a baseline run (same scale) and returns a
+    description of every scenario that got slower or bigger than allowed.
+    """
+    regressions = []
+    baseline_by_scenario = {result["scenario"]: result for result in baseline["results"]}
+    for result in results:
+        before = baseline_by_scenario.get(result["scenario"])
+        if not before or before["items"] != result["items"]:
+            continue
+        if result["throughput_per_second"] < before["throughput_per_second"] * (1 - max_regression):
+            regressions.append(f"{result['scenario']}: throughput {before['throughput_per_second']} -> "
+                               f"{result['throughput_per_second']} items/s")
+        for key in ("p99_seconds", "peak_memory_mb"):
+            if before.get(key) and result.get(key, 0) > before[key] * (1 + max_regression):
+                regressions.append(f"{result['scenario']}: {key} {before[key]} -> {result[key]}")
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the invoice pipeline and the reconciliation.")
+    parser.add_argument("--scale", default="1k", help="number of invoices: 1k, 10k, 100k or any number (default: 1k)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--workers", type=int, default=config.MAX_CONCURRENT_INVOICES,
+                        help="workers for the batch scenario (default: config.MAX_CONCURRENT_INVOICES)")
+    parser.add_argument("--scanned-share", type=float, default=0.3,
+                        help="share of scanned invoices, which go to the (fake) vision model (default: 0.3)")
+    parser.add_argument("--openai-latency", type=float, default=0.05, help="seconds per fake OpenAI call")
+    parser.add_argument("--documentai-latency", type=float, default=0.05, help="seconds per fake Document AI call")
+    parser.add_argument("--sheets-latency", type=float, default=0.05, help="seconds per fake Sheets request")
+    parser.add_argument("--batched", action="store_true",
+                        help="batch scenario: several invoices per LLM request (main.py --batched)")
+    parser.add_argument("--batch-api", action="store_true",
+                        help="batch scenario: go through the (fake) OpenAI Batch API (main.py --batch-api)")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep config.PROVIDER_RATE_LIMITS (by default only the concurrency limits apply)")
+    parser.add_argument("--ledger-store", action="store_true",
+                        help="use the local ledger store (config.LEDGER_STORE_ENABLED) whatever the config says")
+    parser.add_argument("--repeat", type=int, default=3, help="reconciliation runs (default: 3)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--fixtures", help="a JSON file with recorded 'openai_replies' and 'documentai_entities'")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip tracemalloc (it slows the pipeline down noticeably)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results JSON of an earlier run")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="allowed slowdown or growth against the baseline (default: 0.2 = 20%%)")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_TIME_BUDGET_SECONDS,
+                        help="startup scenario: the longest an entry point may take to import "
+                             f"(default: {IMPORT_TIME_BUDGET_SECONDS}s)")
+    parser.add_argument("--keep-files", action="store_true", help="keep the temporary folder")
+    args = parser.parse_args()
+
+    args.replies, args.entities = RECORDED_OPENAI_REPLIES, RECORDED_DOCUMENTAI_ENTITIES
+    if args.fixtures:
+        with open(args.fixtures, "r", encoding="utf-8") as f:
+            fixtures = json.load(f)
+        args.replies = fixtures.get("openai_replies") or args.replies
+        args.entities = fixtures.get("documentai_entities") or args.entities
+    return args
+
+
+def main():
+    args = parse_arguments()
+    count = SCALES.get(args.scale) or int(args.scale)
+    workdir = tempfile.mkdtemp(prefix="invoice-benchmark-")
+    try:
+        results = Benchmark(count, workdir, args).run(args.scenarios)
+    finally:
+        if args.keep_files:
+            print(f"Benchmark files kept in: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"scale": count, "created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, f,
+                      indent=2)
+        print(f"\nResults written to: {args.output}")
+    over_budget = [entry for result in results for entry in result.get("over_budget", [])]
+    if over_budget:
+        print(f"\nOVER the import-time budget of {args.import_budget}s:")
+        for entry in over_budget:
+            print(f"  {entry}")
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.max_regression)
+        if regressions:
+            print("\nREGRESSIONS against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+        else:
+            print("\nNo regressions against the baseline.")
+    if over_budget or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
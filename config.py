@@ -12,6 +12,9 @@ ARCHIVE_FOLDER = os.path.join(INVOICE_FOLDER, "archive")
 FAILED_FOLDER = os.path.join(INVOICE_FOLDER, "failed")
 # Define the reconciled folder inside the archive folder
 RECONCILED_FOLDER = os.path.join(ARCHIVE_FOLDER, "reconciled")
+# Files are moved here while a batch run is working on them, so that two
+# overlapping runs never pick up the same invoice.
+PROCESSING_FOLDER = os.path.join(INVOICE_FOLDER, "processing")
 
 # --- 2. Google Sheets Configuration ---
 # The exact names of your Google Sheets.
@@ -40,4 +43,189 @@ PRIMARY_MATCH_THRESHOLD = 80
 SECONDARY_MATCH_THRESHOLD = 90
 # The tolerance in days for matching payments to invoices.
 # A payment date can be this many days BEFORE the invoice date and still be considered a match.
-PAYMENT_DATE_TOLERANCE_DAYS = 5
\ No newline at end of file
+PAYMENT_DATE_TOLERANCE_DAYS = 5
+# When True, reconciliation only fetches rows that were still unmatched after the
+# last run plus rows added since (with the ledger store: only the rows added to the
+# sheets since the last sync). Set to False (or delete the state file) to
+# force a full re-read of both sheets.
+INCREMENTAL_RECONCILIATION = True
+RECONCILIATION_STATE_FILE = "reconciliation_state.json"
+
+# --- 6. Batch Processing & Concurrency ---
+# How many invoices process_all_invoices() works on at the same time.
+MAX_CONCURRENT_INVOICES = 8
+# The maximum number of simultaneous calls to each external provider.
+# Lower these if you start hitting rate limits (HTTP 429 errors).
+PROVIDER_CONCURRENCY_LIMITS = {
+    "openai": 8,
+    "documentai": 4,
+    "sheets": 2,
+}
+
+# --- 7. Extraction Cache ---
+# Results from the AI agents are cached on disk, keyed by the file's contents,
+# so reprocessing an invoice we have already seen costs no API calls.
+EXTRACTION_CACHE_ENABLED = True
+EXTRACTION_CACHE_FILE = "extraction_cache.sqlite"
+# Cached results older than this are discarded.
+EXTRACTION_CACHE_MAX_AGE_DAYS = 180
+# When the cache grows beyond this many results, the least recently used are discarded.
+EXTRACTION_CACHE_MAX_ENTRIES = 20000
+
+# --- 8. Google Sheets Writing ---
+# New invoice rows are buffered and written to the sheet in a single request
+# once this many rows are waiting, or the oldest row has waited this long.
+SHEETS_FLUSH_MAX_ROWS = 50
+SHEETS_FLUSH_INTERVAL_SECONDS = 30
+
+# --- 9. Reconciliation Name-Score Cache ---
+# Fuzzy supplier/bank-description scores are remembered between runs, so the
+# same payee is never scored twice.
+NAME_SCORE_CACHE_ENABLED = True
+NAME_SCORE_CACHE_FILE = "name_scores.sqlite"
+# Scores not used for this long are discarded.
+NAME_SCORE_CACHE_MAX_AGE_DAYS = 365
+# When the cache grows beyond this many scores, the least recently used are discarded.
+NAME_SCORE_CACHE_MAX_ENTRIES = 200000
+
+# --- 10. PDF Rendering for the Vision Model ---
+# The resolution pages are rendered at (capped to what GPT-4o actually reads).
+PDF_RENDER_DPI = 150
+# The maximum number of pages sent per invoice (the first page plus the totals page(s)).
+PDF_MAX_PAGES_PER_INVOICE = 2
+# "jpeg" gives much smaller uploads than "png".
+PDF_IMAGE_FORMAT = "jpeg"
+PDF_JPEG_QUALITY = 80
+
+# --- 11. Text-Layer Fast Path ---
+# Most software-generated PDFs contain their text. When True, we try to read the
+# invoice straight from that text and only call GPT-4o if the numbers don't add up.
+TEXT_LAYER_FAST_PATH = True
+# When the text could not be fully parsed, send GPT-4o the text instead of page images
+# (much cheaper and faster). Set to False to always send images in that case.
+TEXT_LAYER_SEND_TEXT_ONLY = True
+
+# --- 12. Hedged Extraction (Web Uploads) ---
+# When True, invoices uploaded through the web app are also sent to the specialist
+# (Google Document AI) while GPT-4o is still working, and the first valid result
+# wins. This lowers the worst-case wait, at the cost of some extra API calls.
+HEDGED_EXTRACTION_FOR_UPLOADS = False
+# Start the specialist once GPT-4o takes longer than this percentile of its recent
+# response times. Set to 0 to send every invoice to both agents at once.
+HEDGE_LATENCY_PERCENTILE = 90
+# The wait used until enough response times have been measured.
+HEDGE_DEFAULT_DELAY_SECONDS = 8
+
+# --- 13. Folder Watcher (python watcher.py) ---
+# A new file is processed once its size has not changed for this many seconds.
+WATCHER_SETTLE_SECONDS = 2
+# Set to True to poll the folder instead of using file system events
+# (e.g. for network drives, where events are not always delivered).
+WATCHER_USE_POLLING = False
+WATCHER_POLL_INTERVAL_SECONDS = 5
+# Even with file system events, the folder is rescanned this often in case an event was missed.
+WATCHER_RESCAN_INTERVAL_SECONDS = 60
+
+# --- 14. Job Journal ---
+# Records the progress of every invoice file, so an interrupted run can be resumed
+# without new API calls or duplicate rows in the sheet.
+JOB_JOURNAL_FILE = "job_journal.sqlite"
+
+# --- 15. Rate Limits and Retries ---
+# How many calls per second may start for each provider. When a provider answers
+# "429 Too Many Requests", its rate is halved automatically and then slowly restored.
+PROVIDER_RATE_LIMITS = {"openai": 5, "documentai": 2, "sheets": 1}
+# Temporary errors (rate limits, server errors, timeouts) are retried this many times,
+# waiting a little longer (with random jitter) before each attempt.
+PROVIDER_MAX_RETRIES = 5
+RETRY_BASE_DELAY_SECONDS = 1
+RETRY_MAX_DELAY_SECONDS = 60
+# After this many failures in a row, calls to that provider pause for the cool-down (circuit breaker).
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN_SECONDS = 30
+
+# --- 16. Logging and Metrics ---
+# "DEBUG" also shows per-page and per-field details; "WARNING" only shows problems.
+LOG_LEVEL = "INFO"
+# Per-stage timings (render, LLM call, sheet write, reconciliation phases...) and
+# token/byte counters. Set to False to switch all measurements off.
+METRICS_ENABLED = True
+# Where to export the metrics after each run: a ".prom" file uses the Prometheus text
+# format, anything else JSON. Set to "" to disable the export.
+METRICS_EXPORT_FILE = "metrics.json"
+
+# --- 17. Batched Extraction (Backfills) ---
+# With "python main.py --batched", several invoices share one GPT-4o request, so the long
+# prompt is sent once per request instead of once per invoice.
+BATCH_INVOICES_PER_REQUEST = 5
+# Files are read and pre-extracted in chunks of this size while earlier chunks are processed.
+BATCH_CHUNK_FILES = 200
+# With "python main.py --batch-api" the requests go through OpenAI's Batch API (half the
+# price, results within 24 hours). How often to check for results, and for how long at most.
+BATCH_API_POLL_INTERVAL_SECONDS = 60
+BATCH_API_MAX_WAIT_HOURS = 24
+
+# --- 18. Image Preprocessing ---
+# Invoice photos (.jpg, .png...) are shrunk before they are sent to GPT-4o: grayscale,
+# straightened, cropped to the paper and scaled down to this long side, as a JPEG.
+# Set to False to send photos exactly as they are.
+IMAGE_PREPROCESSING_ENABLED = True
+IMAGE_MAX_LONG_SIDE = 2048
+IMAGE_JPEG_QUALITY = 80
+# Straighten photos taken at an angle of up to this many degrees.
+IMAGE_DESKEW = True
+IMAGE_MAX_DESKEW_DEGREES = 5
+# Cut away the margins around the paper, keeping this much padding.
+IMAGE_AUTO_CROP = True
+IMAGE_CROP_PADDING_PIXELS = 20
+
+# --- 19. Supplier Directory ---
+# Every verified invoice adds its supplier (keyed by NIF/CIF) to a local directory:
+# the canonical name, other spellings and the bank descriptions of matched payments.
+# Known suppliers skip the identification part of the GPT-4o prompt, always get the
+# same name in the sheet, and their payments are matched without fuzzy scoring.
+SUPPLIER_DIRECTORY_ENABLED = True
+SUPPLIER_DIRECTORY_FILE = "supplier_directory.sqlite"
+
+# --- 20. PDF Rendering in Separate Processes ---
+# PDF pages are rendered in a pool of separate processes, so every CPU core draws
+# pages at the same time (in threads, only one page is rendered at a time).
+# Set to False to render in the worker threads instead.
+RENDER_IN_SEPARATE_PROCESSES = True
+# How many render processes to start (0 = one per CPU core).
+RENDER_PROCESSES = 0
+# At most this many scanned PDFs are rendered ahead of the workers that will send them.
+RENDER_AHEAD_LIMIT = 16
+
+# --- 21. Local Ledger Store ---
+# Invoices and bank payments are kept in a local, typed ledger (SQLite). Extraction and
+# reconciliation read and write it at local-disk speed, even when the Google Sheets quota
+# has run out; both sheets are kept as a mirror by a background sync, which appends new
+# rows, copies reconciliation's changes and brings in rows added to the sheets by hand.
+# Off by default: when switched on, the first sync reads both sheets in full into the new
+# ledger file, and from then on the ledger is where invoices and matches are written first
+# (see "Upgrading" in the README). When off, the sheets are read and written directly (see
+# INCREMENTAL_RECONCILIATION).
+LEDGER_STORE_ENABLED = False
+LEDGER_STORE_FILE = "ledger.sqlite"
+LEDGER_SYNC_INTERVAL_SECONDS = 30
+
+# --- 22. Bank Statement Import ---
+# 'python bank_importer.py FILE...' (or Step 2 of the web app) loads bank statements
+# (CSV, XLSX or Norma 43) into the bank payments. Movements that are already loaded
+# are skipped; new ones are written in batches of this many rows.
+BANK_IMPORT_BATCH_ROWS = 1000
+# Set to True to load money paid into the account too (as negative payments).
+BANK_IMPORT_INCLUDE_CREDITS = False
+
+# --- 23. Split and Combined Payments ---
+# After the one-to-one matching, reconciliation looks for invoices paid in instalments
+# and for single payments covering several invoices of the same supplier, whose amounts
+# add up to the cent. These are marked with a match score of 70.
+GROUP_MATCHING_ENABLED = True
+# The payments of a group can be dated up to this many days after each of its invoices.
+GROUP_MATCH_WINDOW_DAYS = 60
+# At most this many invoices (or payments) in one group.
+GROUP_MATCH_MAX_ITEMS = 4
+# Each search looks at most at this many invoices (or payments), the closest in date.
+GROUP_MATCH_MAX_CANDIDATES = 20
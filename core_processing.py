@@ -1,67 +1,276 @@
 import json
-import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+import config
+import extractor
+import google_ai_connector
+import job_journal
+import supplier_directory
 from extractor import extract_invoice_data
 from helpers import verify_and_calculate_tax, clean_invoice_data
+from invoice_model import parse_amount
 from sheets_connector import append_to_sheet
-from google_ai_connector import analyze_invoice_with_google
+from google_ai_connector import analyze_invoice_with_google, mime_type_for
+from extraction_cache import compute_file_hash, get_cached_result, store_result
+from instrumentation import logger, timed, count, invoice_context, bind_to_invoice
 
+# --- HEDGED EXTRACTION STATE ---
+# Recent primary agent latencies (in seconds), used to decide when to start the specialist.
+_primary_latencies = deque(maxlen=200)
+# How often each agent provided the result in hedged mode.
+_hedge_stats = {"primary_wins": 0, "specialist_wins": 0, "no_valid_result": 0, "specialist_started": 0}
+_hedge_lock = threading.Lock()
+# Each hedged invoice can keep two agents busy at once.
+_hedge_executor = ThreadPoolExecutor(max_workers=2 * config.MAX_CONCURRENT_INVOICES, thread_name_prefix="hedged-extraction")
+# Below this many samples, config.HEDGE_DEFAULT_DELAY_SECONDS is used instead of the percentile.
+MIN_LATENCY_SAMPLES = 20
 
-def process_single_invoice(file_content, file_name):
+# Extracted data in the job journal is only reused if it came from these agents (and prompt).
+JOURNAL_VERSION = f"{extractor.AGENT_VERSION}+{google_ai_connector.AGENT_VERSION}"
+
+# --- BATCHED EXTRACTION STATE ---
+# Primary agent results from batched requests (file hash -> raw data dictionary),
+# waiting for their invoice to be processed.
+_prefetched_results = {}
+_prefetch_lock = threading.Lock()
+
+
+def _has_valid_total(raw_data_dict):
+    """The critical field check: the data must contain a total greater than zero (in any common format)."""
+    if not raw_data_dict:
+        return False
+    total = parse_amount(raw_data_dict.get('total'))
+    return total is not None and total > 0
+
+
+def _parse_primary_result(extracted_data_json, file_name):
     """
-    The core logic for processing one invoice file from memory,
-    including the fallback to the specialist agent.
-    Returns True if successful, False otherwise.
+    Turns the primary agent's JSON text into a dictionary, or None if there is
+    no valid JSON object in it. Fields the agent returned as null are left out.
     """
-    # --- STEP 1: Primary Attempt with our GPT-4o agent ---
-    extracted_data_json = extract_invoice_data(file_content, file_name)
-    raw_data_dict = None
-
-    if extracted_data_json:
+    if not extracted_data_json:
+        return None
+    try:
+        # Structured output is plain JSON; anything else (e.g. wrapped in Markdown) is cut out of the text.
+        data = json.loads(extracted_data_json)
+    except json.JSONDecodeError:
+        start_index = extracted_data_json.find('{')
+        end_index = extracted_data_json.rfind('}') + 1
         try:
-            start_index = extracted_data_json.find('{')
-            end_index = extracted_data_json.rfind('}') + 1
-            if start_index != -1 and end_index != 0:
-                clean_json_string = extracted_data_json[start_index:end_index]
-                raw_data_dict = json.loads(clean_json_string)
+            data = json.loads(extracted_data_json[start_index:end_index]) if start_index != -1 and end_index != 0 else None
         except json.JSONDecodeError:
-            print(f"  --> Primary agent returned malformed JSON for {file_name}.")
+            data = None
+    if not isinstance(data, dict):
+        logger.warning("  --> Primary agent returned malformed JSON for %s.", file_name)
+        return None
+    return {field: value for field, value in data.items() if value is not None}
+
+
+def _run_primary_agent(file_content, file_name, file_hash, use_cache):
+    """
+    Gets the primary (GPT-4o) agent's result as a dictionary: from a batched
+    request made beforehand (see prefetch_primary_results), from the cache, or
+    with a request of its own.
+    """
+    with _prefetch_lock:
+        raw_data_dict = _prefetched_results.pop(file_hash, None)
+    if raw_data_dict is not None:
+        return raw_data_dict
+
+    if use_cache:
+        raw_data_dict = get_cached_result(file_hash, "primary", extractor.AGENT_VERSION)
+        if raw_data_dict is not None:
+            logger.debug("  --> Using cached primary agent result for %s.", file_name)
+            return raw_data_dict
+
+    started_at = time.monotonic()
+    with timed("primary_agent"):
+        extracted_data_json = extract_invoice_data(file_content, file_name)
+    raw_data_dict = _parse_primary_result(extracted_data_json, file_name)
+    if raw_data_dict is not None:
+        store_result(file_hash, "primary", extractor.AGENT_VERSION, raw_data_dict)
+
+    with _hedge_lock:
+        _primary_latencies.append(time.monotonic() - started_at)
+    return raw_data_dict
+
+
+def _run_specialist_agent(file_content, file_name, file_hash, use_cache):
+    """Gets the specialist (Google Document AI) agent's result as a dictionary, from the cache if possible."""
+    if use_cache:
+        raw_data_dict = get_cached_result(file_hash, "specialist", google_ai_connector.AGENT_VERSION)
+        if raw_data_dict is not None:
+            logger.debug("  --> Using cached specialist result for %s.", file_name)
+            return raw_data_dict
+
+    # The specialist takes the in-memory content directly, so no temporary file is needed.
+    with timed("specialist_call"):
+        raw_data_dict = analyze_invoice_with_google(file_content, mime_type_for(file_name))
+
+    if raw_data_dict:
+        store_result(file_hash, "specialist", google_ai_connector.AGENT_VERSION, raw_data_dict)
+    return raw_data_dict
+
+
+def _hedge_delay_seconds():
+    """
+    How long to wait for the primary agent before also starting the specialist:
+    the configured percentile of recent primary latencies (0 means start both at once).
+    """
+    if not config.HEDGE_LATENCY_PERCENTILE:
+        return 0
+    with _hedge_lock:
+        latencies = sorted(_primary_latencies)
+    if len(latencies) < MIN_LATENCY_SAMPLES:
+        return config.HEDGE_DEFAULT_DELAY_SECONDS
+    index = min(len(latencies) - 1, int(len(latencies) * config.HEDGE_LATENCY_PERCENTILE / 100))
+    return latencies[index]
+
+
+def _record_hedge_outcome(outcome):
+    with _hedge_lock:
+        _hedge_stats[outcome] += 1
+
+
+def get_hedge_stats():
+    """Returns how often each agent won in hedged mode (a copy of the counters)."""
+    with _hedge_lock:
+        return dict(_hedge_stats)
+
+
+def _extract_hedged(file_content, file_name, file_hash, use_cache):
+    """
+    Runs the primary agent and, once it is slower than usual (or immediately,
+    see config.HEDGE_LATENCY_PERCENTILE), the specialist too. Returns the first
+    result that passes the critical field check; the other result is discarded.
+    """
+    primary_future = _hedge_executor.submit(bind_to_invoice(_run_primary_agent), file_content, file_name, file_hash, use_cache)
+    done, _ = wait([primary_future], timeout=_hedge_delay_seconds())
+    if done and _has_valid_total(primary_future.result()):
+        _record_hedge_outcome("primary_wins")
+        return primary_future.result()
+
+    logger.info("  --> Hedging: starting the specialist for %s.", file_name)
+    _record_hedge_outcome("specialist_started")
+    specialist_future = _hedge_executor.submit(bind_to_invoice(_run_specialist_agent), file_content, file_name, file_hash, use_cache)
+    pending = {primary_future, specialist_future}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and _has_valid_total(future.result()):
+                _record_hedge_outcome("primary_wins" if future is primary_future else "specialist_wins")
+                for other_future in pending:
+                    # Not started yet? Then it never will be. Otherwise its result is simply ignored.
+                    other_future.cancel()
+                return future.result()
+
+    _record_hedge_outcome("no_valid_result")
+    # Like the sequential path, fall back to whatever the specialist returned.
+    return specialist_future.result() if specialist_future.exception() is None else None
+
+
+def prefetch_primary_results(invoices, use_batch_api=False, use_cache=True):
+    """
+    Runs the primary agent for many invoices at once, with several invoices per
+    request (or through OpenAI's Batch API), ahead of process_single_invoice().
+    'invoices' is a list of (file_content, file_name) tuples. The results are
+    kept until each invoice is processed; an invoice without a valid result
+    (a failed request, or a reply that left it out) simply gets its own
+    request then. Returns the number of invoices with a result.
+    """
+    batch = {}
+    for file_content, file_name in invoices:
+        file_hash = compute_file_hash(file_content)
+        if use_cache and get_cached_result(file_hash, "primary", extractor.AGENT_VERSION) is not None:
+            continue
+        batch.setdefault(file_hash, (file_hash, file_content, file_name))
+    if not batch:
+        return 0
+
+    extract = extractor.extract_invoices_data_with_batch_api if use_batch_api else extractor.extract_invoices_data_batched
+    prefetched = 0
+    for file_hash, extracted_data_json in extract(list(batch.values())).items():
+        raw_data_dict = _parse_primary_result(extracted_data_json, batch[file_hash][2])
+        if not _has_valid_total(raw_data_dict):
+            continue
+        store_result(file_hash, "primary", extractor.AGENT_VERSION, raw_data_dict)
+        with _prefetch_lock:
+            _prefetched_results[file_hash] = raw_data_dict
+        prefetched += 1
+    logger.info("  --> Batched extraction: %d of %d invoice(s) extracted; the rest get their own request.",
+                prefetched, len(batch))
+    return prefetched
+
+
+def _extract_raw_data(file_content, file_name, file_hash, use_cache, hedged):
+    """Runs the AI agents (steps 1-3) and returns the raw data dictionary, or None."""
+    if hedged:
+        return _extract_hedged(file_content, file_name, file_hash, use_cache)
+
+    # --- STEP 1: Primary Attempt with our GPT-4o agent ---
+    raw_data_dict = _run_primary_agent(file_content, file_name, file_hash, use_cache)
 
     # --- STEP 2: Critical Field Check ---
-    if not raw_data_dict or float(raw_data_dict.get('total', '0').replace(',', '.')) <= 0:
-        print(f"  --> Primary agent failed. Falling back to specialist for {file_name}.")
+    if not _has_valid_total(raw_data_dict):
+        logger.info("  --> Primary agent failed. Falling back to specialist for %s.", file_name)
 
         # --- STEP 3: Fallback to Specialist ---
-        file_extension = os.path.splitext(file_name)[1].lower()
-        mime_type = "application/pdf"
-        if file_extension in [".jpg", ".jpeg"]:
-            mime_type = "image/jpeg"
-        elif file_extension == ".png":
-            mime_type = "image/png"
+        raw_data_dict = _run_specialist_agent(file_content, file_name, file_hash, use_cache)
+    return raw_data_dict
 
-        # The specialist needs a file path, so we must temporarily save the in-memory content.
-        temp_file_path = os.path.join("temp_" + file_name)
-        with open(temp_file_path, "wb") as f:
-            f.write(file_content)
 
-        # Call the specialist with the path to the temporary file
-        raw_data_dict = analyze_invoice_with_google(temp_file_path, mime_type)
+def process_single_invoice(file_content, file_name, use_cache=True, hedged=False):
+    """
+    The core logic for processing one invoice file from memory,
+    including the fallback to the specialist agent.
+    Results from both agents are cached by file hash; pass use_cache=False
+    to force fresh API calls.
+    With hedged=True the specialist is started while the primary agent is still
+    running (see _extract_hedged), which lowers the worst-case latency.
+    Every step is recorded in the job journal: a file that was already extracted
+    by an earlier (interrupted) run with the same agents is not sent to them
+    again (unless use_cache=False), and its
+    row is not appended again if it already reached the sheet.
+    Returns the cleaned data dictionary if successful, None otherwise.
+    """
+    with invoice_context(file_name), timed("invoice"):
+        return _process_invoice(file_content, file_name, use_cache, hedged)
 
-        # Clean up the temporary file immediately
-        os.remove(temp_file_path)
 
-    # --- STEP 4: Final Processing ---
-    if raw_data_dict:
-        print(f"Data for processing for {file_name}: {raw_data_dict}")
-        verified_data_dict = verify_and_calculate_tax(raw_data_dict)
-        clean_data_dict = clean_invoice_data(verified_data_dict, file_name)
+def _process_invoice(file_content, file_name, use_cache, hedged):
+    file_hash = compute_file_hash(file_content)
+    job = job_journal.start_job(file_hash, file_name, JOURNAL_VERSION)
 
-        if append_to_sheet(clean_data_dict):
-            print(f"  --> Successfully processed and saved {file_name} to Google Sheets.")
-            return clean_data_dict  # <-- SUCCESS: Return the dictionary
-        else:
-            print(f"  --> Failed to write {file_name} to Google Sheets.")
+    if use_cache and job["data"]:
+        logger.info("  --> Resuming %s from the job journal (state: %s).", file_name, job['state'])
+        clean_data_dict = dict(job["data"], filename=file_name)
+    else:
+        raw_data_dict = _extract_raw_data(file_content, file_name, file_hash, use_cache, hedged)
+        if not raw_data_dict:
+            logger.warning("  --> Both agents failed to extract data for %s.", file_name)
+            job_journal.mark_failed(file_hash, "No data extracted")
+            count("invoices", outcome="failed")
             return None  # <-- FAILURE: Return None
+
+        # --- STEP 4: Final Processing ---
+        logger.debug("Data for processing for %s: %s", file_name, raw_data_dict)
+        with timed("verify_tax"):
+            verified_data_dict = verify_and_calculate_tax(raw_data_dict)
+        if not verified_data_dict['tax'].startswith("ERROR"):
+            # Only invoices whose numbers add up teach the supplier directory.
+            supplier_directory.record_invoice(verified_data_dict)
+        clean_data_dict = clean_invoice_data(verified_data_dict, file_name)
+        job_journal.mark_extracted(file_hash, clean_data_dict, JOURNAL_VERSION)
+
+    idempotency_key = job_journal.make_idempotency_key(file_hash, clean_data_dict.get('invoice_id'))
+    if append_to_sheet(clean_data_dict, idempotency_key):
+        logger.info("  --> Successfully processed %s and queued it for Google Sheets.", file_name)
+        count("invoices", outcome="success")
+        return clean_data_dict  # <-- SUCCESS: Return the dictionary
     else:
-        print(f"  --> Both agents failed to extract data for {file_name}.")
+        logger.warning("  --> Failed to write %s to Google Sheets.", file_name)
+        count("invoices", outcome="failed")
         return None  # <-- FAILURE: Return None
@@ -2,50 +2,143 @@
 
 import os
 import pandas as pd
-import gspread
 import config
+import ledger_store
 import shutil
-from thefuzz import fuzz
+from instrumentation import logger, PhaseTimer
+from matching_engine import find_matches, find_group_matches, PRIMARY_MATCH_SCORE
+from name_scoring import create_name_scorer, normalize_name
+from provider_limits import call_provider
+from supplier_directory import load_name_index, learn_bank_aliases
+from reconciliation_state import load_state, save_state, fetch_sheet_rows, build_sheet_state
+from sheets_connector import get_sheets_session, flush_sheet, sync_ledger, start_ledger_sync
 
-# --- SCORING LOGIC ---
-# These variables define the score to assign upon a successful match.
-# They are part of the core logic, so they live here, not in the config file.
-PRIMARY_MATCH_SCORE = 100
-SECONDARY_MATCH_SCORE = 85
+# The matching itself (including the match scores) lives in matching_engine.py.
 
 
-# --------------------
+# Columns used to recognise a remembered row when reconciling incrementally.
+INVOICE_KEY_COLUMNS = ['Invoice Number', 'Total Amount', 'Filename']
+BANK_KEY_COLUMNS = ['Date', 'Amount', 'Description']
 
-def reconcile_sheets():
+
+def _rows_to_dataframe(header, rows):
+    """Builds a DataFrame from (sheet_row_number, values) pairs, keeping the row number in 'gspread_row'."""
+    df = pd.DataFrame([values for _, values in rows], columns=header)
+    df['gspread_row'] = [row_number for row_number, _ in rows]
+    return df
+
+
+def _match(unpaid_invoices, available_payments):
+    """
+    Runs the matching engine over the unpaid invoices and available payments
+    (DataFrames with the sheets' column names) and teaches the supplier
+    directory the bank descriptions of known suppliers' payments.
+    Returns (matches, group_matches): find_matches()'s list of (invoice_label,
+    payment_label, match_score), and find_group_matches()'s list of split and
+    combined payments over what is left.
+    """
+    logger.info("Matching %d unpaid invoice(s) against %d available payment(s)...",
+                len(unpaid_invoices), len(available_payments))
+    name_scorer = create_name_scorer()
+    suppliers = load_name_index()
+    matches = find_matches(unpaid_invoices, available_payments,
+                           config.PAYMENT_DATE_TOLERANCE_DAYS,
+                           config.PRIMARY_MATCH_THRESHOLD,
+                           config.SECONDARY_MATCH_THRESHOLD,
+                           scorer=name_scorer, suppliers=suppliers)
+    group_matches = []
+    if config.GROUP_MATCHING_ENABLED:
+        group_matches = find_group_matches(
+            unpaid_invoices.drop(index=[invoice_label for invoice_label, _, _ in matches]),
+            available_payments.drop(index=[payment_label for _, payment_label, _ in matches]),
+            config.PAYMENT_DATE_TOLERANCE_DAYS,
+            config.GROUP_MATCH_WINDOW_DAYS,
+            config.PRIMARY_MATCH_THRESHOLD,
+            config.SECONDARY_MATCH_THRESHOLD,
+            config.GROUP_MATCH_MAX_ITEMS,
+            config.GROUP_MATCH_MAX_CANDIDATES,
+            scorer=name_scorer, suppliers=suppliers)
+    name_scorer.save()
+    logger.info(name_scorer.summary())
+    # Remember how known suppliers' payments are described, so next time they match without scoring.
+    # Only descriptions that passed the primary name check count ("PAGO TARJETA" names no supplier).
+    matched_descriptions = []
+    for invoice_label, payment_label, match_score in matches:
+        supplier = suppliers.get(normalize_name(str(unpaid_invoices.at[invoice_label, 'Supplier Name'])))
+        if supplier and match_score == PRIMARY_MATCH_SCORE:
+            matched_descriptions.append((supplier, available_payments.at[payment_label, 'Description']))
+    new_aliases = learn_bank_aliases(matched_descriptions)
+    logger.debug("Learned %d new bank alias(es) for known suppliers.", new_aliases)
+    return matches, group_matches
+
+
+def _log_group_match(invoices, payments, match_score):
+    """Logs a split or combined payment (DataFrames of its invoices and payments)."""
+    logger.info("  ✅ MATCH (%s): Invoice(s) %s (%s) -> %d payment(s) on %s '%s'", match_score,
+                ", ".join(invoices['Invoice Number'].astype(str)), invoices['Supplier Name'].iloc[0], len(payments),
+                ", ".join(payments['Date'].dt.strftime('%d-%m-%Y')), "', '".join(payments['Description'].astype(str)))
+
+
+def _move_to_reconciled(filename_to_move):
+    """Moves a reconciled invoice file from the archive to the reconciled folder (if it is there)."""
+    source_path = str(os.path.join(config.ARCHIVE_FOLDER, filename_to_move))
+    destination_path = str(os.path.join(config.RECONCILED_FOLDER, filename_to_move))
+    if os.path.exists(source_path):
+        logger.info("  --> Reconciled. Moving '%s' to reconciled folder.", filename_to_move)
+        shutil.move(source_path, destination_path)
+
+
+def reconcile_sheets(incremental=None):
     """
     Reads data, finds matches, updates sheets, and moves reconciled files.
+
+    With the ledger store (config.LEDGER_STORE_ENABLED), the invoices and
+    payments are read from and updated in the local ledger, and the sheets are
+    brought up to date by the ledger sync; see _reconcile_ledger().
+
+    Otherwise, in incremental mode (default: config.INCREMENTAL_RECONCILIATION)
+    only the rows that were still unmatched after the last run, plus any rows
+    appended since, are fetched from the sheets. The returned DataFrame holds
+    the fetched invoice rows with this run's updates applied.
     """
+    if incremental is None:
+        incremental = config.INCREMENTAL_RECONCILIATION
+
     os.makedirs(config.RECONCILED_FOLDER, exist_ok=True)
-    print(f"Reconciled files will be moved to: {config.RECONCILED_FOLDER}")
+    logger.info("Reconciled files will be moved to: %s", config.RECONCILED_FOLDER)
+    timer = PhaseTimer("reconcile_")
+    if config.LEDGER_STORE_ENABLED:
+        return _reconcile_ledger(incremental, timer)
     try:
         # --- 1. CONNECT AND FETCH DATA ---
-        print("Connecting to Google Sheets...")
-        gc = gspread.service_account(filename=config.CREDENTIALS_FILE)
+        # Make sure every invoice still buffered for the sheet is included.
+        flush_sheet()
+        gc = get_sheets_session().get_client()
         invoice_sheet = gc.open(config.INVOICE_SHEET_NAME).sheet1
         bank_sheet = gc.open(config.BANK_SHEET_NAME).sheet1
 
-        invoice_data = invoice_sheet.get_all_values()
-        bank_data = bank_sheet.get_all_values()
-
-        invoices_df = pd.DataFrame(invoice_data[1:], columns=invoice_data[0])
-        bank_df = pd.DataFrame(bank_data[1:], columns=bank_data[0])
+        state = load_state() if incremental else {}
+        invoice_header, invoice_rows, invoices_incremental = fetch_sheet_rows(
+            invoice_sheet, state.get("invoices"), INVOICE_KEY_COLUMNS)
+        bank_header, bank_rows, bank_incremental = fetch_sheet_rows(
+            bank_sheet, state.get("payments"), BANK_KEY_COLUMNS)
 
-        invoices_df['gspread_row'] = invoices_df.index + 2
-        bank_df['gspread_row'] = bank_df.index + 2
-        print(f"Found {len(invoices_df)} invoices and {len(bank_df)} bank payments.")
+        invoices_df = _rows_to_dataframe(invoice_header, invoice_rows)
+        bank_df = _rows_to_dataframe(bank_header, bank_rows)
+        # Keep the rows as they are in the sheet, to build the final report from.
+        report_df = invoices_df.copy()
+        unpaid_rows = set(invoices_df.loc[invoices_df['Paid On'] == '', 'gspread_row'])
+        unmatched_payment_rows = set(bank_df.loc[bank_df['Matched Invoice ID'] == '', 'gspread_row'])
+        logger.info("Found %d invoices and %d bank payments.", len(invoices_df), len(bank_df))
+        timer.lap("fetch")
 
         # --- 2. PREPARE DATA ---
-        print("Cleaning and standardizing data types...")
+        logger.debug("Cleaning and standardizing data types...")
         invoices_df['Invoice Date'] = pd.to_datetime(invoices_df['Invoice Date'], dayfirst=True, errors='coerce')
         bank_df['Date'] = pd.to_datetime(bank_df['Date'], dayfirst=True, errors='coerce')
         invoices_df.dropna(subset=['Invoice Date'], inplace=True)
         bank_df.dropna(subset=['Date'], inplace=True)
-        print("Date columns successfully converted.")
+        logger.debug("Date columns successfully converted.")
 
         for col in ['Total Amount', 'Tax']:
             if col in invoices_df.columns:
@@ -61,100 +154,177 @@ def reconcile_sheets():
         bank_df.dropna(subset=['Amount'], inplace=True)
         invoices_df['Total Amount'] = invoices_df['Total Amount'].astype(float)
         bank_df['Amount'] = bank_df['Amount'].astype(float)
-        print("Data cleaning complete.")
+        logger.debug("Data cleaning complete.")
+        timer.lap("clean")
 
         # --- 3. THE ADVANCED MATCHING LOGIC ---
-        print("\n--- Starting Advanced Reconciliation ---")
+        logger.info("\n--- Starting Advanced Reconciliation ---")
         invoice_updates = []
         bank_updates = []
         unpaid_invoices = invoices_df[invoices_df['Paid On'] == ''].copy()
         available_payments = bank_df[bank_df['Matched Invoice ID'] == ''].copy()
+        matches, group_matches = _match(unpaid_invoices, available_payments)
+        timer.lap("match")
+
+        for invoice_label, payment_label, match_score in matches:
+            invoice = unpaid_invoices.loc[invoice_label]
+            payment = available_payments.loc[payment_label]
+            payment_date_string = payment['Date'].strftime('%d-%m-%Y')
+            logger.info("  ✅ MATCH (%s): Invoice %s (%s) -> payment on %s '%s'", match_score,
+                        invoice['Invoice Number'], invoice['Supplier Name'], payment_date_string, payment['Description'])
+
+            invoice_updates.append({'range': f"F{invoice['gspread_row']}", 'values': [[payment_date_string]]})
+            invoice_updates.append({'range': f"H{invoice['gspread_row']}", 'values': [[str(match_score)]]})
+            bank_updates.append({'range': f"D{payment['gspread_row']}:E{payment['gspread_row']}",
+                                 'values': [[invoice['Invoice Number'], invoice['Filename']]]})
 
-        for index, invoice in unpaid_invoices.iterrows():
-            invoice_id_lower = invoice['Invoice Number'].lower()
-            supplier_name_lower = invoice['Supplier Name'].lower()
-            invoice_date = invoice['Invoice Date']
-            invoice_amount = invoice['Total Amount']
-            print(
-                f"\n--- Checking Invoice: {invoice_id_lower} ({supplier_name_lower}) | Date: {invoice_date.strftime('%d-%m-%Y')} | Amount: {invoice_amount} ---")
-
-            potential_payments = available_payments[available_payments['Amount'] == invoice_amount]
-            if potential_payments.empty:
-                print("  --> No payments found with matching amount.")
-                continue
-
-            print(f"  --> Found {len(potential_payments)} payment(s) with matching amount. Checking date and name...")
-            for _, payment in potential_payments.iterrows():
-                payment_date = payment['Date']
-                cutoff_date = invoice_date - pd.Timedelta(days=config.PAYMENT_DATE_TOLERANCE_DAYS)
-                is_date_valid = payment_date >= cutoff_date
-
-                print(f"    - Checking Payment on: {payment_date.strftime('%d-%m-%Y')}")
-                print(
-                    f"      - Is Payment Date ({payment_date.strftime('%d-%m-%Y')}) >= Cutoff Date ({cutoff_date.strftime('%d-%m-%Y')})? -> {is_date_valid}")
-
-                if not is_date_valid:
-                    print("      - Date is NOT valid. Skipping this payment.")
-                    continue
-
-                match_found = False
-                match_score = 0
-                description_lower = payment['Description'].lower()
-                primary_name_score = fuzz.token_set_ratio(supplier_name_lower, description_lower)
-
-                print(f"      - Comparing with '{payment['Description']}': Primary Score = {primary_name_score}")
-                if primary_name_score >= config.PRIMARY_MATCH_THRESHOLD:
-                    print(f"        ✅ PRIMARY MATCH: Score is valid.")
-                    match_found = True
-                    match_score = PRIMARY_MATCH_SCORE  # <-- Now uses the variable defined at the top
-                else:
-                    details1_lower = payment.get('Bank Details 1', '').lower()
-                    details2_lower = payment.get('Bank Details 2', '').lower()
-                    combined_details = description_lower + " " + details1_lower + " " + details2_lower
-                    secondary_name_score = fuzz.token_set_ratio(supplier_name_lower, combined_details)
-                    print(f"      - Comparing with combined details: Secondary Score = {secondary_name_score}")
-                    if secondary_name_score >= config.SECONDARY_MATCH_THRESHOLD:
-                        print(f"        ✅ SECONDARY MATCH: Score is valid.")
-                        match_found = True
-                        match_score = SECONDARY_MATCH_SCORE  # <-- Now uses the variable defined at the top
-
-                if match_found:
-                    payment_date_string = payment['Date'].strftime('%d-%m-%Y')
-                    invoice_updates.append({'range': f"F{invoice['gspread_row']}", 'values': [[payment_date_string]]})
-                    invoice_updates.append({'range': f"H{invoice['gspread_row']}", 'values': [[str(match_score)]]})
-                    bank_updates.append({'range': f"D{payment['gspread_row']}:E{payment['gspread_row']}",
-                                         'values': [[invoice['Invoice Number'], invoice['Filename']]]})
-
-                    available_payments.drop(payment.name, inplace=True)
-
-                    filename_to_move = invoice['Filename']
-                    source_path = str(os.path.join(config.ARCHIVE_FOLDER, filename_to_move))
-                    destination_path = str(os.path.join(config.RECONCILED_FOLDER, filename_to_move))
-                    if os.path.exists(source_path):
-                        print(f"  --> Reconciled. Moving '{filename_to_move}' to reconciled folder.")
-                        shutil.move(source_path, destination_path)
-
-                    break
+            _move_to_reconciled(invoice['Filename'])
+
+        # An invoice paid in instalments is paid on the date of its last payment.
+        group_paid_on = {}
+        for invoice_labels, payment_labels, match_score in group_matches:
+            invoices = unpaid_invoices.loc[invoice_labels]
+            payments = available_payments.loc[payment_labels]
+            _log_group_match(invoices, payments, match_score)
+            payment_date_string = payments['Date'].max().strftime('%d-%m-%Y')
+            for invoice_label, invoice in invoices.iterrows():
+                group_paid_on[invoice_label] = payment_date_string
+                invoice_updates.append({'range': f"F{invoice['gspread_row']}", 'values': [[payment_date_string]]})
+                invoice_updates.append({'range': f"H{invoice['gspread_row']}", 'values': [[str(match_score)]]})
+                _move_to_reconciled(invoice['Filename'])
+            matched_invoices = [ledger_store.GROUP_SEPARATOR.join(invoices[column].astype(str))
+                                for column in ('Invoice Number', 'Filename')]
+            for _, payment in payments.iterrows():
+                bank_updates.append({'range': f"D{payment['gspread_row']}:E{payment['gspread_row']}",
+                                     'values': [matched_invoices]})
+        timer.lap("apply")
 
         # --- 4. BATCH UPDATE THE SHEETS ---
         if invoice_updates:
-            print(f"\nUpdating {len(invoice_updates) // 2} rows in '{config.INVOICE_SHEET_NAME}'...")
-            invoice_sheet.batch_update(invoice_updates)
+            logger.info("\nUpdating %d rows in '%s'...", len(invoice_updates) // 2, config.INVOICE_SHEET_NAME)
+            call_provider("sheets", invoice_sheet.batch_update, invoice_updates)
         if bank_updates:
-            print(f"Updating {len(bank_updates)} rows in '{config.BANK_SHEET_NAME}'...")
-            bank_sheet.batch_update(bank_updates)
+            logger.info("Updating %d rows in '%s'...", len(bank_updates), config.BANK_SHEET_NAME)
+            call_provider("sheets", bank_sheet.batch_update, bank_updates)
+        timer.lap("sheet_update")
+
+        # --- 5. REMEMBER WHERE WE LEFT OFF ---
+        matched_invoice_rows = {int(unpaid_invoices.at[label, 'gspread_row']) for label, _, _ in matches}
+        matched_bank_rows = {int(available_payments.at[label, 'gspread_row']) for _, label, _ in matches}
+        for invoice_labels, payment_labels, _ in group_matches:
+            matched_invoice_rows.update(int(row) for row in unpaid_invoices.loc[invoice_labels, 'gspread_row'])
+            matched_bank_rows.update(int(row) for row in available_payments.loc[payment_labels, 'gspread_row'])
+        # Rows skipped during cleaning (e.g. an unreadable date) stay "unmatched", so they are re-checked next time.
+        save_state({
+            "invoices": build_sheet_state(invoice_header, invoice_rows, unpaid_rows - matched_invoice_rows,
+                                          INVOICE_KEY_COLUMNS, state.get("invoices") if invoices_incremental else None),
+            "payments": build_sheet_state(bank_header, bank_rows, unmatched_payment_rows - matched_bank_rows,
+                                          BANK_KEY_COLUMNS, state.get("payments") if bank_incremental else None),
+        })
+        timer.lap("save_state")
+
+        # --- 6. Return the final results ---
+        # Apply the updates we just made to our local copy instead of re-fetching the sheet.
+        for invoice_label, payment_label, match_score in matches:
+            report_df.at[invoice_label, 'Paid On'] = available_payments.at[payment_label, 'Date'].strftime('%d-%m-%Y')
+            if len(invoice_header) > 7:
+                report_df.at[invoice_label, invoice_header[7]] = str(match_score)
+        for invoice_labels, _, match_score in group_matches:
+            for invoice_label in invoice_labels:
+                report_df.at[invoice_label, 'Paid On'] = group_paid_on[invoice_label]
+                if len(invoice_header) > 7:
+                    report_df.at[invoice_label, invoice_header[7]] = str(match_score)
+        final_invoices_df = report_df.drop(columns=['gspread_row'])
+
+        logger.info("\n--- Reconciliation Complete! ---")
+        return final_invoices_df  # <-- SUCCESS: Return the updated dataframe
+
+    except Exception as e:
+        logger.error("An error occurred during reconciliation: %s", e)
+
+
+
+def _reconcile_ledger(incremental, timer):
+    """
+    reconcile_sheets() on the local ledger. The sheets are synced first, so
+    rows added there (e.g. a pasted bank statement) are included; if Google
+    Sheets cannot be reached, the ledger is reconciled as it is. The matches
+    are stored in the ledger and copied to the sheets by the background sync.
+    Returns every invoice, as the rows of the invoice sheet.
+    """
+    try:
+        # --- 1. BRING THE LEDGER UP TO DATE ---
+        if not sync_ledger(full=not incremental):
+            logger.warning("Could not sync with Google Sheets. Reconciling the local ledger as it is.")
+        timer.lap("sync")
+
+        # --- 2. READ THE UNPAID INVOICES AND AVAILABLE PAYMENTS ---
+        # The ledger's columns are typed already: no text cleaning is needed.
+        invoices = pd.DataFrame.from_records(ledger_store.fetch_invoices(unpaid_only=True),
+                                             columns=ledger_store.INVOICE_FIELDS, index="id")
+        payments = pd.DataFrame.from_records(ledger_store.fetch_payments(unmatched_only=True),
+                                             columns=ledger_store.PAYMENT_FIELDS, index="id")
+        invoices = invoices[invoices['invoice_date'].notna() & invoices['total'].notna()]
+        payments = payments[payments['payment_date'].notna() & payments['amount'].notna()]
+        unpaid_invoices = pd.DataFrame({
+            'Supplier Name': invoices['supplier'],
+            'Invoice Date': pd.to_datetime(invoices['invoice_date']),
+            'Invoice Number': invoices['invoice_number'],
+            'Total Amount': invoices['total'].astype(float),
+            'Filename': invoices['filename'],
+        }, index=invoices.index)
+        available_payments = pd.DataFrame({
+            'Date': pd.to_datetime(payments['payment_date']),
+            'Amount': payments['amount'].astype(float),
+            'Description': payments['description'],
+            'Bank Details 1': payments['details1'],
+            'Bank Details 2': payments['details2'],
+        }, index=payments.index)
+        logger.info("Found %d unpaid invoices and %d unmatched bank payments in the ledger.",
+                    len(unpaid_invoices), len(available_payments))
+        timer.lap("fetch")
+
+        # --- 3. THE ADVANCED MATCHING LOGIC ---
+        logger.info("\n--- Starting Advanced Reconciliation ---")
+        matches, group_matches = _match(unpaid_invoices, available_payments)
+        timer.lap("match")
+
+        # --- 4. STORE THE MATCHES ---
+        for invoice_id, payment_id, match_score in matches:
+            logger.info("  ✅ MATCH (%s): Invoice %s (%s) -> payment on %s '%s'", match_score,
+                        unpaid_invoices.at[invoice_id, 'Invoice Number'], unpaid_invoices.at[invoice_id, 'Supplier Name'],
+                        available_payments.at[payment_id, 'Date'].strftime('%d-%m-%Y'),
+                        available_payments.at[payment_id, 'Description'])
+            _move_to_reconciled(unpaid_invoices.at[invoice_id, 'Filename'])
+        ledger_store.record_matches([(invoice_id, payment_id, available_payments.at[payment_id, 'Date'].date(),
+                                      match_score) for invoice_id, payment_id, match_score in matches])
+        # An invoice paid in instalments is paid on the date of its last payment.
+        groups = []
+        for invoice_ids, payment_ids, match_score in group_matches:
+            _log_group_match(unpaid_invoices.loc[invoice_ids], available_payments.loc[payment_ids], match_score)
+            for invoice_id in invoice_ids:
+                _move_to_reconciled(unpaid_invoices.at[invoice_id, 'Filename'])
+            groups.append((invoice_ids, payment_ids, available_payments.loc[payment_ids, 'Date'].max().date(),
+                           match_score))
+        ledger_store.record_group_matches(groups)
+        # Copy the matches to the sheets in the background.
+        start_ledger_sync(now=True)
+        timer.lap("apply")
 
         # --- 5. Return the final results ---
-        # We need to re-fetch the data to see the updates we just made.
-        updated_invoice_data = invoice_sheet.get_all_records()
-        final_invoices_df = pd.DataFrame(updated_invoice_data)
+        final_invoices_df = pd.DataFrame(
+            [ledger_store.sheet_values(ledger_store.INVOICES, row) for row in ledger_store.fetch_invoices()],
+            columns=ledger_store.INVOICE_COLUMNS)
+        timer.lap("report")
 
-        print("\n--- Reconciliation Complete! ---")
-        return final_invoices_df  # <-- SUCCESS: Return the full, updated dataframe
+        logger.info("\n--- Reconciliation Complete! ---")
+        return final_invoices_df
 
     except Exception as e:
-        print(f"An error occurred during reconciliation: {e}")
+        logger.error("An error occurred during reconciliation: %s", e)
 
 
 if __name__ == "__main__":
-    reconcile_sheets()
\ No newline at end of file
+    reconcile_sheets()
+    # Make sure the matches reach the sheets before we exit.
+    flush_sheet()
\ No newline at end of file
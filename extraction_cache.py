@@ -0,0 +1,115 @@
+# extraction_cache.py
+# A persistent on-disk cache for the results of our AI agents.
+# Results are keyed by a SHA-256 of the file bytes plus the agent name and its
+# prompt/model version, so re-uploading or retrying the same invoice never pays
+# for the same extraction twice.
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import config
+
+# How many writes happen between two eviction passes.
+EVICTION_INTERVAL_WRITES = 100
+
+_connection = None
+_lock = threading.Lock()
+_writes_since_eviction = 0
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+
+def compute_file_hash(file_content):
+    """Returns the SHA-256 hex digest of the file's bytes."""
+    return hashlib.sha256(file_content).hexdigest()
+
+
+def _get_connection():
+    """Opens the cache database on first use (caller must hold the lock)."""
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(config.EXTRACTION_CACHE_FILE, check_same_thread=False)
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS extraction_cache (
+                file_hash TEXT NOT NULL,
+                agent TEXT NOT NULL,
+                agent_version TEXT NOT NULL,
+                data_json TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                PRIMARY KEY (file_hash, agent, agent_version)
+            )
+        """)
+        _connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_cache_last_used ON extraction_cache (last_used_at)")
+        _connection.commit()
+        _evict_old_entries()
+    return _connection
+
+
+def _evict_old_entries():
+    """Removes entries older than the max age, then trims the cache to the max size (caller must hold the lock)."""
+    cutoff = time.time() - config.EXTRACTION_CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+    deleted = _connection.execute("DELETE FROM extraction_cache WHERE created_at < ?", (cutoff,)).rowcount
+    # Least recently used entries go first when the cache is over its size limit.
+    deleted += _connection.execute("""
+        DELETE FROM extraction_cache WHERE rowid IN (
+            SELECT rowid FROM extraction_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+        )
+    """, (config.EXTRACTION_CACHE_MAX_ENTRIES,)).rowcount
+    _connection.commit()
+    _stats["evictions"] += deleted
+
+
+def get_cached_result(file_hash, agent, agent_version):
+    """
+    Looks up a previously stored result for this file and agent version.
+    Returns the stored dictionary, or None on a cache miss.
+    """
+    if not config.EXTRACTION_CACHE_ENABLED:
+        return None
+
+    with _lock:
+        connection = _get_connection()
+        row = connection.execute(
+            "SELECT data_json FROM extraction_cache WHERE file_hash = ? AND agent = ? AND agent_version = ?",
+            (file_hash, agent, agent_version)).fetchone()
+        if row is None:
+            _stats["misses"] += 1
+            return None
+
+        connection.execute(
+            "UPDATE extraction_cache SET last_used_at = ? WHERE file_hash = ? AND agent = ? AND agent_version = ?",
+            (time.time(), file_hash, agent, agent_version))
+        connection.commit()
+        _stats["hits"] += 1
+        return json.loads(row[0])
+
+
+def store_result(file_hash, agent, agent_version, data_dict):
+    """Saves an agent's parsed result dictionary in the cache."""
+    global _writes_since_eviction
+    if not config.EXTRACTION_CACHE_ENABLED:
+        return
+
+    with _lock:
+        connection = _get_connection()
+        now = time.time()
+        connection.execute(
+            "INSERT OR REPLACE INTO extraction_cache VALUES (?, ?, ?, ?, ?, ?)",
+            (file_hash, agent, agent_version, json.dumps(data_dict), now, now))
+        connection.commit()
+        _stats["stores"] += 1
+
+        _writes_since_eviction += 1
+        if _writes_since_eviction >= EVICTION_INTERVAL_WRITES:
+            _writes_since_eviction = 0
+            _evict_old_entries()
+
+
+def get_cache_stats():
+    """Returns a copy of the hit/miss/store/eviction counters for this process."""
+    with _lock:
+        return dict(_stats)
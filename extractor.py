@@ -1,135 +1,606 @@
 import os
 import base64
-import fitz  # This is the PyMuPDF library
+import itertools
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
 import config
+import providers
+import render_pool
+import supplier_directory
+
+from instrumentation import logger, timed, count
+from invoice_model import INVOICE_JSON_SCHEMA, BATCHED_INVOICES_JSON_SCHEMA
+from provider_limits import call_provider
+from image_preprocessor import prepare_image
+from text_layer_parser import extract_text_lines, parse_invoice_lines, is_complete_and_verified, lines_to_text
+from providers import lazy_import
+
+# The openai library is only imported (and the client only created) when the first request is sent.
+openai = lazy_import("openai")
+
+# The model we send invoices to.
+MODEL_NAME = "gpt-4o"
+# Bump this whenever the prompt below changes, so cached results from the old prompt are not reused.
+PROMPT_VERSION = 5
+# Identifies this agent's results in the extraction cache.
+AGENT_VERSION = f"{MODEL_NAME}-prompt-v{PROMPT_VERSION}-{config.MY_COMPANY_CIF}"
+
+# In a batched request, each invoice starts with this line.
+BATCH_INVOICE_MARKER = "Invoice {key}:"
+# A batched request never holds more page images than this.
+MAX_IMAGES_PER_BATCHED_REQUEST = 10
+# The Batch API accepts input files up to 200 MB; we stay a little below.
+MAX_BATCH_FILE_BYTES = 190 * 1024 * 1024
+
+
+def _create_client():
+    """Creates the OpenAI client, with the API key from the environment (or a .env file)."""
+    from dotenv import load_dotenv
+    # This line looks for a .env file and makes the variables inside it available to our script.
+    load_dotenv()
+    # Retries are handled by provider_limits.call_provider, so the client itself does not retry.
+    return openai.OpenAI(max_retries=0)
+
+
+providers.register_provider("openai", _create_client)
+
+
+def get_client():
+    """Returns the shared OpenAI client, creating it on first use."""
+    return providers.get_client("openai")
+
+
+def use_client(new_client):
+    """
+    Replaces the OpenAI client, e.g. with a FakeOpenAIClient for tests and
+    benchmarks. Returns the previous client.
+    """
+    return providers.use_client("openai", new_client)
+
+
+def _supplier_identification_task():
+    """Task 1 of the prompt: the rules for telling the supplier from the client (us)."""
+    return f"""
+    **Task 1: Supplier Identification**
+
+    Your first and most critical task is to identify the **Supplier** of the invoice. To do this, you must first find the two entities on the document (Supplier and Client) and distinguish between them using the following strict rules:
+
+    1.  **Rule 1: Identify the Client Block.**
+        Scan the document for a block of text that contains the exact name "{config.MY_COMPANY_NAME}" AND the exact NIF/CIF "{config.MY_COMPANY_CIF}". This block of text identifies the **Client**. You must completely ignore this entire block for the purpose of supplier identification.
+
+    2.  **Rule 2: Identify the Supplier Block.**
+        The *other* block of text on the document that contains a Name, a NIF/CIF, and an Address is the **Supplier**. This block will have these characteristics:
+        *   **Name:** The name is often a company, which might end in "S.L.", "SL", "S.A.", or "SA".
+        *   **NIF/CIF:** It will have a 9-character identification string (e.g., a letter followed by 8 digits like `B12345678`).
+        *   **Address:** A Spanish address.
+
+    3.  **Rule 3: Extract the Supplier Name and NIF/CIF.**
+        Once you have confidently identified the Supplier block (by first identifying and excluding the Client block), extract only the **official company name** and use it for the `supplier` field, and its NIF/CIF for the `supplier_nif` field.
+
+    **After identifying the supplier, find these other identity fields:**
+    *   `date`: The invoice date (`fecha factura`), formatted as DD-MM-YYYY.
+    *   `invoice_id`: The invoice number (`número de factura`).
+"""
+
+
+def _known_supplier_task(supplier):
+    """The short Task 1 for an invoice whose supplier is already in the supplier directory."""
+    hint = supplier.layout.get('invoice_id_example')
+    return f"""
+    **Task 1: Supplier (already known)**
+
+    The supplier of this invoice is already known. Set `supplier_nif` to "{supplier.nif}", and `supplier` to the company name printed next to it (it has been "{supplier.name}" on earlier invoices).
+
+    **Then find these other identity fields:**
+    *   `date`: The invoice date (`fecha factura`), formatted as DD-MM-YYYY.
+    *   `invoice_id`: The invoice number (`número de factura`).{f' Their invoice numbers look like `{hint}`.' if hint else ''}
+"""
+
+
+def build_extraction_prompt(known_supplier=None):
+    """
+    Returns our detailed instruction (prompt) for the AI. For a supplier that is
+    already in the supplier directory, the supplier identification rules are left out.
+    """
+    return f"""
+    You are a highly precise data extraction bot specializing in Spanish invoices. You have two equally important tasks.
+{_known_supplier_task(known_supplier) if known_supplier else _supplier_identification_task()}
+    **Task 2: Financial Extraction**
+
+    Focus your search on the bottom half (above the footer of the document, if it has a footer) of the final page to find these financial summary fields.
+    *   `total`: The final, grand total of the invoice (`Total Factura`).
+    *   `subtotal`: The subtotal before taxes (`Base Imponible Total` or `Subtotal`).
+    *   `total_tax`: The explicit total tax amount, if present (`Total IVA`).
+    *   `iva_breakdown`: A list of all VAT breakdown lines. For each line, extract the `base` (`Base Imponible`) and the `cuota` (`Cuota IVA`).
+
+    **Final Formatting Rules:**
+    *   Return a single, clean JSON object that follows the given schema. If a field is not found, set it to null.
+    *   Do not add any conversation, explanations, or Markdown.
+
+    **Example:**
+    {{
+        "supplier": "Exluib S.A.",
+        "supplier_nif": "A12345678",
+        "date": "16-08-2025",
+        "invoice_id": "A-5899",
+        "total": "484.10",
+        "subtotal": "420.00",
+        "total_tax": null,
+        "iva_breakdown": [
+            {{"base": "200.00", "cuota": "42.00"}},
+            {{"base": "220.00", "cuota": "22.10"}}
+        ]
+    }}
+    """
+
+
+def build_batch_instructions(invoice_count):
+    """The extra instruction for a request that holds several invoices (see extract_invoices_data_batched)."""
+    return f"""
+    **Several Invoices in One Request:**
+    This request contains {invoice_count} different invoices. Each one starts with a line "{BATCH_INVOICE_MARKER.format(key='<key>')}"
+    followed by its page images (or its text). Extract every invoice separately with the rules above, and never
+    mix data between invoices. Instead of a single invoice object, return an object whose `invoices` array has
+    one object per invoice, in the same order, each with an extra `key` field holding the invoice's key exactly as given.
+    """
+
+
+def _build_request(content, instructions=None, max_tokens=500, schema=None, known_supplier=None):
+    """
+    The arguments of one chat.completions.create call: the prompt (plus any
+    extra instructions), the content items, and the JSON schema the reply must
+    follow (structured output; default: one invoice).
+    """
+    return {
+        # We use gpt-4o because it's excellent at "vision" tasks.
+        "model": MODEL_NAME,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    # This is our detailed instruction (prompt) to the AI.
+                    {"type": "text", "text": build_extraction_prompt(known_supplier) + (instructions or "")},
+                    *content
+                ]
+            }
+        ],
+        # We can set the max tokens to prevent overly long responses.
+        "max_tokens": max_tokens,
+        "temperature": 0.2,
+        # Structured output: the reply is always valid JSON with exactly our fields.
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "invoice_extraction", "strict": True,
+                            "schema": schema or INVOICE_JSON_SCHEMA},
+        },
+    }
+
+
+def _count_usage(usage):
+    if usage:
+        count("openai_prompt_tokens", usage.prompt_tokens)
+        count("openai_completion_tokens", usage.completion_tokens)
+
+
+def ask_model(content, instructions=None, max_tokens=500, known_supplier=None):
+    """
+    Sends the extraction prompt followed by the given content items (images or
+    text) to the model in one request, and returns the model's text reply.
+    With a 'known_supplier' (a supplier_directory.Supplier), the prompt skips
+    the supplier identification rules.
+    """
+    with timed("llm_call"):
+        response = call_provider("openai", get_client().chat.completions.create,
+                                 **_build_request(content, instructions, max_tokens, known_supplier=known_supplier))
+    _count_usage(response.usage)
+    # Extract and return the clean data from the AI's response.
+    return response.choices[0].message.content
+
+
+def prepare_invoice(file_content, file_name):
+    """
+    Does the local part of the extraction for one invoice. Returns a
+    (result, content, known_supplier) tuple: 'result' is the JSON text if the
+    PDF's text layer already gave a complete, verified invoice (so no AI call
+    is needed), and 'content' is the list of content items (page images or
+    text) to send to the model otherwise. Both are None for an unsupported
+    file type. 'known_supplier' is the supplier_directory.Supplier whose NIF
+    the text layer shows, or None.
+    """
+    logger.debug("Reading file content for: %s", file_name)
+    images = []
+    known_supplier = None
+    file_extension = os.path.splitext(file_name)[1].lower()
 
-from openai import OpenAI
-from dotenv import load_dotenv
+    if file_extension == ".pdf" and config.TEXT_LAYER_FAST_PATH:
+        # Fast path: digitally generated PDFs already contain their text, so try to read it directly.
+        with timed("text_layer_parse"):
+            text_lines = extract_text_lines(file_content)
+            parsed_data = parse_invoice_lines(text_lines) if text_lines else None
+        if text_lines:
+            known_supplier = supplier_directory.lookup_supplier(parsed_data.get('supplier_nif'))
+            if known_supplier and not parsed_data.get('supplier'):
+                # A known NIF: the canonical name, where the layout hides the name from the parser.
+                parsed_data['supplier'] = known_supplier.name
+            if is_complete_and_verified(parsed_data):
+                logger.info("  --> Invoice read from the PDF's text layer. No AI call needed.")
+                return json.dumps(parsed_data), None, known_supplier
+            if config.TEXT_LAYER_SEND_TEXT_ONLY:
+                logger.info("  --> Text layer is incomplete. Sending the text (without images) to GPT-4o.")
+                return None, [{
+                    "type": "text",
+                    "text": "There are no images for this invoice. Here is its text, page by page:\n"
+                            + lines_to_text(text_lines)
+                }], known_supplier
 
-# This line looks for a .env file and makes the variables inside it available to our script.
-load_dotenv()
+    if file_extension == ".pdf":
+        # Render the first page and the page(s) with the totals, straight from memory, in a render process.
+        with timed("render"):
+            images = render_pool.render_pages(file_content)
+        logger.debug("  --> PDF content processed successfully (%d page(s) rendered).", len(images))
+
+    elif file_extension in [".png", ".jpg", ".jpeg", ".gif", ".bmp"]:
+        # A photo: shrink it to what the model reads, with its real MIME type.
+        with timed("image_preprocess"):
+            images = [prepare_image(file_content, file_name)]
+        logger.debug("  --> Image content (%s) read successfully.", file_extension)
+
+    else:
+        logger.warning("  --> Unsupported file type: %s. Skipping.", file_extension)
+        return None, None, None
+
+    #Encode the image data into a format the API can understand (Base64).
+    with timed("encode"):
+        image_contents = [
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+                }
+            }
+            for image_bytes, mime_type in images
+        ]
+    count("image_bytes_sent", sum(len(image_bytes) for image_bytes, _ in images))
+
+    return None, [
+        # Tell the model how the images relate to the document.
+        {
+            "type": "text",
+            "text": f"The following {len(image_contents)} image(s) are pages of the same invoice, in order. "
+                    "The last image is the final page."
+        },
+        # Here we provide the actual image data.
+        *image_contents
+    ], known_supplier
 
-# Set up the OpenAI client.
-client = OpenAI()
 
 # Define the main function that will do all the work.
 def extract_invoice_data(file_content, file_name):
     """
     This function takes the content (bytes) of an invoice file,
-    extracts the raw image bytes, sends it to GPT-4o for analysis,
-    and returns the extracted data.
+    renders the relevant pages to images, sends them to GPT-4o for analysis,
+    and returns the extracted data (as JSON text).
+    PDFs with a text layer are parsed directly when possible, with no AI call.
 
     Args:
         file_content (bytes): The raw bytes of the file.
         file_name (str): The original name of the file, used to determine type.
     """
-    print(f"Reading file content for: {file_name}")
-    image_bytes = None
-
     try:
-        file_extension = os.path.splitext(file_name)[1].lower()
-
-        if file_extension == ".pdf":
-            # PyMuPDF can open a PDF from memory using 'stream=file_content'
-            doc = fitz.open(stream=file_content, filetype="pdf")
-            page = doc.load_page(0)
-            pix = page.get_pixmap()
-            image_bytes = pix.tobytes("png")
-            doc.close()
-            print("  --> PDF content processed successfully.")
-
-        elif file_extension in [".png", ".jpg", ".jpeg", ".gif", ".bmp"]:
-            # If it's an image, the content is already the image bytes.
-            image_bytes = file_content
-            print(f"  --> Image content ({file_extension}) read successfully.")
-
-        else:
-            print(f"  --> Unsupported file type: {file_extension}. Skipping.")
-            return None
-
-        #Encode the image data into a format the API can understand (Base64).
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-
-        #Call the OpenAI API with our image and prompt.
-        response = client.chat.completions.create(
-            # We use gpt-4o because it's excellent at "vision" tasks.
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        # This is our detailed instruction (prompt) to the AI.
-                        {
-                            "type": "text",
-                            "text": f"""
-                            You are a highly precise data extraction bot specializing in Spanish invoices. You have two equally important tasks.
-                    
-                            **Task 1: Supplier Identification**
-                    
-                            Your first and most critical task is to identify the **Supplier** of the invoice. To do this, you must first find the two entities on the document (Supplier and Client) and distinguish between them using the following strict rules:
-                    
-                            1.  **Rule 1: Identify the Client Block.**
-                                Scan the document for a block of text that contains the exact name "{config.MY_COMPANY_NAME}" AND the exact NIF/CIF "{config.MY_COMPANY_CIF}". This block of text identifies the **Client**. You must completely ignore this entire block for the purpose of supplier identification.
-                    
-                            2.  **Rule 2: Identify the Supplier Block.**
-                                The *other* block of text on the document that contains a Name, a NIF/CIF, and an Address is the **Supplier**. This block will have these characteristics:
-                                *   **Name:** The name is often a company, which might end in "S.L.", "SL", "S.A.", or "SA".
-                                *   **NIF/CIF:** It will have a 9-character identification string (e.g., a letter followed by 8 digits like `B12345678`).
-                                *   **Address:** A Spanish address.
-                    
-                            3.  **Rule 3: Extract the Supplier Name.**
-                                Once you have confidently identified the Supplier block (by first identifying and excluding the Client block), extract only the **official company name** and use it for the `supplier` field.
-                    
-                            **After identifying the supplier, find these other identity fields:**
-                            *   `date`: The invoice date (`fecha factura`), formatted as DD-MM-YYYY.
-                            *   `invoice_id`: The invoice number (`número de factura`).
-                    
-                            **Task 2: Financial Extraction**
-                    
-                            Focus your search on the bottom half (above the footer of the document, if it has a footer) of the final page to find these financial summary fields.
-                            *   `total`: The final, grand total of the invoice (`Total Factura`).
-                            *   `subtotal`: The subtotal before taxes (`Base Imponible Total` or `Subtotal`).
-                            *   `total_tax`: The explicit total tax amount, if present (`Total IVA`).
-                            *   `iva_breakdown`: A list of all VAT breakdown lines. For each line, extract the `base` (`Base Imponible`) and the `cuota` (`Cuota IVA`).
-                    
-                            **Final Formatting Rules:**
-                            *   Return a single, clean JSON object. If a field is not found, omit it from the JSON.
-                            *   Do not add any conversation, explanations, or Markdown.
-                    
-                            **Example:**
-                            {{
-                                "supplier": "Exluib S.A.",
-                                "date": "16-08-2025",
-                                "invoice_id": "A-5899",
-                                "total": "484.10",
-                                "subtotal": "420.00",
-                                "iva_breakdown": [
-                                    {{"base": "200.00", "cuota": "42.00"}},
-                                    {{"base": "220.00", "cuota": "22.10"}}
-                                ]
-                            }}
-                            """
-                        },
-                        # Here we provide the actual image data.
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            # We can set the max tokens to prevent overly long responses.
-            max_tokens=500,
-            temperature=0.2
-        )
+        result, content, known_supplier = prepare_invoice(file_content, file_name)
+        if content is None:
+            return result
 
-        # Step 8: Extract and return the clean data from the AI's response.
-        extracted_text = response.choices[0].message.content
-        return extracted_text
+        #Call the OpenAI API with our images and prompt.
+        if known_supplier:
+            logger.info("  --> Known supplier %s (%s). Skipping supplier identification.",
+                        known_supplier.name, known_supplier.nif)
+        return ask_model(content, known_supplier=known_supplier)
 
     except Exception as e:
-        # If anything goes wrong, we print the error and return None.
-        print(f"An error occurred during file extraction:  {e}")
+        # If anything goes wrong, we log the error and return None.
+        logger.error("An error occurred during file extraction:  %s", e)
         return None
+
+
+# --- BATCHED EXTRACTION ---
+# For backfills, several invoices share one request (and so one copy of the
+# long prompt above), or whole sets of requests go through OpenAI's Batch API.
+
+def _prepare_batch(invoices):
+    """
+    Runs prepare_invoice() on (key, file_content, file_name) tuples. Returns the
+    JSON text of the invoices that need no AI call ({key: JSON text}) and the
+    (key, content) pairs of the others. As the prompt is shared, a known
+    supplier is named in the invoice's own content instead.
+    """
+    results = {}
+    pending = []
+    # Start rendering the PDFs in the render processes (as many as there are free slots) while we go through them.
+    for _, file_content, file_name in invoices:
+        if file_name.lower().endswith(".pdf") and not render_pool.render_ahead(file_content, block=False):
+            break
+    for key, file_content, file_name in invoices:
+        try:
+            result, content, known_supplier = prepare_invoice(file_content, file_name)
+        except Exception as e:
+            logger.error("An error occurred while preparing %s for a batched request: %s", file_name, e)
+            continue
+        finally:
+            render_pool.discard_ahead(file_content)
+        if content is not None:
+            if known_supplier:
+                content = [{"type": "text", "text": f"The supplier of this invoice is already known (NIF/CIF "
+                                                    f"{known_supplier.nif}, earlier invoices: \"{known_supplier.name}\"). "
+                                                    f"Copy the name as printed on this one."},
+                           *content]
+            pending.append((key, content))
+        elif result:
+            results[key] = result
+    return results, pending
+
+
+def _pack_requests(pending, invoices_per_request=None):
+    """
+    Groups (key, content) pairs into requests of up to 'invoices_per_request'
+    invoices and MAX_IMAGES_PER_BATCHED_REQUEST images. Returns a list of
+    (keys, request arguments) pairs.
+    """
+    invoices_per_request = max(1, invoices_per_request or config.BATCH_INVOICES_PER_REQUEST)
+    # Each group is a [list of (key, content) pairs, number of images] pair.
+    groups = []
+    for key, content in pending:
+        images = sum(item["type"] == "image_url" for item in content)
+        if not groups or len(groups[-1][0]) >= invoices_per_request or \
+                groups[-1][1] + images > MAX_IMAGES_PER_BATCHED_REQUEST:
+            groups.append([[], 0])
+        groups[-1][0].append((key, content))
+        groups[-1][1] += images
+
+    requests = []
+    for group, _ in groups:
+        content = []
+        # Short keys ("1", "2", ...) are easy for the model to copy; we map them back below.
+        for position, (_, invoice_content) in enumerate(group, start=1):
+            content.append({"type": "text", "text": BATCH_INVOICE_MARKER.format(key=position)})
+            content.extend(invoice_content)
+        request = _build_request(content, build_batch_instructions(len(group)), max_tokens=500 * len(group),
+                                 schema=BATCHED_INVOICES_JSON_SCHEMA)
+        requests.append(([key for key, _ in group], request))
+    return requests
+
+
+def _parse_batched_reply(reply, keys):
+    """
+    Maps the invoices of a batched reply ({"invoices": [...]}, or a bare JSON
+    array) back to the callers' keys. Returns {key: JSON text}; invoices
+    missing from the reply are left out.
+    """
+    if not reply:
+        return {}
+    try:
+        items = json.loads(reply)
+    except json.JSONDecodeError:
+        start_index = reply.find('[')
+        end_index = reply.rfind(']') + 1
+        try:
+            items = json.loads(reply[start_index:end_index]) if start_index != -1 and end_index != 0 else []
+        except json.JSONDecodeError:
+            logger.warning("  --> A batched request returned malformed JSON.")
+            return {}
+    if isinstance(items, dict):
+        items = items.get("invoices")
+    results = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        try:
+            key = keys[int(str(item.pop("key", "")).strip()) - 1]
+        except (ValueError, IndexError):
+            continue
+        results.setdefault(key, json.dumps(item))
+    return results
+
+
+def extract_invoices_data_batched(invoices, invoices_per_request=None):
+    """
+    Extracts many invoices with several invoices per model request.
+    'invoices' is a list of (key, file_content, file_name) tuples; returns
+    {key: JSON text} for every invoice that was extracted. Invoices missing
+    from the result (failed requests, or left out of a reply) should be
+    retried one by one with extract_invoice_data().
+    """
+    results, pending = _prepare_batch(invoices)
+    requests = _pack_requests(pending, invoices_per_request)
+
+    def send(keys_and_request):
+        keys, request = keys_and_request
+        try:
+            with timed("llm_call"):
+                response = call_provider("openai", get_client().chat.completions.create, **request)
+        except Exception as e:
+            logger.error("  --> A batched request for %d invoice(s) failed: %s", len(keys), e)
+            return {}
+        _count_usage(response.usage)
+        return _parse_batched_reply(response.choices[0].message.content, keys)
+
+    if requests:
+        logger.info("  --> Sending %d invoice(s) to GPT-4o in %d request(s).", len(pending), len(requests))
+        # The "openai" provider limit caps how many of these run at the same time.
+        with ThreadPoolExecutor(max_workers=config.PROVIDER_CONCURRENCY_LIMITS.get("openai", 4)) as executor:
+            for request_results in executor.map(send, requests):
+                results.update(request_results)
+    count("batched_invoices", len(pending))
+    count("batched_requests", len(requests))
+    return results
+
+
+def _batch_files(requests):
+    """Splits the requests into Batch API input files (JSONL bytes) below MAX_BATCH_FILE_BYTES."""
+    files = [[]]
+    size = 0
+    for request_index, (_, request) in enumerate(requests):
+        line = json.dumps({"custom_id": str(request_index), "method": "POST", "url": "/v1/chat/completions",
+                           "body": request}).encode("utf-8") + b"\n"
+        if files[-1] and size + len(line) > MAX_BATCH_FILE_BYTES:
+            files.append([])
+            size = 0
+        files[-1].append(line)
+        size += len(line)
+    return [b"".join(lines) for lines in files if lines]
+
+
+def extract_invoices_data_with_batch_api(invoices, invoices_per_request=None):
+    """
+    Like extract_invoices_data_batched(), but submits the requests through
+    OpenAI's asynchronous Batch API (half the price, no rate limit pressure)
+    and waits for the results, checking every config.BATCH_API_POLL_INTERVAL_SECONDS
+    for up to config.BATCH_API_MAX_WAIT_HOURS. Meant for large backfills.
+    """
+    results, pending = _prepare_batch(invoices)
+    requests = _pack_requests(pending, invoices_per_request)
+    if not requests:
+        return results
+
+    batch_ids = []
+    for batch_file_content in _batch_files(requests):
+        input_file = call_provider("openai", get_client().files.create,
+                                   file=("invoice_extraction.jsonl", batch_file_content), purpose="batch")
+        batch = call_provider("openai", get_client().batches.create, input_file_id=input_file.id,
+                              endpoint="/v1/chat/completions", completion_window="24h")
+        batch_ids.append(batch.id)
+    logger.info("  --> Submitted %d invoice(s) in %d request(s) to the OpenAI Batch API (batch(es): %s).",
+                len(pending), len(requests), ", ".join(batch_ids))
+    count("batched_invoices", len(pending))
+    count("batched_requests", len(requests))
+
+    deadline = time.monotonic() + config.BATCH_API_MAX_WAIT_HOURS * 3600
+    unfinished = list(batch_ids)
+    while unfinished:
+        for batch_id in list(unfinished):
+            batch = call_provider("openai", get_client().batches.retrieve, batch_id)
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                unfinished.remove(batch_id)
+                logger.info("  --> Batch %s finished with status '%s'.", batch_id, batch.status)
+                if batch.output_file_id:
+                    output = call_provider("openai", get_client().files.content, batch.output_file_id).text
+                    results.update(_read_batch_output(output, requests))
+        if unfinished and time.monotonic() > deadline:
+            logger.warning("  --> Gave up waiting for batch(es) %s. Those invoices are sent one by one.",
+                           ", ".join(unfinished))
+            for batch_id in unfinished:
+                call_provider("openai", get_client().batches.cancel, batch_id)
+            break
+        if unfinished:
+            time.sleep(config.BATCH_API_POLL_INTERVAL_SECONDS)
+    return results
+
+
+def _read_batch_output(output, requests):
+    """Maps the lines of a Batch API output file back to the callers' keys ({key: JSON text})."""
+    results = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        response = entry.get("response") or {}
+        if response.get("status_code") != 200:
+            continue
+        keys, _ = requests[int(entry["custom_id"])]
+        body = response["body"]
+        usage = body.get("usage") or {}
+        count("openai_prompt_tokens", usage.get("prompt_tokens", 0))
+        count("openai_completion_tokens", usage.get("completion_tokens", 0))
+        results.update(_parse_batched_reply(body["choices"][0]["message"]["content"], keys))
+    return results
+
+
+class FakeOpenAIClient:
+    """
+    A local stand-in for the OpenAI client, for tests and benchmarks. Every
+    chat.completions.create() call returns the next of the given (recorded)
+    replies in turn, after an optional delay; a batched request gets a JSON
+    array with one recorded reply per invoice. The Batch API (files and
+    batches) is mimicked too: a batch is completed as soon as it is created.
+    Token usage is estimated from the request. Every request it receives is
+    kept in 'requests'.
+    """
+
+    # Roughly what one low-resolution page image costs in prompt tokens.
+    TOKENS_PER_IMAGE = 765
+    BATCH_MARKER_PATTERN = re.compile(BATCH_INVOICE_MARKER.format(key=r"(\d+)"))
+
+    def __init__(self, replies, latency_seconds=0):
+        self._replies = itertools.cycle(replies)
+        self.latency_seconds = latency_seconds
+        self.requests = []
+        self._files = {}
+        self._batches = {}
+        self._lock = threading.Lock()
+        # Mimics the client.chat.completions.create(), client.files.* and client.batches.* call paths.
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch,
+                                       cancel=self._retrieve_batch)
+
+    def _next_reply(self, content):
+        keys = [match.group(1) for item in content if item["type"] == "text"
+                for match in [self.BATCH_MARKER_PATTERN.fullmatch(item["text"])] if match]
+        with self._lock:
+            if not keys:
+                return next(self._replies)
+            replies = [next(self._replies) for _ in keys]
+        items = []
+        for key, reply in zip(keys, replies):
+            start_index, end_index = reply.find('{'), reply.rfind('}') + 1
+            items.append(dict(json.loads(reply[start_index:end_index]), key=key))
+        return json.dumps({"invoices": items})
+
+    def _create(self, model, messages, **kwargs):
+        with self._lock:
+            self.requests.append(messages)
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        content = [item for message in messages for item in message["content"]]
+        reply = self._next_reply(content)
+        prompt_tokens = sum(len(item["text"]) // 4 if item["type"] == "text" else self.TOKENS_PER_IMAGE
+                            for item in content)
+        completion_tokens = len(reply) // 4
+        from openai.types.chat import ChatCompletion, ChatCompletionMessage
+        from openai.types.chat.chat_completion import Choice
+        from openai.types.completion_usage import CompletionUsage
+        return ChatCompletion(
+            id="fake-completion", created=int(time.time()), model=model, object="chat.completion",
+            choices=[Choice(index=0, finish_reason="stop",
+                            message=ChatCompletionMessage(role="assistant", content=reply))],
+            usage=CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                  total_tokens=prompt_tokens + completion_tokens))
+
+    def _create_file(self, file, purpose):
+        file_id = f"fake-file-{len(self._files)}"
+        self._files[file_id] = file[1]
+        return SimpleNamespace(id=file_id)
+
+    def _file_content(self, file_id):
+        return SimpleNamespace(text=self._files[file_id].decode("utf-8"))
+
+    def _create_batch(self, input_file_id, endpoint, completion_window):
+        output_lines = []
+        for line in self._files[input_file_id].decode("utf-8").splitlines():
+            entry = json.loads(line)
+            response = self._create(**entry["body"])
+            output_lines.append(json.dumps({"custom_id": entry["custom_id"],
+                                            "response": {"status_code": 200, "body": response.model_dump()}}))
+        output_file = self._create_file(("output.jsonl", "\n".join(output_lines).encode("utf-8")), "batch_output")
+        batch = SimpleNamespace(id=f"fake-batch-{len(self._batches)}", status="completed",
+                                output_file_id=output_file.id)
+        self._batches[batch.id] = batch
+        return batch
+
+    def _retrieve_batch(self, batch_id):
+        return self._batches[batch_id]
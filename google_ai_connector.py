@@ -1,51 +1,152 @@
 import os
-from google.cloud import documentai
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import config
+import providers
+from instrumentation import logger
+from provider_limits import call_provider
+from providers import lazy_import
+
+# The Document AI library is only imported (and the client only created) when the first document is sent.
+documentai = lazy_import("google.cloud.documentai")
 
 # --- CONFIGURATION ---
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "credentials.json"
+# The service account key Document AI uses, unless the environment already names one.
+CREDENTIALS_FILE = "credentials.json"
 # --------------------
 
-def analyze_invoice_with_google(file_path, mime_type="application/pdf"):
+# Identifies this agent's results in the extraction cache.
+AGENT_VERSION = f"documentai-{config.GOOGLE_PROCESSOR_ID}"
+
+# Google's entity types and the fields of our standard dictionary they map to.
+ENTITY_FIELDS = {
+    "supplier_name": "supplier",
+    "supplier_tax_id": "supplier_nif",
+    "invoice_date": "date",
+    "invoice_id": "invoice_id",
+    "total_amount": "total",
+    "net_amount": "subtotal",
+    "total_tax_amount": "total_tax",
+}
+# We only take fields with a reasonable confidence score
+MIN_ENTITY_CONFIDENCE = 0.4  # 40% confidence threshold
+
+# --- SHARED CLIENT ---
+# One client (and so one gRPC channel) is created on first use and shared by all
+# threads; creating a client per call costs a new connection every time.
+# (The same path DocumentProcessorServiceClient.processor_path() builds.)
+PROCESSOR_NAME = (f"projects/{config.GOOGLE_PROJECT_ID}/locations/{config.GOOGLE_LOCATION}"
+                  f"/processors/{config.GOOGLE_PROCESSOR_ID}")
+
+
+def _create_client():
+    """Creates the Document AI client for our processor's region."""
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", CREDENTIALS_FILE)
+    opts = {"api_endpoint": f"{config.GOOGLE_LOCATION}-documentai.googleapis.com"}
+    return documentai.DocumentProcessorServiceClient(client_options=opts)
+
+
+providers.register_provider("documentai", _create_client)
+
+
+def get_client():
+    """Returns the shared Document AI client, creating it on first use."""
+    return providers.get_client("documentai")
+
+
+def use_client(client):
     """
-    Sends an invoice to Google Document AI and translates the result
-    into our standard project dictionary format.
+    Replaces the shared client, e.g. with a FakeDocumentProcessor for tests.
+    Pass None to go back to a real client on the next call. Returns the previous client.
     """
-    opts = {"api_endpoint": f"{config.GOOGLE_LOCATION}-documentai.googleapis.com"}
-    client = documentai.DocumentProcessorServiceClient(client_options=opts)
-    name = client.processor_path(config.GOOGLE_PROJECT_ID, config.GOOGLE_LOCATION, config.GOOGLE_PROCESSOR_ID)
+    return providers.use_client("documentai", client)
 
-    with open(file_path, "rb") as image:
-        image_content = image.read()
 
-    document = {"content": image_content, "mime_type": mime_type}
-    request = {"name": name, "raw_document": document}
+def mime_type_for(file_name):
+    """The MIME type Document AI needs for an invoice file, based on its extension."""
+    file_extension = os.path.splitext(file_name)[1].lower()
+    if file_extension in [".jpg", ".jpeg"]:
+        return "image/jpeg"
+    elif file_extension == ".png":
+        return "image/png"
+    return "application/pdf"
 
-    print("  --> Sending to Google Document AI Specialist...")
-    result = client.process_document(request=request)
-    document = result.document
 
-    # --- TRANSLATION LOGIC ---
-    # This is where we convert Google's output into our format.
+def _translate_document(document):
+    """
+    Converts Google's output into our standard project dictionary format.
+    For now, we don't need to translate the breakdown, as our Python calculator
+    can work with the total, subtotal, and total_tax fields.
+    """
     extracted_data = {}
     for entity in document.entities:
-        # We only take fields with a reasonable confidence score
-        if entity.confidence > 0.4:  # 40% confidence threshold
-            # Map Google's field names to our field names
-            if entity.type_ == "supplier_name":
-                extracted_data['supplier'] = entity.mention_text
-            elif entity.type_ == "invoice_date":
-                extracted_data['date'] = entity.mention_text
-            elif entity.type_ == "invoice_id":
-                extracted_data['invoice_id'] = entity.mention_text
-            elif entity.type_ == "total_amount":
-                extracted_data['total'] = entity.mention_text
-            elif entity.type_ == "net_amount":
-                extracted_data['subtotal'] = entity.mention_text
-            elif entity.type_ == "total_tax_amount":
-                extracted_data['total_tax'] = entity.mention_text
-
-    # For now, we don't need to translate the breakdown, as our Python calculator
-    # can work with the total, subtotal, and total_tax fields.
-
-    return extracted_data
\ No newline at end of file
+        field = ENTITY_FIELDS.get(entity.type_)
+        if field and entity.confidence > MIN_ENTITY_CONFIDENCE:
+            extracted_data[field] = entity.mention_text
+    return extracted_data
+
+
+def analyze_invoice_with_google(file_content, mime_type="application/pdf"):
+    """
+    Sends an invoice (its bytes, straight from memory) to Google Document AI
+    and translates the result into our standard project dictionary format.
+    """
+    document = {"content": file_content, "mime_type": mime_type}
+    request = {"name": PROCESSOR_NAME, "raw_document": document}
+
+    logger.info("  --> Sending to Google Document AI Specialist...")
+    result = call_provider("documentai", get_client().process_document, request=request)
+    return _translate_document(result.document)
+
+
+def analyze_invoices_with_google(invoices, max_workers=None):
+    """
+    Sends several invoices to Document AI at once over the shared client.
+    'invoices' is a list of (file_content, mime_type) tuples; returns the
+    dictionaries in the same order (an empty dictionary where a request failed).
+    The number of requests in flight is still capped by the "documentai"
+    provider limit.
+    """
+    def analyze(invoice):
+        try:
+            return analyze_invoice_with_google(*invoice)
+        except Exception as e:
+            logger.warning("  --> Google Document AI request failed: %s", e)
+            return {}
+
+    if not invoices:
+        return []
+    max_workers = max_workers or config.PROVIDER_CONCURRENCY_LIMITS.get("documentai", 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(analyze, invoices))
+
+
+class FakeDocumentProcessor:
+    """
+    A local stand-in for DocumentProcessorServiceClient, for tests and benchmarks.
+    Returns the given entities ({entity_type: mention_text}) for every document,
+    or per document content through 'entities_by_content', after an optional delay.
+    Every request it receives is kept in 'requests'.
+    """
+
+    def __init__(self, entities=None, entities_by_content=None, latency_seconds=0, confidence=0.9):
+        self.entities = entities or {}
+        self.entities_by_content = entities_by_content or {}
+        self.latency_seconds = latency_seconds
+        self.confidence = confidence
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def process_document(self, request):
+        with self._lock:
+            self.requests.append(request)
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        content = request["raw_document"]["content"]
+        entities = self.entities_by_content.get(content, self.entities)
+        document = documentai.Document(entities=[
+            documentai.Document.Entity(type_=entity_type, mention_text=text, confidence=self.confidence)
+            for entity_type, text in entities.items()
+        ])
+        return documentai.ProcessResponse(document=document)
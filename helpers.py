@@ -1,72 +1,74 @@
 import os
+from decimal import Decimal
+
+import supplier_directory
+from instrumentation import logger
+from invoice_model import Invoice, format_amount
+
+# How far (Total - Subtotal) may be from the tax for the numbers to "add up".
+TAX_TOLERANCE = Decimal("0.02")
 
 
 # clean_invoice_data(data_dict) Function: Our data cleaning utility
 def clean_invoice_data(data_dict, filename):
     """
-    Takes a dictionary of extracted invoice data and cleans/standardizes the values.
+    Takes a dictionary of extracted invoice data and cleans/standardizes the values
+    (through the typed Invoice model: amounts like "1234.56", dates as DD-MM-YYYY).
+    A supplier found in the supplier directory (by NIF) gets its canonical name
+    when no name was extracted, or when the name is one of its known spellings.
     """
-    cleaned_data = {}
+    invoice = Invoice.from_dict(data_dict)
+    invoice.filename = filename
 
-    cleaned_data['filename'] = filename
-    # Clean the text fields by removing any leading/trailing whitespace
-    supplier_name = data_dict.get('supplier', '').strip()
-    if not supplier_name:  # If the supplier name is empty...
+    known_supplier = supplier_directory.lookup_supplier(invoice.supplier_nif)
+    if known_supplier and (not invoice.supplier or supplier_directory.known_spelling(known_supplier, invoice.supplier)):
+        invoice.supplier = known_supplier.name
+    elif not invoice.supplier:  # If the supplier name is empty...
         name_from_file = os.path.splitext(os.path.basename(filename))[0]
         name_from_file = ''.join([i for i in name_from_file if not i.isdigit()]).strip()
-        supplier_name = name_from_file.replace('_', ' ').replace('-', ' ')
-        print(f"  --> AI did not find a supplier. Using fallback from filename: '{supplier_name}'")
-    cleaned_data['supplier'] = supplier_name
-    # ----------------------------------------
-    cleaned_data['date'] = data_dict.get('date', '').strip()
-    cleaned_data['invoice_id'] = data_dict.get('invoice_id', '').strip()
-
-    # --- Clean the numeric fields ---
-    # We will handle Tax first
-    tax_str = data_dict.get('tax', '0').strip()
-    # Replace comma with a period for a standard decimal, then remove the € symbol and any other spaces.
-    tax_str_cleaned = tax_str.replace(',', '.').replace('€', '').strip()
-    cleaned_data['tax'] = tax_str_cleaned
-
-    # Now we handle Total
-    total_str = data_dict.get('total', '0').strip()
-    total_str_cleaned = total_str.replace(',', '.').replace('€', '').strip()
-    cleaned_data['total'] = total_str_cleaned
+        invoice.supplier = name_from_file.replace('_', ' ').replace('-', ' ').strip()
+        logger.info("  --> AI did not find a supplier. Using fallback from filename: '%s'", invoice.supplier)
 
-    print(f"Cleaned data: {cleaned_data}")
+    cleaned_data = invoice.to_dict()
+    logger.debug("Cleaned data: %s", cleaned_data)
     return cleaned_data
 
-def verify_and_calculate_tax(data_dict):
+
+def verify_tax(invoice):
     """
-    Takes the raw extracted data from the AI, calculates, and verifies the tax.
-    Returns the dictionary with a guaranteed, correct 'tax' field.
+    Calculates and verifies the tax of an Invoice. Sets 'tax' to the verified
+    amount, or 'tax_error' to the reason it could not be verified. Returns the invoice.
     """
-    try:
-        # Get numeric values for total and subtotal, default to 0.0 if not found
-        total = float(data_dict.get('total', '0').replace(',', '.'))
-        subtotal = float(data_dict.get('subtotal', '0').replace(',', '.'))
+    if any(name in invoice.unreadable_fields for name in ('total', 'subtotal', 'total_tax', 'iva_breakdown')):
+        logger.warning("  --> Error during tax verification: unreadable %s", ", ".join(invoice.unreadable_fields))
+        invoice.tax, invoice.tax_error = None, "ERROR: CALCULATION FAILED"
+        return invoice
 
-        # Path 1: An explicit total_tax exists. Let's verify it.
-        if 'total_tax' in data_dict:
-            explicit_tax = float(data_dict['total_tax'].replace(',', '.'))
-            # Sanity Check: Is (Total - Subtotal) close to the explicit tax?
-            if abs((total - subtotal) - explicit_tax) < 0.02:
-                data_dict['tax'] = str(explicit_tax)
-                return data_dict
+    # Missing totals count as zero, so they can never "add up" by accident.
+    expected_tax = (invoice.total or Decimal(0)) - (invoice.subtotal or Decimal(0))
 
-        # Path 2: No explicit tax, or verification failed. Let's calculate from the breakdown.
-        if 'iva_breakdown' in data_dict and isinstance(data_dict['iva_breakdown'], list):
-            calculated_tax = sum(float(item.get('cuota', '0').replace(',', '.')) for item in data_dict['iva_breakdown'])
-            # Sanity Check: Is (Total - Subtotal) close to our calculated tax?
-            if abs((total - subtotal) - calculated_tax) < 0.02:
-                data_dict['tax'] = f"{calculated_tax:.2f}"
-                return data_dict
+    # Path 1: An explicit total_tax exists. Let's verify it.
+    if invoice.total_tax is not None and abs(expected_tax - invoice.total_tax) < TAX_TOLERANCE:
+        invoice.tax, invoice.tax_error = invoice.total_tax, ""
+        return invoice
 
-        # Path 3: All else fails. Mark as unverifiable.
-        data_dict['tax'] = "ERROR: UNVERIFIABLE"
-        return data_dict
+    # Path 2: No explicit tax, or verification failed. Let's calculate from the breakdown.
+    if invoice.iva_breakdown:
+        calculated_tax = sum((line.cuota or Decimal(0) for line in invoice.iva_breakdown), Decimal(0))
+        if abs(expected_tax - calculated_tax) < TAX_TOLERANCE:
+            invoice.tax, invoice.tax_error = calculated_tax, ""
+            return invoice
 
-    except (ValueError, TypeError) as e:
-        print(f"  --> Error during tax verification: {e}")
-        data_dict['tax'] = "ERROR: CALCULATION FAILED"
-        return data_dict
+    # Path 3: All else fails. Mark as unverifiable.
+    invoice.tax, invoice.tax_error = None, "ERROR: UNVERIFIABLE"
+    return invoice
+
+
+def verify_and_calculate_tax(data_dict):
+    """
+    Takes the raw extracted data from the AI, calculates, and verifies the tax.
+    Returns the dictionary with a guaranteed, correct 'tax' field (see verify_tax).
+    """
+    invoice = verify_tax(Invoice.from_dict(data_dict))
+    data_dict['tax'] = invoice.tax_error or format_amount(invoice.tax)
+    return data_dict
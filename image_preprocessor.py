@@ -0,0 +1,165 @@
+# image_preprocessor.py
+# Shrinks invoice photos before they are sent to the vision model.
+#
+# Phone photos are often 4-12 MB and far bigger than what GPT-4o reads (it
+# scales every image down to 2048px on the long side and 768px on the short
+# side). Each photo is decoded once, at a reduced size where the format allows
+# it, turned to grayscale, straightened, cropped to the paper, scaled down and
+# re-encoded as a compact JPEG written straight into one buffer.
+#
+# If anything goes wrong the original bytes are sent, with the right MIME type.
+
+import io
+import os
+
+import config
+from instrumentation import logger, count
+from pdf_renderer import VISION_MAX_LONG_SIDE, VISION_MAX_SHORT_SIDE
+from providers import lazy_import
+
+# Pillow and numpy are only imported when the first photo is preprocessed.
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+np = lazy_import("numpy")
+
+# The MIME type of each image extension we accept.
+IMAGE_MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".bmp": "image/bmp",
+    ".webp": "image/webp",
+}
+# The deskew angle is searched on a thumbnail of this long side, in steps of DESKEW_STEP_DEGREES.
+DESKEW_THUMBNAIL_SIDE = 800
+DESKEW_STEP_DEGREES = 0.5
+# Images are decoded at (at least) this many times the size they are sent at.
+DECODE_HEADROOM = 1.5
+# A pixel this much darker than the background counts as content when cropping.
+CROP_CONTRAST_THRESHOLD = 40
+
+
+def mime_type_for_image(file_name):
+    """The MIME type of an image file, based on its extension (image/png if unknown)."""
+    return IMAGE_MIME_TYPES.get(os.path.splitext(file_name)[1].lower(), "image/png")
+
+
+def _target_size(width, height):
+    """The largest size within the vision model's limits (never bigger than the original)."""
+    long_side = min(VISION_MAX_LONG_SIDE, config.IMAGE_MAX_LONG_SIDE)
+    scale = min(1.0, long_side / max(width, height), VISION_MAX_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _open_reduced(file_content):
+    """
+    Opens an image at a reduced size that is still bigger than the target size.
+    JPEGs are decoded directly at that size (much faster and lighter than
+    decoding the full photo and scaling it afterwards).
+    """
+    image = Image.open(io.BytesIO(file_content))
+    target_width, target_height = _target_size(*image.size)
+    # Keep some extra resolution, as cropping the margins makes the image smaller.
+    min_width, min_height = int(target_width * DECODE_HEADROOM), int(target_height * DECODE_HEADROOM)
+    if image.format == "JPEG":
+        # draft() only ever reduces by powers of two, and never below the requested size.
+        image.draft("L", (min_width, min_height))
+    else:
+        # Other formats are decoded in full, then reduced by a whole factor.
+        factor = min(image.width // min_width, image.height // min_height)
+        if factor >= 2:
+            image = image.reduce(factor)
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "L":
+        if image.mode in ("RGBA", "LA", "P"):
+            # Transparent areas become white paper, not black.
+            image = image.convert("RGBA")
+            background = Image.new("RGBA", image.size, "white")
+            image = Image.alpha_composite(background, image)
+        image = image.convert("L")
+    return image
+
+
+def _skew_angle(image):
+    """
+    Estimates how many degrees the text lines are rotated: the angle at which
+    the rows of a thumbnail are most clearly split into dark (text) and light
+    (spacing) rows.
+    """
+    thumbnail = image.copy()
+    thumbnail.thumbnail((DESKEW_THUMBNAIL_SIDE, DESKEW_THUMBNAIL_SIDE))
+    # Dark pixels (text) become white, the paper black.
+    ink = ImageOps.invert(thumbnail).point(lambda value: 255 if value > 128 else 0)
+    best_angle, best_score = 0.0, None
+    limit = config.IMAGE_MAX_DESKEW_DEGREES
+    for angle in np.arange(-limit, limit + DESKEW_STEP_DEGREES / 2, DESKEW_STEP_DEGREES):
+        rows = np.asarray(ink.rotate(float(angle), resample=Image.NEAREST), dtype=np.float32).sum(axis=1)
+        score = float(np.square(np.diff(rows)).sum())
+        if best_score is None or score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def _crop_to_content(image):
+    """
+    Cuts away the margins (the rows and columns with no content), keeping a
+    little padding. The content is found on a thumbnail, where camera noise
+    has been averaged away.
+    """
+    thumbnail = image.copy()
+    thumbnail.thumbnail((DESKEW_THUMBNAIL_SIDE, DESKEW_THUMBNAIL_SIDE), Image.BOX)
+    pixels = np.asarray(thumbnail)
+    background = np.median(pixels[::4, ::4])
+    content = pixels < background - CROP_CONTRAST_THRESHOLD
+    rows, columns = np.flatnonzero(content.any(axis=1)), np.flatnonzero(content.any(axis=0))
+    if not len(rows) or not len(columns):
+        return image
+    scale = image.width / thumbnail.width
+    padding = config.IMAGE_CROP_PADDING_PIXELS
+    box = (max(0, int(columns[0] * scale) - padding), max(0, int(rows[0] * scale) - padding),
+           min(image.width, int((columns[-1] + 1) * scale) + padding),
+           min(image.height, int((rows[-1] + 1) * scale) + padding))
+    return image.crop(box)
+
+
+def preprocess_image(file_content):
+    """Returns the photo as a grayscale, straightened, cropped and downscaled JPEG (bytes)."""
+    image = _open_reduced(file_content)
+
+    if config.IMAGE_DESKEW:
+        angle = _skew_angle(image)
+        if angle:
+            logger.debug("  --> Straightening the image by %.1f degrees.", angle)
+            image = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    if config.IMAGE_AUTO_CROP:
+        image = _crop_to_content(image)
+    target_size = _target_size(*image.size)
+    if target_size != image.size:
+        image = image.resize(target_size, Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=config.IMAGE_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+def prepare_image(file_content, file_name):
+    """
+    Returns (image_bytes, mime_type) for an invoice photo: the preprocessed JPEG,
+    or the original bytes when preprocessing is disabled, fails, or would not
+    make the image smaller.
+    """
+    mime_type = mime_type_for_image(file_name)
+    if not config.IMAGE_PREPROCESSING_ENABLED:
+        return file_content, mime_type
+    try:
+        processed = preprocess_image(file_content)
+    except Exception as e:
+        logger.warning("  --> Could not preprocess image %s (%s). Sending it unchanged.", file_name, e)
+        return file_content, mime_type
+    if len(processed) >= len(file_content):
+        return file_content, mime_type
+    count("image_bytes_saved", len(file_content) - len(processed))
+    logger.debug("  --> Image reduced from %d to %d bytes.", len(file_content), len(processed))
+    return processed, "image/jpeg"
+
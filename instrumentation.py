@@ -0,0 +1,228 @@
+# instrumentation.py
+# Logging, per-stage timers and counters for the whole pipeline.
+#
+# Every module logs through the shared 'logger' (a standard library logger, so
+# messages below config.LOG_LEVEL cost only a level check) and measures its
+# stages with 'timed()' and 'count()'. The timings and counters can be exported
+# as JSON or in the Prometheus text format, together with a per-invoice
+# breakdown of where the time (and the tokens) went.
+#
+# Example:
+#     with timed("llm_call"):
+#         response = client.chat.completions.create(...)
+#     count("openai_prompt_tokens", response.usage.prompt_tokens)
+
+import json
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import config
+
+# How many recent durations per stage are kept for the percentiles.
+MAX_SAMPLES_PER_STAGE = 1000
+# How many recent invoices are kept in the per-invoice breakdown.
+MAX_INVOICE_RECORDS = 200
+
+
+class _ConsoleHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is at the time, just like print() does."""
+
+    def emit(self, record):
+        self.stream = sys.stdout
+        super().emit(record)
+
+
+logger = logging.getLogger("invoice_processor")
+if not logger.handlers:
+    _handler = _ConsoleHandler()
+    # Plain messages, so the console output looks the same as before.
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(getattr(logging, str(config.LOG_LEVEL).upper(), logging.INFO))
+    logger.propagate = False
+
+_lock = threading.Lock()
+# stage -> {"count", "sum", "max", "samples"}
+_stages = {}
+# (name, sorted label items) -> value
+_counters = {}
+_invoices = deque(maxlen=MAX_INVOICE_RECORDS)
+_current = threading.local()
+
+
+def _record_duration(stage, seconds):
+    with _lock:
+        stats = _stages.get(stage)
+        if stats is None:
+            stats = _stages[stage] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                      "samples": deque(maxlen=MAX_SAMPLES_PER_STAGE)}
+        stats["count"] += 1
+        stats["sum"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        stats["samples"].append(seconds)
+        invoice = getattr(_current, "invoice", None)
+        if invoice is not None:
+            invoice["stages"][stage] = round(invoice["stages"].get(stage, 0) + seconds, 4)
+
+
+@contextmanager
+def timed(stage):
+    """Measures the duration of the 'with' block as one sample of the given stage."""
+    if not config.METRICS_ENABLED:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_duration(stage, time.perf_counter() - started_at)
+
+
+class PhaseTimer:
+    """
+    Times the consecutive phases of one long function without nesting 'with'
+    blocks: each lap(phase) call ends the current phase and starts the next.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.started_at = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        if config.METRICS_ENABLED:
+            _record_duration(self.prefix + phase, now - self.started_at)
+        self.started_at = now
+
+
+def count(name, value=1, **labels):
+    """Adds 'value' to a counter (e.g. tokens, bytes, rows), optionally with labels."""
+    if not config.METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        invoice = getattr(_current, "invoice", None)
+        if invoice is not None:
+            invoice["counters"][name] = invoice["counters"].get(name, 0) + value
+
+
+@contextmanager
+def invoice_context(file_name):
+    """
+    Attributes every stage and counter recorded by this thread inside the
+    'with' block to one invoice, for the per-invoice breakdown.
+    """
+    if not config.METRICS_ENABLED:
+        yield
+        return
+    invoice = {"file": file_name, "stages": {}, "counters": {}}
+    _current.invoice = invoice
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current.invoice = None
+        invoice["total_seconds"] = round(time.perf_counter() - started_at, 4)
+        with _lock:
+            _invoices.append(invoice)
+
+
+def bind_to_invoice(func):
+    """
+    Wraps a function so that, when it runs on another thread (e.g. in a thread
+    pool), its stages still count towards the current thread's invoice.
+    """
+    invoice = getattr(_current, "invoice", None)
+
+    def run_for_invoice(*args, **kwargs):
+        _current.invoice = invoice
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.invoice = None
+    return run_for_invoice
+
+
+def _percentile(sorted_samples, percentile):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * percentile / 100))]
+
+
+def export_json():
+    """Returns all stages (count, total, average, p50, p95, p99, max), counters and recent invoices as a dictionary."""
+    with _lock:
+        stages = {}
+        for stage, stats in _stages.items():
+            samples = sorted(stats["samples"])
+            stages[stage] = {
+                "count": stats["count"],
+                "total_seconds": round(stats["sum"], 4),
+                "avg_seconds": round(stats["sum"] / stats["count"], 4),
+                "p50_seconds": round(_percentile(samples, 50), 4),
+                "p95_seconds": round(_percentile(samples, 95), 4),
+                "p99_seconds": round(_percentile(samples, 99), 4),
+                "max_seconds": round(stats["max"], 4),
+            }
+        counters = [{"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(_counters.items())]
+        return {"stages": stages, "counters": counters, "invoices": list(_invoices)}
+
+
+def export_prometheus():
+    """Returns the stage timings (as summaries) and counters in the Prometheus text format."""
+    lines = []
+    metrics = export_json()
+    if metrics["stages"]:
+        lines.append("# TYPE invoice_processor_stage_seconds summary")
+    for stage, stats in sorted(metrics["stages"].items()):
+        for quantile, key in (("0.5", "p50_seconds"), ("0.95", "p95_seconds"), ("0.99", "p99_seconds")):
+            lines.append(f'invoice_processor_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {stats[key]}')
+        lines.append(f'invoice_processor_stage_seconds_sum{{stage="{stage}"}} {stats["total_seconds"]}')
+        lines.append(f'invoice_processor_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+    declared = set()
+    for counter in metrics["counters"]:
+        name = f"invoice_processor_{counter['name']}_total"
+        if name not in declared:
+            lines.append(f"# TYPE {name} counter")
+            declared.add(name)
+        labels = ",".join(f'{key}="{value}"' for key, value in counter["labels"].items())
+        lines.append(f"{name}{{{labels}}} {counter['value']}" if labels else f"{name} {counter['value']}")
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics():
+    """Forgets every stage timing, counter and invoice recorded so far (e.g. between benchmark runs)."""
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _invoices.clear()
+
+
+def write_metrics(path=None):
+    """
+    Writes the metrics to config.METRICS_EXPORT_FILE (or 'path'): Prometheus
+    text format for a ".prom" file, JSON otherwise. Does nothing if no file is set.
+    """
+    path = path or config.METRICS_EXPORT_FILE
+    if not path or not config.METRICS_ENABLED:
+        return
+    if path.endswith(".prom"):
+        content = export_prometheus()
+    else:
+        content = json.dumps(export_json(), indent=2)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def stage_summary():
+    """A short human-readable line per stage, for the end of a batch run."""
+    return "\n".join(
+        f"  {stage:<20} {stats['count']:>5} x  avg {stats['avg_seconds']:.3f}s  "
+        f"p95 {stats['p95_seconds']:.3f}s  total {stats['total_seconds']:.1f}s"
+        for stage, stats in sorted(export_json()["stages"].items()))
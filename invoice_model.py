@@ -0,0 +1,253 @@
+# invoice_model.py
+# The one typed model of an invoice, shared by every step of the pipeline.
+#
+# The agents return amounts and dates as text in whatever format the invoice
+# used ("1.234,56 €", "484,10", "1,234.56", "16/08/25"). Invoice.from_dict()
+# parses them once into Decimal amounts and real dates, never raising on a
+# formatting slip; to_dict() writes them back in the one format we store in the
+# job journal and the sheet ("1234.56", "DD-MM-YYYY").
+#
+# INVOICE_JSON_SCHEMA describes the same fields for the model's structured output.
+
+import datetime
+import re
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from typing import List, Optional
+
+# Accepted date layouts: day first (Spanish) with '-', '/' or '.', or ISO.
+DATE_PATTERN = re.compile(r"^\s*(\d{1,2})[/.\-](\d{1,2})[/.\-](\d{4}|\d{2})\s*$")
+ISO_DATE_PATTERN = re.compile(r"^\s*(\d{4})-(\d{1,2})-(\d{1,2})")
+# Spanish tax IDs: company CIF (B12345678), personal NIF (12345678Z) and foreigner NIE (X1234567L),
+# optionally with an "ES" VAT prefix and a separator after the first character.
+TAX_ID_PATTERN = re.compile(
+    r"\b(?:ES)?([A-HJNP-SUVW][-\s]?\d{7}[0-9A-J]|\d{8}[-\s]?[A-Z]|[XYZ][-\s]?\d{7}[-\s]?[A-Z])\b")
+AMOUNT_FIELDS = ("total", "subtotal", "total_tax")
+
+_TEXT_OR_NULL = {"type": ["string", "null"]}
+_AMOUNT_OR_NULL = {"type": ["string", "null"], "description": "The amount as printed, e.g. \"1.234,56\"."}
+# The JSON schema for the model's structured output (strict mode: every field is
+# required, so a field that is not on the invoice comes back as null).
+INVOICE_PROPERTIES = {
+    "supplier": _TEXT_OR_NULL,
+    "supplier_nif": {"type": ["string", "null"], "description": "The supplier's NIF/CIF, e.g. \"B12345678\"."},
+    "date": {"type": ["string", "null"], "description": "The invoice date as DD-MM-YYYY."},
+    "invoice_id": _TEXT_OR_NULL,
+    "total": _AMOUNT_OR_NULL,
+    "subtotal": _AMOUNT_OR_NULL,
+    "total_tax": _AMOUNT_OR_NULL,
+    "iva_breakdown": {
+        "type": ["array", "null"],
+        "items": {
+            "type": "object",
+            "properties": {"base": _AMOUNT_OR_NULL, "cuota": _AMOUNT_OR_NULL},
+            "required": ["base", "cuota"],
+            "additionalProperties": False,
+        },
+    },
+}
+INVOICE_JSON_SCHEMA = {
+    "type": "object",
+    "properties": INVOICE_PROPERTIES,
+    "required": list(INVOICE_PROPERTIES),
+    "additionalProperties": False,
+}
+# A batched request returns several invoices, each with the key it was given.
+BATCHED_INVOICES_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "invoices": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"key": {"type": "string"}, **INVOICE_PROPERTIES},
+                "required": ["key", *INVOICE_PROPERTIES],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["invoices"],
+    "additionalProperties": False,
+}
+
+
+def normalize_amount(text):
+    """
+    Turns an amount as printed on a Spanish invoice ("1.234,56 €", "484,10",
+    "1,234.56", "-12.5") into a plain decimal string like "1234.56".
+    Returns None if the text does not contain a number.
+    """
+    # Digits with '.' or ',' separators, or a space before a group of exactly three digits ("1 234,56").
+    match = re.search(r"-?\d(?:[\d.,]|\s(?=\d{3}\b))*", str(text))
+    if not match:
+        return None
+    number = re.sub(r"\s", "", match.group()).rstrip(".,")
+
+    # The last separator is the decimal separator if 1 or 2 digits follow it
+    # (or 3 digits with no other separator, e.g. "1.234" is a thousand).
+    last_separator = max(number.rfind(","), number.rfind("."))
+    if last_separator != -1:
+        decimals = number[last_separator + 1:]
+        integer_part = re.sub(r"[.,]", "", number[:last_separator])
+        if len(decimals) in (1, 2) or (len(decimals) > 3 and number.count(number[last_separator]) == 1):
+            number = f"{integer_part}.{decimals}"
+        else:
+            number = integer_part + decimals
+    return number
+
+
+def parse_amount(value):
+    """
+    Turns an amount (text in any common format, or a number) into a Decimal.
+    Returns None if there is no amount in it.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return Decimal(str(value))
+    number = normalize_amount(value)
+    if number is None:
+        return None
+    try:
+        return Decimal(number)
+    except InvalidOperation:
+        return None
+
+
+def parse_date(value):
+    """Turns a date (DD-MM-YYYY, DD/MM/YY, YYYY-MM-DD...) into a date. Returns None if it is not a valid date."""
+    if isinstance(value, datetime.date):
+        return value
+    text = str(value or "")
+    match = DATE_PATTERN.match(text)
+    if match:
+        day, month, year = match.groups()
+    else:
+        match = ISO_DATE_PATTERN.match(text)
+        if not match:
+            return None
+        year, month, day = match.groups()
+    if len(year) == 2:
+        year = "20" + year
+    try:
+        return datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+
+
+def normalize_tax_id(value):
+    """
+    Turns a NIF/CIF as printed ("B-12345678", "es b12345678", "12.345.678-Z")
+    into its plain form ("B12345678"). Returns "" if it is not a valid tax ID.
+    """
+    text = re.sub(r"[-\s.]", "", str(value or "")).upper()
+    match = TAX_ID_PATTERN.fullmatch(text)
+    return match.group(1) if match else ""
+
+
+def format_amount(amount):
+    """The stored form of an amount: plain digits with two decimals, e.g. "1234.56"."""
+    return f"{amount:.2f}"
+
+
+def _text(value):
+    return str(value).strip() if value is not None else ""
+
+
+@dataclass
+class TaxLine:
+    """One line of the VAT breakdown."""
+    base: Optional[Decimal] = None
+    cuota: Optional[Decimal] = None
+
+
+@dataclass
+class Invoice:
+    """
+    An invoice with typed values. Amounts are Decimals and the date is a date
+    (None where the value is missing or could not be read). 'tax' is the
+    verified tax; when it could not be verified, 'tax_error' says why.
+    """
+    supplier: str = ""
+    supplier_nif: str = ""
+    date: Optional[datetime.date] = None
+    invoice_id: str = ""
+    total: Optional[Decimal] = None
+    subtotal: Optional[Decimal] = None
+    total_tax: Optional[Decimal] = None
+    iva_breakdown: List[TaxLine] = field(default_factory=list)
+    tax: Optional[Decimal] = None
+    tax_error: str = ""
+    filename: str = ""
+    # The original date text, kept when it could not be parsed so it is not lost.
+    date_text: str = ""
+    # Fields that were present but did not contain a readable amount.
+    unreadable_fields: List[str] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Builds an Invoice from an agent's (or a stored) dictionary. Never raises
+        on a badly formatted value: it is left empty and noted in 'unreadable_fields'.
+        """
+        invoice = cls(supplier=_text(data.get('supplier')), supplier_nif=normalize_tax_id(data.get('supplier_nif')),
+                      invoice_id=_text(data.get('invoice_id')), filename=_text(data.get('filename')))
+
+        invoice.date_text = _text(data.get('date'))
+        invoice.date = parse_date(invoice.date_text)
+
+        for name in AMOUNT_FIELDS:
+            setattr(invoice, name, invoice._read_amount(data, name))
+
+        breakdown = data.get('iva_breakdown')
+        if isinstance(breakdown, list):
+            for item in breakdown:
+                if isinstance(item, dict):
+                    invoice.iva_breakdown.append(TaxLine(invoice._read_amount(item, 'base', 'iva_breakdown'),
+                                                         invoice._read_amount(item, 'cuota', 'iva_breakdown')))
+                else:
+                    invoice.unreadable_fields.append('iva_breakdown')
+
+        tax = data.get('tax')
+        if isinstance(tax, str) and tax.startswith("ERROR"):
+            invoice.tax_error = tax
+        else:
+            invoice.tax = invoice._read_amount(data, 'tax')
+        return invoice
+
+    def _read_amount(self, data, name, field_name=None):
+        value = data.get(name)
+        if value is None or value == "":
+            return None
+        amount = parse_amount(value)
+        if amount is None:
+            self.unreadable_fields.append(field_name or name)
+        return amount
+
+    @property
+    def has_valid_total(self):
+        """The critical field check: the total is readable and greater than zero."""
+        return self.total is not None and self.total > 0
+
+    def date_string(self):
+        """The date as DD-MM-YYYY, or the original text if it could not be read."""
+        return self.date.strftime("%d-%m-%Y") if self.date else self.date_text
+
+    def tax_string(self):
+        if self.tax_error:
+            return self.tax_error
+        return format_amount(self.tax if self.tax is not None else Decimal(0))
+
+    def total_string(self):
+        return format_amount(self.total if self.total is not None else Decimal(0))
+
+    def to_dict(self):
+        """The cleaned dictionary we store in the job journal and write to the sheet."""
+        return {
+            'filename': self.filename,
+            'supplier': self.supplier,
+            'date': self.date_string(),
+            'invoice_id': self.invoice_id,
+            'tax': self.tax_string(),
+            'total': self.total_string(),
+        }
@@ -0,0 +1,169 @@
+# job_journal.py
+# A crash-safe journal of every invoice file we process.
+#
+# Each file (identified by the SHA-256 of its bytes) moves through the states
+# queued -> extracted -> written -> archived, and every transition is committed
+# to SQLite before we move on. After a crash or an API outage, a rerun picks
+# each file up from its last recorded state: extracted data is reused without
+# any API call (as long as it came from the same agents and prompt), and rows that already reached the sheet are never appended again
+# (the idempotency key is the file hash plus the invoice number).
+
+import json
+import sqlite3
+import threading
+import time
+
+import config
+
+QUEUED = "queued"
+EXTRACTED = "extracted"
+WRITTEN = "written"
+ARCHIVED = "archived"
+FAILED = "failed"
+
+_connection = None
+_lock = threading.Lock()
+
+
+def _get_connection():
+    """Opens the journal database on first use (caller must hold the lock)."""
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(config.JOB_JOURNAL_FILE, check_same_thread=False, timeout=30)
+        # WAL lets the watcher and a batch run use the journal at the same time.
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                file_hash TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                state TEXT NOT NULL,
+                data_json TEXT,
+                version TEXT,
+                idempotency_key TEXT,
+                error TEXT,
+                extracted_at REAL,
+                written_at REAL,
+                archived_at REAL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        # Journals written before the data was stamped with the agents' version.
+        columns = [row[1] for row in _connection.execute("PRAGMA table_info(jobs)")]
+        if "version" not in columns:
+            _connection.execute("ALTER TABLE jobs ADD COLUMN version TEXT")
+        _connection.execute("CREATE INDEX IF NOT EXISTS idx_jobs_idempotency_key ON jobs (idempotency_key)")
+        _connection.commit()
+    return _connection
+
+
+def make_idempotency_key(file_hash, invoice_id):
+    """The key that identifies an invoice row in the sheet: the file hash plus the invoice number."""
+    return f"{file_hash}:{invoice_id or ''}"
+
+
+def start_job(file_hash, filename, version):
+    """
+    Records that a file is about to be processed and returns its journal entry
+    as a dictionary ('state', 'data', 'written'). A new or previously failed
+    file starts (again) as queued; otherwise the recorded progress is kept.
+    'data' is None when it was extracted by another version of the agents.
+    """
+    with _lock:
+        connection = _get_connection()
+        row = connection.execute(
+            "SELECT state, data_json, written_at, version FROM jobs WHERE file_hash = ?", (file_hash,)).fetchone()
+        now = time.time()
+        if row is None or row[0] == FAILED:
+            connection.execute(
+                "INSERT OR REPLACE INTO jobs (file_hash, filename, state, updated_at) VALUES (?, ?, ?, ?)",
+                (file_hash, filename, QUEUED, now))
+            connection.commit()
+            return {"state": QUEUED, "data": None, "written": False}
+
+        connection.execute("UPDATE jobs SET filename = ?, updated_at = ? WHERE file_hash = ?",
+                           (filename, now, file_hash))
+        connection.commit()
+        data = json.loads(row[1]) if row[1] and row[3] == version else None
+        return {"state": row[0], "data": data, "written": row[2] is not None}
+
+
+def mark_extracted(file_hash, data_dict, version):
+    """
+    Stores the cleaned invoice data and the version of the agents that extracted
+    it, so a rerun never has to call the AI agents again. Data extracted again
+    (a new version, or a run without the cache) replaces the stored data until
+    the row is written.
+    """
+    with _lock:
+        connection = _get_connection()
+        now = time.time()
+        connection.execute(
+            "UPDATE jobs SET state = ?, data_json = ?, version = ?, idempotency_key = ?, extracted_at = ?, "
+            "updated_at = ? WHERE file_hash = ? AND state IN (?, ?) AND written_at IS NULL",
+            (EXTRACTED, json.dumps(data_dict), version, make_idempotency_key(file_hash, data_dict.get('invoice_id')),
+             now, now, file_hash, QUEUED, EXTRACTED))
+        connection.commit()
+
+
+def mark_written(idempotency_keys):
+    """
+    Records that these rows are now in the sheet. Used as the flush listener of
+    the invoice SheetsSession, so it runs right after a successful 'append_rows'.
+    """
+    if not idempotency_keys:
+        return
+    with _lock:
+        connection = _get_connection()
+        now = time.time()
+        connection.executemany(
+            "UPDATE jobs SET state = CASE WHEN archived_at IS NULL THEN ? ELSE ? END, written_at = ?, updated_at = ? "
+            "WHERE idempotency_key = ? AND written_at IS NULL",
+            [(WRITTEN, ARCHIVED, now, now, key) for key in idempotency_keys])
+        connection.commit()
+
+
+def mark_archived(file_hash):
+    """
+    Records that the file was moved to the archive. The state only becomes
+    'archived' once its row is written too (rows are written in batches, so the
+    file is often archived first).
+    """
+    with _lock:
+        connection = _get_connection()
+        now = time.time()
+        connection.execute(
+            "UPDATE jobs SET state = CASE WHEN written_at IS NULL THEN state ELSE ? END, archived_at = ?, "
+            "updated_at = ? WHERE file_hash = ?",
+            (ARCHIVED, now, now, file_hash))
+        connection.commit()
+
+
+def mark_failed(file_hash, error):
+    with _lock:
+        connection = _get_connection()
+        connection.execute("UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE file_hash = ?",
+                           (FAILED, error, time.time(), file_hash))
+        connection.commit()
+
+
+def is_written(idempotency_key):
+    """Returns True if the row with this key has already been written to the sheet."""
+    with _lock:
+        row = _get_connection().execute(
+            "SELECT 1 FROM jobs WHERE idempotency_key = ? AND written_at IS NOT NULL", (idempotency_key,)).fetchone()
+        return row is not None
+
+
+def get_unwritten_archived_jobs(archived_before=None):
+    """
+    Returns (idempotency_key, data_dict) for files that were archived but whose
+    row never reached the sheet (e.g. the process died before the final flush).
+    Pass 'archived_before' (a time.time() value) to leave out recent files whose
+    row may still be buffered by a running process.
+    """
+    with _lock:
+        rows = _get_connection().execute(
+            "SELECT idempotency_key, data_json FROM jobs "
+            "WHERE archived_at IS NOT NULL AND archived_at < ? AND written_at IS NULL AND data_json IS NOT NULL "
+            "ORDER BY archived_at", (archived_before or time.time(),)).fetchall()
+    return [(key, json.loads(data_json)) for key, data_json in rows]
@@ -0,0 +1,465 @@
+# ledger_store.py
+# The local ledger: every invoice and bank payment, in typed SQLite tables.
+#
+# Extraction writes new invoices here and reconciliation reads and updates both
+# ledgers here, at local-disk speed and whether or not the Google Sheets quota
+# has run out. The sheets are a mirror: the ledger sync in sheets_connector.py
+# appends the new rows and copies the changed cells over in bulk, and brings in
+# the rows people add to the sheets by hand (e.g. a pasted bank statement).
+#
+# Amounts are stored as whole cents (exact, and quick to compare) and dates as
+# ISO text; both come back as Decimals and dates. Each row remembers where it
+# is in its sheet ('sheet_row'), the text of its key columns there ('sheet_key',
+# to notice when the sheet was re-ordered) and whether the sheet still needs it
+# appended ('appended') or its cells updated ('changed').
+
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+from decimal import Decimal
+
+import config
+from instrumentation import count
+from invoice_model import Invoice, format_amount, parse_amount, parse_date
+
+INVOICES = "invoices"
+PAYMENTS = "payments"
+
+# The columns of the two sheets, in order.
+INVOICE_COLUMNS = ['Supplier Name', 'Invoice Date', 'Invoice Number', 'Tax', 'Total Amount', 'Paid On', 'Filename',
+                   'Match Percentage']
+BANK_COLUMNS = ['Date', 'Amount', 'Description', 'Matched Invoice ID', 'Matched Filename', 'Bank Details 1',
+                'Bank Details 2']
+# The columns that identify a row in its sheet (the same as reconciliation_state uses).
+INVOICE_KEY_COLUMNS = ['Invoice Number', 'Total Amount', 'Filename']
+BANK_KEY_COLUMNS = ['Date', 'Amount', 'Description']
+
+# Joins the invoice numbers (and filenames) of a payment that covers several invoices.
+GROUP_SEPARATOR = " + "
+
+# The columns fetch_invoices() and fetch_payments() return, in order.
+INVOICE_FIELDS = ["id", "supplier", "invoice_date", "date_note", "invoice_number", "tax", "tax_error", "total",
+                  "paid_on", "paid_note", "filename", "match_score"]
+PAYMENT_FIELDS = ["id", "payment_date", "amount", "description", "matched_invoice_number", "matched_filename",
+                  "details1", "details2"]
+
+_connection = None
+_lock = threading.Lock()
+
+sqlite3.register_converter("DATE", lambda value: datetime.date.fromisoformat(value.decode()))
+sqlite3.register_converter("CENTS", lambda value: Decimal(int(value)).scaleb(-2))
+
+
+def _get_connection():
+    """Opens the ledger database on first use (caller must hold the lock)."""
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(config.LEDGER_STORE_FILE, check_same_thread=False, timeout=30,
+                                      detect_types=sqlite3.PARSE_DECLTYPES)
+        # WAL lets the watcher, a batch run and the web app use the ledger at the same time.
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.executescript("""
+            CREATE TABLE IF NOT EXISTS invoices (
+                id INTEGER PRIMARY KEY,
+                supplier TEXT NOT NULL,
+                invoice_date DATE,
+                -- The date as written, when it is not a valid date (the same for 'paid_note').
+                date_note TEXT NOT NULL DEFAULT '',
+                invoice_number TEXT NOT NULL,
+                tax CENTS,
+                tax_error TEXT NOT NULL DEFAULT '',
+                total CENTS,
+                paid_on DATE,
+                paid_note TEXT NOT NULL DEFAULT '',
+                filename TEXT NOT NULL,
+                match_score TEXT NOT NULL DEFAULT '',
+                idempotency_key TEXT UNIQUE,
+                sheet_row INTEGER,
+                sheet_key TEXT NOT NULL,
+                appended INTEGER NOT NULL,
+                changed INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS payments (
+                id INTEGER PRIMARY KEY,
+                payment_date DATE,
+                amount CENTS,
+                description TEXT NOT NULL,
+                matched_invoice_number TEXT NOT NULL DEFAULT '',
+                matched_filename TEXT NOT NULL DEFAULT '',
+                details1 TEXT NOT NULL DEFAULT '',
+                details2 TEXT NOT NULL DEFAULT '',
+                -- Identifies a bank movement: see movement_key(). 'occurrence' tells identical movements apart.
+                movement_key TEXT NOT NULL,
+                occurrence INTEGER NOT NULL,
+                sheet_row INTEGER,
+                sheet_key TEXT NOT NULL,
+                appended INTEGER NOT NULL,
+                changed INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS sync_state (
+                name TEXT PRIMARY KEY,
+                state_json TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_invoices_unpaid ON invoices (id) WHERE paid_on IS NULL AND paid_note = '';
+            CREATE INDEX IF NOT EXISTS idx_invoices_sheet_row ON invoices (sheet_row);
+            CREATE INDEX IF NOT EXISTS idx_invoices_unsynced ON invoices (id) WHERE appended = 0 OR changed = 1;
+            CREATE INDEX IF NOT EXISTS idx_payments_unmatched ON payments (id) WHERE matched_invoice_number = '';
+            CREATE INDEX IF NOT EXISTS idx_payments_sheet_row ON payments (sheet_row);
+            CREATE INDEX IF NOT EXISTS idx_payments_unsynced ON payments (id) WHERE appended = 0 OR changed = 1;
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_movement ON payments (movement_key, occurrence);
+        """)
+        _connection.commit()
+    return _connection
+
+
+def use_ledger_file(path):
+    """Switches to another ledger file (e.g. a fresh one for tests and benchmarks)."""
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+        config.LEDGER_STORE_FILE = path
+
+
+def _cents(amount):
+    return None if amount is None else int((amount * 100).to_integral_value())
+
+
+def _iso(date):
+    return date.isoformat() if date else None
+
+
+def _sheet_date(date):
+    return date.strftime("%d-%m-%Y") if date else ""
+
+
+def _sheet_key(columns, key_columns, values):
+    """The text of a row's key columns, as in reconciliation_state's fingerprints."""
+    return "|".join(values[columns.index(column)] for column in key_columns)
+
+
+# --- INVOICES ---
+
+def _invoice_sheet_values(invoice):
+    """The cells of an invoice's row in the sheet ('invoice' is a dictionary of INVOICE_FIELDS)."""
+    tax, total = invoice["tax"], invoice["total"]
+    return [invoice["supplier"], invoice["date_note"] or _sheet_date(invoice["invoice_date"]),
+            invoice["invoice_number"], invoice["tax_error"] or format_amount(tax if tax is not None else Decimal(0)),
+            format_amount(total if total is not None else Decimal(0)),
+            invoice["paid_note"] or _sheet_date(invoice["paid_on"]), invoice["filename"], invoice["match_score"]]
+
+
+def add_invoice(data_dict, idempotency_key=None):
+    """
+    Stores a new invoice (a cleaned data dictionary), to be appended to the
+    sheet by the next sync. An invoice whose idempotency key is already stored
+    is ignored. Returns True if the invoice was added.
+    """
+    invoice = Invoice.from_dict(data_dict)
+    stored = {
+        "supplier": invoice.supplier, "invoice_date": invoice.date,
+        "date_note": "" if invoice.date else invoice.date_text, "invoice_number": invoice.invoice_id,
+        "tax": invoice.tax, "tax_error": invoice.tax_error,
+        "total": invoice.total if invoice.total is not None else Decimal(0), "paid_on": None, "paid_note": "",
+        "filename": invoice.filename or "NO_FILENAME_PASSED", "match_score": "",
+    }
+    sheet_key = _sheet_key(INVOICE_COLUMNS, INVOICE_KEY_COLUMNS, _invoice_sheet_values(stored))
+    stored.update(invoice_date=_iso(invoice.date), tax=_cents(stored["tax"]), total=_cents(stored["total"]))
+    with _lock:
+        connection = _get_connection()
+        cursor = connection.execute(
+            f"INSERT OR IGNORE INTO invoices ({', '.join(stored)}, idempotency_key, sheet_key, appended) "
+            f"VALUES ({', '.join('?' * len(stored))}, ?, ?, 0)",
+            (*stored.values(), idempotency_key, sheet_key))
+        connection.commit()
+    if cursor.rowcount:
+        count("ledger_rows_added", table=INVOICES)
+    return bool(cursor.rowcount)
+
+
+def _invoice_from_sheet(values):
+    """The stored columns of an invoice row read from the sheet (any common amount and date format)."""
+    supplier, date_text, invoice_number, tax_text, total_text, paid_text, filename, match_score = values[:8]
+    invoice_date = parse_date(date_text)
+    tax = parse_amount(tax_text)
+    paid_on = parse_date(paid_text)
+    return {
+        "supplier": supplier, "invoice_date": _iso(invoice_date),
+        "date_note": date_text.strip() if invoice_date is None else "", "invoice_number": invoice_number,
+        "tax": _cents(tax), "tax_error": tax_text if tax is None else "", "total": _cents(parse_amount(total_text)),
+        "paid_on": _iso(paid_on), "paid_note": paid_text.strip() if paid_on is None else "",
+        "filename": filename, "match_score": match_score,
+    }
+
+
+def fetch_invoices(unpaid_only=False):
+    """Returns the stored invoices as tuples of INVOICE_FIELDS, in sheet order (new invoices last)."""
+    query = f"SELECT {', '.join(INVOICE_FIELDS)} FROM invoices"
+    if unpaid_only:
+        query += " WHERE paid_on IS NULL AND paid_note = ''"
+    with _lock:
+        return _get_connection().execute(query + " ORDER BY sheet_row IS NULL, sheet_row, id").fetchall()
+
+
+# --- PAYMENTS ---
+
+def movement_key(payment_date, amount, description):
+    """
+    Identifies a bank movement by its date, amount and description (in any
+    spacing or case), so a movement that is already loaded is never loaded again.
+    """
+    text = f"{_iso(payment_date) or ''}|{_cents(amount)}|{' '.join(str(description).upper().split())}"
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def _payment_from_sheet(values):
+    """The stored columns of a payment row read from the bank sheet."""
+    date_text, amount_text, description, matched_invoice_number, matched_filename, details1, details2 = values[:7]
+    payment_date, amount = parse_date(date_text), parse_amount(amount_text)
+    return {
+        "payment_date": _iso(payment_date), "amount": _cents(amount),
+        "description": description, "matched_invoice_number": matched_invoice_number,
+        "matched_filename": matched_filename, "details1": details1, "details2": details2,
+        "movement_key": movement_key(payment_date, amount, description),
+    }
+
+
+def add_payments(movements):
+    """
+    Stores new bank movements, to be appended to the bank sheet by the next
+    sync. Takes (payment date, amount, description, details 1, details 2,
+    occurrence) tuples, where 'occurrence' numbers identical movements (1, 2...).
+    Movements that are already stored are skipped. Returns the number added.
+    """
+    rows = []
+    for payment_date, amount, description, details1, details2, occurrence in movements:
+        rows.append((_iso(payment_date), _cents(amount), description, details1, details2,
+                     movement_key(payment_date, amount, description), occurrence,
+                     _sheet_key(BANK_COLUMNS, BANK_KEY_COLUMNS,
+                                [_sheet_date(payment_date), format_amount(amount), description])))
+    with _lock:
+        connection = _get_connection()
+        changes_before = connection.total_changes
+        connection.executemany(
+            "INSERT OR IGNORE INTO payments (payment_date, amount, description, details1, details2, movement_key, "
+            "occurrence, sheet_key, appended) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)", rows)
+        added = connection.total_changes - changes_before
+        connection.commit()
+    if added:
+        count("ledger_rows_added", added, table=PAYMENTS)
+    return added
+
+
+def fetch_payments(unmatched_only=False):
+    """Returns the stored payments as tuples of PAYMENT_FIELDS, in sheet order (new payments last)."""
+    query = f"SELECT {', '.join(PAYMENT_FIELDS)} FROM payments"
+    if unmatched_only:
+        query += " WHERE matched_invoice_number = ''"
+    with _lock:
+        return _get_connection().execute(query + " ORDER BY sheet_row IS NULL, sheet_row, id").fetchall()
+
+
+# --- RECONCILIATION ---
+
+def record_matches(matches):
+    """
+    Stores the matches of a reconciliation run. Takes (invoice id, payment id,
+    payment date, match score) tuples; the changed cells are copied to the
+    sheets by the next sync.
+    """
+    with _lock:
+        connection = _get_connection()
+        for invoice_id, payment_id, payment_date, match_score in matches:
+            connection.execute(
+                "UPDATE invoices SET paid_on = ?, paid_note = '', match_score = ?, changed = 1 WHERE id = ?",
+                (_iso(payment_date), str(match_score), invoice_id))
+            connection.execute(
+                "UPDATE payments SET (matched_invoice_number, matched_filename) = "
+                "(SELECT invoice_number, filename FROM invoices WHERE id = ?), changed = 1 WHERE id = ?",
+                (invoice_id, payment_id))
+        connection.commit()
+
+
+def record_group_matches(groups):
+    """
+    Stores the split and combined payments of a reconciliation run. Takes
+    (invoice ids, payment ids, payment date, match score) tuples: every invoice
+    of a group is paid on that date, and every payment gets all of the group's
+    invoice numbers and filenames (joined with GROUP_SEPARATOR).
+    """
+    with _lock:
+        connection = _get_connection()
+        for invoice_ids, payment_ids, payment_date, match_score in groups:
+            connection.executemany(
+                "UPDATE invoices SET paid_on = ?, paid_note = '', match_score = ?, changed = 1 WHERE id = ?",
+                [(_iso(payment_date), str(match_score), invoice_id) for invoice_id in invoice_ids])
+            invoices = [connection.execute("SELECT invoice_number, filename FROM invoices WHERE id = ?",
+                                           (invoice_id,)).fetchone() for invoice_id in invoice_ids]
+            connection.executemany(
+                "UPDATE payments SET matched_invoice_number = ?, matched_filename = ?, changed = 1 WHERE id = ?",
+                [(GROUP_SEPARATOR.join(number for number, _ in invoices),
+                  GROUP_SEPARATOR.join(filename for _, filename in invoices), payment_id)
+                 for payment_id in payment_ids])
+        connection.commit()
+
+
+# --- MIRRORING (used by the ledger sync in sheets_connector.py) ---
+
+_TABLES = {
+    INVOICES: (INVOICE_COLUMNS, INVOICE_KEY_COLUMNS, _invoice_from_sheet),
+    PAYMENTS: (BANK_COLUMNS, BANK_KEY_COLUMNS, _payment_from_sheet),
+}
+
+
+def sheet_values(table, row):
+    """The cells in the sheet of a stored row (a tuple of INVOICE_FIELDS or PAYMENT_FIELDS)."""
+    if table == INVOICES:
+        return _invoice_sheet_values(dict(zip(INVOICE_FIELDS, row)))
+    _, payment_date, amount, *texts = row
+    return [_sheet_date(payment_date), format_amount(amount) if amount is not None else ""] + list(texts)
+
+
+def sheet_key(table, values):
+    """The text of the key columns of a row in a sheet, as stored in 'sheet_key'."""
+    columns, key_columns, _ = _TABLES[table]
+    return _sheet_key(columns, key_columns, values)
+
+
+def rows_to_append(table):
+    """Returns the (id, sheet values) pairs of the rows that are not in the sheet yet, oldest first."""
+    fields = INVOICE_FIELDS if table == INVOICES else PAYMENT_FIELDS
+    with _lock:
+        rows = _get_connection().execute(
+            f"SELECT {', '.join(fields)} FROM {table} WHERE appended = 0 ORDER BY id").fetchall()
+    return [(row[0], sheet_values(table, row)) for row in rows]
+
+
+def mark_appended(table, ids, first_sheet_row=None):
+    """
+    Records that these rows were appended to the sheet, in this order, from
+    'first_sheet_row' on (None if the sheet did not say where they went; the
+    next pull then finds them by their key columns).
+    """
+    with _lock:
+        connection = _get_connection()
+        for offset, row_id in enumerate(ids):
+            connection.execute(f"UPDATE {table} SET appended = 1, sheet_row = ? WHERE id = ?",
+                               (first_sheet_row + offset if first_sheet_row else None, row_id))
+        connection.commit()
+
+
+def changed_rows(table):
+    """Returns (id, sheet_row, sheet_key, sheet values) for the rows whose changed cells the sheet still needs."""
+    fields = INVOICE_FIELDS if table == INVOICES else PAYMENT_FIELDS
+    with _lock:
+        rows = _get_connection().execute(
+            f"SELECT sheet_row, sheet_key, {', '.join(fields)} FROM {table} "
+            f"WHERE changed = 1 AND appended = 1 AND sheet_row IS NOT NULL ORDER BY sheet_row").fetchall()
+    return [(row[2], row[0], row[1], sheet_values(table, row[2:])) for row in rows]
+
+
+def mark_unchanged(table, ids):
+    """Records that the sheet has the changed cells of these rows."""
+    with _lock:
+        connection = _get_connection()
+        connection.executemany(f"UPDATE {table} SET changed = 0 WHERE id = ?", [(row_id,) for row_id in ids])
+        connection.commit()
+
+
+def open_sheet_rows(table):
+    """
+    Returns {sheet row number (as text): sheet key} for the placed rows that are
+    still unpaid (invoices) or unmatched (payments), in the form of
+    reconciliation_state's 'unmatched' fingerprints: these are the rows people
+    edit by hand ('Paid On', 'Matched Invoice ID'), so every pull reads them again.
+    """
+    open_condition = "paid_on IS NULL AND paid_note = ''" if table == INVOICES else "matched_invoice_number = ''"
+    with _lock:
+        rows = _get_connection().execute(
+            f"SELECT sheet_row, sheet_key FROM {table} WHERE {open_condition} AND sheet_row IS NOT NULL").fetchall()
+    return {str(sheet_row): sheet_key for sheet_row, sheet_key in rows}
+
+
+def merge_sheet_rows(table, rows, full=False):
+    """
+    Brings rows read from a sheet into the store. Takes (sheet row number,
+    values) pairs. A row the store already has at that position is updated
+    from the sheet (unless it has changes of its own the sheet does not have
+    yet); a row we appended without knowing where it went is recognised by its
+    key columns; anything else is a new row added in the sheet.
+    With full=True the rows are the whole sheet, and every stored row is placed
+    again by its key columns (in case the sheet was sorted or rows were deleted).
+    Returns the number of new rows, or None (changing nothing) if the rows do not
+    line up with the store, so the caller should merge the whole sheet instead.
+    """
+    columns, key_columns, from_sheet = _TABLES[table]
+    rows = [(sheet_row, (list(values) + [""] * len(columns))[:len(columns)]) for sheet_row, values in rows]
+    added = 0
+    with _lock:
+        connection = _get_connection()
+        if full:
+            connection.execute(f"UPDATE {table} SET sheet_row = NULL WHERE appended = 1")
+        else:
+            for sheet_row, values in rows:
+                placed = connection.execute(
+                    f"SELECT sheet_key FROM {table} WHERE sheet_row = ?", (sheet_row,)).fetchone()
+                if placed and placed[0] != _sheet_key(columns, key_columns, values):
+                    return None
+        # Appended rows whose position is unknown, by key: [ids, oldest first].
+        unplaced = {}
+        for row_id, sheet_key in connection.execute(
+                f"SELECT id, sheet_key FROM {table} WHERE appended = 1 AND sheet_row IS NULL ORDER BY id"):
+            unplaced.setdefault(sheet_key, []).append(row_id)
+
+        for sheet_row, values in rows:
+            sheet_key = _sheet_key(columns, key_columns, values)
+            stored = from_sheet(values)
+            existing = connection.execute(f"SELECT id FROM {table} WHERE sheet_row = ?", (sheet_row,)).fetchone()
+            if existing:
+                row_id = existing[0]
+            elif unplaced.get(sheet_key):
+                row_id = unplaced[sheet_key].pop(0)
+                connection.execute(f"UPDATE {table} SET sheet_row = ? WHERE id = ?", (sheet_row, row_id))
+            elif table == PAYMENTS:
+                # A movement that is already stored (e.g. pasted after it was imported) counts as another one.
+                connection.execute(
+                    f"INSERT INTO payments ({', '.join(stored)}, occurrence, sheet_row, sheet_key, appended) "
+                    f"VALUES ({', '.join('?' * len(stored))}, "
+                    f"(SELECT COALESCE(MAX(occurrence), 0) + 1 FROM payments WHERE movement_key = ?), ?, ?, 1)",
+                    (*stored.values(), stored["movement_key"], sheet_row, sheet_key))
+                added += 1
+                continue
+            else:
+                connection.execute(
+                    f"INSERT INTO {table} ({', '.join(stored)}, sheet_row, sheet_key, appended) "
+                    f"VALUES ({', '.join('?' * len(stored))}, ?, ?, 1)",
+                    (*stored.values(), sheet_row, sheet_key))
+                added += 1
+                continue
+            # Cells edited by hand in the sheet win, unless we have changes the sheet does not have yet.
+            # A payment keeps the movement key it was loaded with, so the movement is never loaded again.
+            stored.pop("movement_key", None)
+            connection.execute(
+                f"UPDATE {table} SET {', '.join(f'{name} = ?' for name in stored)} WHERE id = ? AND changed = 0",
+                (*stored.values(), row_id))
+        connection.commit()
+    if added:
+        count("ledger_rows_added", added, table=table)
+    return added
+
+
+def load_sync_state(name):
+    """The saved sync state of one sheet (a dictionary), or None."""
+    with _lock:
+        row = _get_connection().execute("SELECT state_json FROM sync_state WHERE name = ?", (name,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def save_sync_state(name, state):
+    with _lock:
+        connection = _get_connection()
+        connection.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)", (name, json.dumps(state)))
+        connection.commit()
@@ -1,72 +1,440 @@
+import argparse
 import shutil
 import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import config
+import job_journal
+import render_pool
 
-from core_processing import process_single_invoice
-from correlator import reconcile_sheets
+from core_processing import process_single_invoice, get_hedge_stats, prefetch_primary_results
+from extraction_cache import compute_file_hash, get_cache_stats
+from instrumentation import logger, stage_summary, write_metrics
+from provider_limits import get_provider_status
+from sheets_connector import append_to_sheet, flush_sheet
 
 # --- DEFINE FOLDERS USING THE CONFIG ---
-ARCHIVE_FOLDER = os.path.join(config.INVOICE_FOLDER, "archive")
-FAILED_FOLDER = os.path.join(config.INVOICE_FOLDER, "failed")
+ARCHIVE_FOLDER = config.ARCHIVE_FOLDER
+FAILED_FOLDER = config.FAILED_FOLDER
+PROCESSING_FOLDER = config.PROCESSING_FOLDER
 # -----------------------------------------
 
+# A running batch touches this file in its processing folder every interval; a
+# folder whose heartbeat is older than ABANDONED_AFTER_SECONDS belongs to a run that died.
+HEARTBEAT_FILE = ".heartbeat"
+HEARTBEAT_INTERVAL_SECONDS = 30
+ABANDONED_AFTER_SECONDS = 300
+
+# Only these files are invoices, for the batch run, the folder watcher and the upload form alike.
+# Browsers and copy tools write to other names (".part", ".crdownload") first.
+INVOICE_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg")
+
+
+def is_invoice_file(filename):
+    """True for an invoice file name; hidden files and Office lock files ("~$...") never are."""
+    return filename.lower().endswith(INVOICE_EXTENSIONS) and not filename.startswith((".", "~$"))
+
+
+class RunFolder:
+    """
+    A run's private processing folder (see _claim_file), used as a context
+    manager that returns the folder's path. While it is open, a heartbeat file
+    inside it is kept fresh, so other runs know it is still alive.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(PROCESSING_FOLDER, uuid.uuid4().hex)
+        self._heartbeat_path = os.path.join(self.path, HEARTBEAT_FILE)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _touch(self):
+        with open(self._heartbeat_path, "a"):
+            pass
+        os.utime(self._heartbeat_path)
+
+    def _beat(self):
+        while not self._stop_event.wait(HEARTBEAT_INTERVAL_SECONDS):
+            self._touch()
+
+    def __enter__(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._touch()
+        self._thread.start()
+        return self.path
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop_event.set()
+        self._thread.join()
+        os.remove(self._heartbeat_path)
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            logger.warning("  --> Processing folder '%s' is not empty and was left in place.", self.path)
+
+
+def _recover_abandoned_files():
+    """
+    Moves the files left in the processing folder of a run that died (no
+    heartbeat for ABANDONED_AFTER_SECONDS) back into the invoice folder, so
+    they are claimed again. Returns the number of files recovered.
+    """
+    if not os.path.isdir(PROCESSING_FOLDER):
+        return 0
+    recovered_files = 0
+    for run_name in os.listdir(PROCESSING_FOLDER):
+        run_folder = os.path.join(PROCESSING_FOLDER, run_name)
+        if not os.path.isdir(run_folder):
+            continue
+        heartbeat_path = os.path.join(run_folder, HEARTBEAT_FILE)
+        last_beat = os.path.getmtime(heartbeat_path if os.path.exists(heartbeat_path) else run_folder)
+        if time.time() - last_beat < ABANDONED_AFTER_SECONDS:
+            continue
+        for filename in os.listdir(run_folder):
+            if filename == HEARTBEAT_FILE:
+                continue
+            try:
+                _move_without_overwrite(os.path.join(run_folder, filename), config.INVOICE_FOLDER, filename)
+                recovered_files += 1
+            except FileNotFoundError:
+                # Another run is recovering the same folder.
+                pass
+        shutil.rmtree(run_folder, ignore_errors=True)
+    if recovered_files:
+        logger.info("Recovered %d file(s) from an interrupted run.", recovered_files)
+    return recovered_files
+
+
+def recover_interrupted_work():
+    """
+    Picks up where an interrupted run stopped: files it had claimed go back
+    into the invoice folder, and rows of archived invoices that never reached
+    the sheet are queued again (the job journal keeps their data).
+    """
+    _recover_abandoned_files()
+    unwritten_jobs = job_journal.get_unwritten_archived_jobs(archived_before=time.time() - ABANDONED_AFTER_SECONDS)
+    for idempotency_key, data_dict in unwritten_jobs:
+        append_to_sheet(data_dict, idempotency_key)
+    if unwritten_jobs:
+        logger.info("Queued %d row(s) from an interrupted run for Google Sheets.", len(unwritten_jobs))
+
+
+def _claim_file(filename, run_folder):
+    """
+    Moves a file from the invoice folder into this run's private processing folder.
+    The rename is atomic, so if another run got there first we simply skip the file.
+    Returns the new path, or None if the file was already claimed.
+    """
+    source_path = os.path.join(config.INVOICE_FOLDER, filename)
+    claimed_path = os.path.join(run_folder, filename)
+    try:
+        os.rename(source_path, claimed_path)
+        return claimed_path
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+def _unique_destination_path(destination_folder, filename, counter=0):
+    """The destination path for a file, with a numeric suffix from 'counter' onwards (e.g. "name (2).pdf")."""
+    if counter == 0:
+        return os.path.join(destination_folder, filename)
+    name, extension = os.path.splitext(filename)
+    return os.path.join(destination_folder, f"{name} ({counter}){extension}")
+
+
+def _move_without_overwrite(source_path, destination_folder, filename):
+    """
+    Moves a file into the destination folder. If a file with the same name is
+    already there (e.g. a re-upload), a numeric suffix is added instead of overwriting it.
+    The new name is taken in one step (a hard link, or else an empty placeholder
+    created with "x"), so parallel workers never pick the same name.
+    """
+    counter = 0
+    while True:
+        destination_path = _unique_destination_path(destination_folder, filename, counter)
+        try:
+            os.link(source_path, destination_path)
+        except FileExistsError:
+            counter += 1
+            continue
+        except FileNotFoundError:
+            raise
+        except OSError:
+            # No hard links here (e.g. another file system): reserve the name with a placeholder instead.
+            try:
+                open(destination_path, "xb").close()
+            except FileExistsError:
+                counter += 1
+                continue
+            try:
+                shutil.move(source_path, destination_path)
+            except BaseException:
+                os.remove(destination_path)
+                raise
+            return destination_path
+        os.remove(source_path)
+        return destination_path
+
+
+def _write_without_overwrite(file_content, destination_folder, filename):
+    """
+    Writes in-memory file content into the destination folder, adding a numeric
+    suffix like _move_without_overwrite(). The "x" mode makes the name check
+    and the file creation one step, so parallel workers never overwrite each other.
+    """
+    counter = 0
+    while True:
+        destination_path = _unique_destination_path(destination_folder, filename, counter)
+        try:
+            with open(destination_path, "xb") as f:
+                f.write(file_content)
+            return destination_path
+        except FileExistsError:
+            counter += 1
+
+
+def _process_claimed_file(filename, claimed_path, hedged=False, ahead_hash=None):
+    """
+    Runs the core processing for one claimed file and moves it to the
+    archive or failed folder. 'ahead_hash' is the hash _render_ahead() returned
+    for the file, if its render was started ahead. Returns True if the invoice
+    was processed successfully.
+    """
+    logger.info("--- Processing: %s ---", filename)
+    try:
+        # Read the file's content into memory (bytes)
+        with open(claimed_path, "rb") as f:
+            file_content = f.read()
+
+        # Call our central processing function
+        if process_single_invoice(file_content, filename, hedged=hedged):
+            # If successful, move the file to the archive
+            destination_path = _move_without_overwrite(claimed_path, ARCHIVE_FOLDER, filename)
+            job_journal.mark_archived(compute_file_hash(file_content))
+            logger.info("  --> Batch success. Moved to archive: %s", destination_path)
+            return True
+        else:
+            # If it fails, move to the failed folder
+            destination_path = _move_without_overwrite(claimed_path, FAILED_FOLDER, filename)
+            logger.warning("  --> Batch failure. Moved to failed folder: %s", destination_path)
+            return False
+
+    except Exception as e:
+        logger.error("  --> A critical error occurred while processing %s: %s", filename, e)
+        if os.path.exists(claimed_path):
+            _move_without_overwrite(claimed_path, FAILED_FOLDER, filename)
+        return False
+    finally:
+        # Frees the slot of a render started ahead that was not needed (e.g. a cached invoice,
+        # or a file that could not be read).
+        if ahead_hash:
+            render_pool.release_ahead(ahead_hash)
+
+
+def _prefetch_claimed_files(claimed_files, use_batch_api):
+    """Extracts a chunk of claimed files with batched requests (see core_processing.prefetch_primary_results)."""
+    invoices = []
+    for filename, claimed_path in claimed_files:
+        with open(claimed_path, "rb") as f:
+            invoices.append((f.read(), filename))
+    try:
+        prefetch_primary_results(invoices, use_batch_api=use_batch_api)
+    except Exception as e:
+        logger.warning("  --> Batched extraction failed (%s). These files are extracted one by one.", e)
+
+
+def _render_ahead(filename, claimed_path):
+    """
+    Starts rendering a PDF in the render processes before a worker picks it up
+    (see render_pool.render_ahead). Waits while too many renders are waiting.
+    Returns the file's hash if the render was started, None otherwise.
+    """
+    if not filename.lower().endswith(".pdf") or not config.RENDER_IN_SEPARATE_PROCESSES:
+        return None
+    try:
+        with open(claimed_path, "rb") as f:
+            return render_pool.render_ahead(f.read())
+    except OSError as e:
+        logger.warning("  --> Could not read %s to render it ahead (%s).", filename, e)
+        return None
+
+
 #process_all_invoices() Function to loop trough and process all invoice files
-def process_all_invoices():
+def process_all_invoices(max_workers=None, hedged=False, batched=False, use_batch_api=False):
     """
     Scans the invoice folder and runs the core processing logic for each file.
-    This is now just a "batch runner" for our core processing function.
+    Up to 'max_workers' invoices (default: config.MAX_CONCURRENT_INVOICES) are
+    processed at the same time; calls to each provider are additionally capped
+    by config.PROVIDER_CONCURRENCY_LIMITS. With hedged=True both AI agents may
+    run at once for an invoice (see core_processing.process_single_invoice).
+
+    For backfills, batched=True sends several invoices per GPT-4o request, and
+    use_batch_api=True sends those requests through OpenAI's Batch API. Files
+    are pre-extracted in chunks of config.BATCH_CHUNK_FILES while the previous
+    chunk is being processed. Otherwise, scanned PDFs start rendering in the
+    render processes as they are handed to the workers (see render_pool).
     """
-    print(f"Starting batch processing in folder: {config.INVOICE_FOLDER}")
-    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
-    os.makedirs(FAILED_FOLDER, exist_ok=True)
+    if max_workers is None:
+        max_workers = config.MAX_CONCURRENT_INVOICES
 
+    logger.info("Starting batch processing in folder: %s", config.INVOICE_FOLDER)
     if not os.path.exists(config.INVOICE_FOLDER):
-        print(f"Error: The folder '{config.INVOICE_FOLDER}' was not found.")
+        logger.error("The folder '%s' was not found.", config.INVOICE_FOLDER)
         return
 
-    files_in_folder = os.listdir(config.INVOICE_FOLDER)
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+    os.makedirs(FAILED_FOLDER, exist_ok=True)
+
+    recover_interrupted_work()
+
     successful_files = 0
     failed_files = 0
+    # Every run gets its own processing folder, so overlapping runs never collide.
+    with RunFolder() as run_folder:
+        claimed_files = []
+        for filename in os.listdir(config.INVOICE_FOLDER):
+            if is_invoice_file(filename) and os.path.isfile(os.path.join(config.INVOICE_FOLDER, filename)):
+                claimed_path = _claim_file(filename, run_folder)
+                if claimed_path:
+                    claimed_files.append((filename, claimed_path))
 
-    for filename in files_in_folder:
-        full_file_path = os.path.join(config.INVOICE_FOLDER, filename)
-        if os.path.isfile(full_file_path):
-            print(f"\n--- Processing: {filename} ---")
+        logger.info("Claimed %d file(s). Processing with up to %d worker(s).", len(claimed_files), max_workers)
 
-            try:
-                # Read the file's content into memory (bytes)
-                with open(full_file_path, "rb") as f:
-                    file_content = f.read()
-
-                # Call our new, central processing function
-                if process_single_invoice(file_content, filename):
-                    # If successful, move the file to the archive
-                    destination_path = os.path.join(ARCHIVE_FOLDER, filename)
-                    print(f"  --> Batch success. Moving to archive: {destination_path}")
-                    shutil.move(full_file_path, destination_path)
+        batched = batched or use_batch_api
+        chunk_size = max(1, config.BATCH_CHUNK_FILES) if batched else max(1, len(claimed_files))
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = []
+            for chunk_start in range(0, len(claimed_files), chunk_size):
+                chunk = claimed_files[chunk_start:chunk_start + chunk_size]
+                if batched:
+                    _prefetch_claimed_files(chunk, use_batch_api)
+                for filename, claimed_path in chunk:
+                    ahead_hash = None if batched else _render_ahead(filename, claimed_path)
+                    futures.append(executor.submit(_process_claimed_file, filename, claimed_path, hedged,
+                                                   ahead_hash))
+            for future in as_completed(futures):
+                if future.result():
                     successful_files += 1
                 else:
-                    # If it fails, move to the failed folder
-                    destination_path = os.path.join(FAILED_FOLDER, filename)
-                    print(f"  --> Batch failure. Moving to failed folder: {destination_path}")
-                    shutil.move(full_file_path, destination_path)
                     failed_files += 1
+    # Every worker is done: stop the render processes (the next run starts them again).
+    render_pool.shutdown()
 
-            except Exception as e:
-                print(f"  --> A critical error occurred while processing {filename}: {e}")
-                destination_path = os.path.join(FAILED_FOLDER, filename)
-                shutil.move(full_file_path, destination_path)
-                failed_files += 1
+    # Write any rows still buffered for the invoice sheet.
+    flush_sheet()
 
     print("\n--- Batch processing complete! ---")
     print(f"Successfully processed: {successful_files} file(s).")
     print(f"Failed to process: {failed_files} file(s).")
+    cache_stats = get_cache_stats()
+    print(f"Extraction cache: {cache_stats['hits']} hit(s), {cache_stats['misses']} miss(es).")
+    for provider, status in get_provider_status().items():
+        print(f"{provider}: {status['calls']} call(s), {status['retries']} retried, "
+              f"{status['rate_limited']} rate-limited, circuit {status['circuit']}.")
+    if hedged:
+        hedge_stats = get_hedge_stats()
+        print(f"Hedged extraction: primary won {hedge_stats['primary_wins']}, "
+              f"specialist won {hedge_stats['specialist_wins']}, no valid result {hedge_stats['no_valid_result']}.")
+    if stage_summary():
+        print("Time per stage:")
+        print(stage_summary())
+    write_metrics()
+
+def _process_upload(upload_index, uploaded_file, events, hedged):
+    """
+    Processes one uploaded file straight from memory, then stores its bytes in
+    the archive or failed folder. Reports its progress as events on the queue.
+    """
+    filename = uploaded_file.name
+    events.put({"index": upload_index, "file": filename, "status": "processing"})
+    started_at = time.monotonic()
+    file_content = None
+    clean_data_dict = None
+    destination_path = None
+    logger.info("--- Processing upload: %s ---", filename)
+    try:
+        # Read the bytes only now, so at most one copy per worker is held besides the upload itself.
+        file_content = uploaded_file.getvalue()
+        clean_data_dict = process_single_invoice(file_content, filename, hedged=hedged)
+        destination_folder = ARCHIVE_FOLDER if clean_data_dict else FAILED_FOLDER
+        destination_path = _write_without_overwrite(file_content, destination_folder, filename)
+        if clean_data_dict:
+            job_journal.mark_archived(compute_file_hash(file_content))
+        if clean_data_dict:
+            logger.info("  --> Upload success. Saved to: %s", destination_path)
+        else:
+            logger.warning("  --> Upload failure. Saved to: %s", destination_path)
+    except Exception as e:
+        logger.error("  --> A critical error occurred while processing %s: %s", filename, e)
+        if file_content is not None and destination_path is None:
+            # Keep the upload, as process_all_invoices() keeps a file that failed.
+            try:
+                destination_path = _write_without_overwrite(file_content, FAILED_FOLDER, filename)
+                logger.warning("  --> Saved to: %s", destination_path)
+            except OSError as write_error:
+                logger.error("  --> Could not save %s to the failed folder: %s", filename, write_error)
+    events.put({
+        "index": upload_index,
+        "file": filename,
+        "status": "success" if clean_data_dict else "failed",
+        "seconds": round(time.monotonic() - started_at, 1),
+        "supplier": clean_data_dict.get('supplier') if clean_data_dict else None,
+        "total": clean_data_dict.get('total') if clean_data_dict else None,
+        "saved_to": destination_path,
+    })
+
+
+def process_uploaded_invoices(uploaded_files, max_workers=None, hedged=False):
+    """
+    Processes uploaded files (objects with a 'name' and a 'getvalue()' method,
+    like Streamlit's UploadedFile) without saving them to the invoice folder first.
+
+    This is a generator: it yields an event dictionary ('index' is the file's
+    position in 'uploaded_files') whenever a file starts ("processing") or finishes ("success" / "failed", with 'seconds', 'supplier'
+    and 'total'), so the caller can show live progress. Buffered sheet rows are
+    flushed before it finishes.
+    """
+    if max_workers is None:
+        max_workers = config.MAX_CONCURRENT_INVOICES
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+    os.makedirs(FAILED_FOLDER, exist_ok=True)
+
+    events = queue.Queue()
+    finished_files = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for upload_index, uploaded_file in enumerate(uploaded_files):
+            executor.submit(_process_upload, upload_index, uploaded_file, events, hedged)
+        while finished_files < len(uploaded_files):
+            event = events.get()
+            if event["status"] != "processing":
+                finished_files += 1
+            yield event
+
+    # Write any rows still buffered for the invoice sheet.
+    flush_sheet()
+
 
 # This special block is the entry point of our application.
 if __name__ == "__main__":
-    process_all_invoices()
+    parser = argparse.ArgumentParser(description="Processes every invoice in the invoice folder, then reconciles.")
+    parser.add_argument("--batched", action="store_true",
+                        help="send several invoices per GPT-4o request (for backfills)")
+    parser.add_argument("--batch-api", action="store_true",
+                        help="send the batched requests through OpenAI's Batch API and wait for the results")
+    args = parser.parse_args()
+
+    process_all_invoices(batched=args.batched, use_batch_api=args.batch_api)
  # After processing, run the correlation to get an updated payment report.
     print("\n======================================")
     print("Starting correlation of all records...")
+    # Imported only here: reconciliation needs pandas, which processing invoices never loads.
+    from correlator import reconcile_sheets
     reconcile_sheets()
-    print("======================================")
\ No newline at end of file
+    # With the ledger store, the matches are only in the sheets after a sync.
+    flush_sheet()
+    write_metrics()
+    print("======================================")
@@ -0,0 +1,409 @@
+# matching_engine.py
+# The indexed matcher used by correlator.reconcile_sheets().
+#
+# Instead of filtering the whole payments table for every invoice, payments are
+# grouped once into buckets by amount (in integer cents). Each bucket is sorted
+# by date, so the "payment is not too early" check is a binary search, and the
+# (expensive) fuzzy name scoring only runs on the payments that survive it.
+# Payments whose description is a known bank alias of the supplier (see
+# supplier_directory.py) are matched without any scoring at all.
+#
+# find_group_matches() then looks among the invoices and payments left over for
+# an invoice paid in instalments, or one payment covering several invoices of
+# the same supplier (see "SPLIT AND COMBINED PAYMENTS" below).
+
+from bisect import bisect_left, bisect_right
+
+import pandas as pd
+
+from instrumentation import count
+from name_scoring import NameScorer
+from supplier_directory import bank_alias
+
+# --- SCORING LOGIC ---
+# These variables define the score to assign upon a successful match.
+PRIMARY_MATCH_SCORE = 100
+SECONDARY_MATCH_SCORE = 85
+# Invoices paid in instalments, or together with other invoices in one payment.
+GROUP_MATCH_SCORE = 70
+
+
+def to_cents(amounts):
+    """Converts a Series of float amounts to integer cents."""
+    return (amounts * 100).round().astype("int64")
+
+
+def _to_int_dates(dates):
+    """Converts a Series of datetimes to int64 nanoseconds, for fast comparisons."""
+    return dates.to_numpy(dtype="datetime64[ns]").astype("int64")
+
+
+class PaymentIndex:
+    """
+    An amount-bucketed index over the available bank payments.
+
+    Payments are referred to by their position in the original DataFrame, so
+    candidates can always be checked in the original (sheet) order.
+    """
+
+    def __init__(self, payments_df, scorer):
+        self.scorer = scorer
+        self.labels = list(payments_df.index)
+        self.raw_descriptions = payments_df['Description'].astype(str).str.lower().tolist()
+        self.descriptions = [scorer.normalize(description) for description in self.raw_descriptions]
+        self.details1 = self._lowered_column(payments_df, 'Bank Details 1')
+        self.details2 = self._lowered_column(payments_df, 'Bank Details 2')
+        self._combined_details = {}
+        self._bank_aliases = {}
+        self.dates = _to_int_dates(payments_df['Date']).tolist()
+        self.used = [False] * len(self.labels)
+        self.cents = to_cents(payments_df['Amount']).tolist()
+
+        # Build the buckets: cents -> (sorted dates, positions in the same order)
+        buckets = {}
+        for position, cents in enumerate(self.cents):
+            buckets.setdefault(cents, []).append((self.dates[position], position))
+        self._buckets = {}
+        for cents, entries in buckets.items():
+            entries.sort()
+            self._buckets[cents] = ([date for date, _ in entries], [position for _, position in entries])
+
+    @staticmethod
+    def _lowered_column(payments_df, column):
+        if column not in payments_df.columns:
+            return [''] * len(payments_df)
+        return payments_df[column].astype(str).str.lower().tolist()
+
+    def candidates(self, cents, cutoff_date):
+        """
+        Returns the positions of unused payments with exactly this amount whose
+        date is on or after 'cutoff_date', in the original sheet order.
+        """
+        bucket = self._buckets.get(cents)
+        if bucket is None:
+            return []
+        bucket_dates, bucket_positions = bucket
+        first_valid = bisect_left(bucket_dates, cutoff_date)
+        return sorted(position for position in bucket_positions[first_valid:] if not self.used[position])
+
+    def combined_details(self, position):
+        """The (normalized) description and both bank detail fields, as used for the secondary score."""
+        combined = self._combined_details.get(position)
+        if combined is None:
+            combined = self.scorer.normalize(
+                self.raw_descriptions[position] + " " + self.details1[position] + " " + self.details2[position])
+            self._combined_details[position] = combined
+        return combined
+
+    def bank_alias(self, position):
+        """The description without references or dates, as stored in the supplier directory."""
+        alias = self._bank_aliases.get(position)
+        if alias is None:
+            alias = self._bank_aliases[position] = bank_alias(self.raw_descriptions[position])
+        return alias
+
+    def mark_used(self, position):
+        self.used[position] = True
+
+
+def first_matching_payment(supplier_name, index, positions, primary_threshold, secondary_threshold,
+                           bank_aliases=()):
+    """
+    Scores candidate payments (in order) against a normalized supplier name, in bulk.
+    Returns (position, match_score) for the first payment that passes the primary
+    or, failing that, the secondary name check, or (None, 0) if none does.
+    A payment whose description is one of the supplier's 'bank_aliases' matches
+    first, with the primary score and without any scoring.
+    """
+    if bank_aliases:
+        for position in positions:
+            if index.bank_alias(position) in bank_aliases:
+                count("reconcile_bank_alias_matches")
+                return position, PRIMARY_MATCH_SCORE
+
+    primary_scores = index.scorer.score_many(supplier_name, [index.descriptions[p] for p in positions])
+
+    # Only payments before the first primary match can still win on their secondary score.
+    first_primary = next((i for i, score in enumerate(primary_scores) if score >= primary_threshold), len(positions))
+    secondary_scores = index.scorer.score_many(
+        supplier_name, [index.combined_details(p) for p in positions[:first_primary]])
+
+    for position, score in zip(positions, secondary_scores):
+        if score >= secondary_threshold:
+            return position, SECONDARY_MATCH_SCORE
+    if first_primary < len(positions):
+        return positions[first_primary], PRIMARY_MATCH_SCORE
+    return None, 0
+
+
+def find_matches(unpaid_invoices, available_payments, tolerance_days, primary_threshold, secondary_threshold,
+                 scorer=None, suppliers=None):
+    """
+    Matches unpaid invoices to available payments.
+
+    A payment matches an invoice when it has exactly the same amount, is dated
+    no more than 'tolerance_days' before the invoice, and its description passes
+    the primary (or, failing that, the secondary) fuzzy name check. Invoices are
+    handled in sheet order and each payment can only be used once; the first
+    matching payment in sheet order wins.
+
+    Pass a name_scoring.NameScorer to reuse its score cache; otherwise a fresh
+    one is used. 'suppliers' ({normalized name: Supplier}, see
+    supplier_directory.load_name_index) maps the names in the sheet to known
+    suppliers: their canonical name is used for scoring, and their bank
+    aliases match without scoring. Returns a list of (invoice_label, payment_label, match_score)
+    tuples, where the labels are index labels of the two DataFrames.
+    """
+    if unpaid_invoices.empty or available_payments.empty:
+        return []
+
+    if scorer is None:
+        scorer = NameScorer()
+    index = PaymentIndex(available_payments, scorer)
+    tolerance = pd.Timedelta(days=tolerance_days).value
+
+    invoice_labels = list(unpaid_invoices.index)
+    invoice_cents = to_cents(unpaid_invoices['Total Amount']).tolist()
+    invoice_dates = _to_int_dates(unpaid_invoices['Invoice Date']).tolist()
+    supplier_names = unpaid_invoices['Supplier Name'].astype(str).str.lower().tolist()
+
+    matches = []
+    for i, invoice_label in enumerate(invoice_labels):
+        cutoff_date = invoice_dates[i] - tolerance
+        positions = index.candidates(invoice_cents[i], cutoff_date)
+        if not positions:
+            continue
+        supplier_name = scorer.normalize(supplier_names[i])
+        supplier = suppliers.get(supplier_name) if suppliers else None
+        if supplier:
+            position, match_score = first_matching_payment(
+                scorer.normalize(supplier.name), index, positions, primary_threshold, secondary_threshold,
+                supplier.bank_aliases)
+        else:
+            position, match_score = first_matching_payment(
+                supplier_name, index, positions, primary_threshold, secondary_threshold)
+        if position is not None:
+            index.mark_used(position)
+            matches.append((invoice_label, index.labels[position], match_score))
+
+    return matches
+
+
+# --- SPLIT AND COMBINED PAYMENTS ---
+# An invoice and a payment can belong together when the payment is dated from
+# 'tolerance_days' before the invoice to 'window_days' after it. Each supplier's
+# leftover invoices are compared with the leftover payments that pass the name
+# check for that supplier, found through an index of the words in the payments
+# (so the fuzzy scorer never sees the whole ledger). Within a supplier, a subset
+# of payments that adds up to the cent to one invoice (or a subset of invoices
+# that adds up to one payment) is searched for by meet in the middle: the subset
+# sums of each half of the candidates are listed, then looked up against each
+# other. At most 'max_candidates' items (the closest in date) are searched, with
+# at most 'max_items' in a subset, so each search takes a few thousand steps.
+
+# Words shorter than this (e.g. "sl", "sa") never pick candidate payments.
+MIN_INDEXED_WORD_LENGTH = 3
+# Only words in at most this many of the suppliers' names (not e.g. "ibiza" or
+# "comercial") pick candidate payments. A supplier without any such word (or bank
+# alias) is left out, as no payment description could tell it from the others.
+MAX_SUPPLIERS_PER_WORD = 3
+
+
+def _subset_sums(amounts, first_position, target, max_items):
+    """
+    Lists the sums (up to 'target') of the subsets of at most 'max_items'
+    amounts. Returns {sum: positions}, keeping the smallest subset for each sum.
+    """
+    sums = {0: ()}
+    # Subsets are grown one amount at a time, so the first subset found for a sum is a smallest one.
+    frontier = [(0, (), -1)]
+    for _ in range(max_items):
+        next_frontier = []
+        for total, positions, last in frontier:
+            for i in range(last + 1, len(amounts)):
+                new_total = total + amounts[i]
+                if new_total > target:
+                    continue
+                new_positions = positions + (first_position + i,)
+                sums.setdefault(new_total, new_positions)
+                next_frontier.append((new_total, new_positions, i))
+        frontier = next_frontier
+    return sums
+
+
+def subset_with_sum(amounts, target, max_items):
+    """
+    Finds the fewest amounts (positive integer cents, at most 'max_items') that
+    add up to exactly 'target'. Returns their positions in 'amounts', or None.
+    """
+    if sum(amounts) < target:
+        return None
+    count("reconcile_subset_searches")
+    half = len(amounts) // 2
+    left = _subset_sums(amounts[:half], 0, target, max_items)
+    right = _subset_sums(amounts[half:], half, target, max_items)
+    best = None
+    for total, right_positions in right.items():
+        left_positions = left.get(target - total)
+        if left_positions is None or len(left_positions) + len(right_positions) > max_items:
+            continue
+        if best is None or len(left_positions) + len(right_positions) < len(best):
+            best = left_positions + right_positions
+    return sorted(best) if best else None
+
+
+def _words(text):
+    return {word for word in text.split() if len(word) >= MIN_INDEXED_WORD_LENGTH and not word.isdigit()}
+
+
+class _WordIndex:
+    """The payments (positions in a PaymentIndex) each word of their description and bank details is in."""
+
+    def __init__(self, index, positions, supplier_names):
+        self.index = index
+        self._payments = {}
+        for position in positions:
+            for word in _words(index.combined_details(position)):
+                self._payments.setdefault(word, []).append(position)
+        self._supplier_count = {}
+        for supplier_name in supplier_names:
+            for word in _words(supplier_name):
+                self._supplier_count[word] = self._supplier_count.get(word, 0) + 1
+        self._aliases = None
+
+    def candidates(self, supplier_name, bank_aliases=()):
+        """The payments that share a distinctive word with the supplier's name (or have one of its bank aliases)."""
+        positions = set()
+        for word in _words(supplier_name):
+            if self._supplier_count[word] <= MAX_SUPPLIERS_PER_WORD:
+                positions.update(self._payments.get(word, ()))
+        if bank_aliases:
+            if self._aliases is None:
+                self._aliases = {}
+                for payments in self._payments.values():
+                    for position in payments:
+                        self._aliases.setdefault(self.index.bank_alias(position), set()).add(position)
+            for alias in bank_aliases:
+                positions.update(self._aliases.get(alias, ()))
+        return positions
+
+
+def _supplier_payments(supplier_name, index, positions, primary_threshold, secondary_threshold, bank_aliases=()):
+    """
+    The payments (out of 'positions') that pass the name check for a supplier,
+    as in first_matching_payment(): a bank alias, or the primary or secondary score.
+    """
+    primary_scores = index.scorer.score_many(supplier_name, [index.descriptions[p] for p in positions])
+    secondary_scores = index.scorer.score_many(supplier_name, [index.combined_details(p) for p in positions])
+    return [position for position, primary, secondary in zip(positions, primary_scores, secondary_scores)
+            if primary >= primary_threshold or secondary >= secondary_threshold
+            or (bank_aliases and index.bank_alias(position) in bank_aliases)]
+
+
+def _closest(items, dates, target_date, max_candidates):
+    """The 'max_candidates' items closest in date to 'target_date', in their original order."""
+    if len(items) > max_candidates:
+        items = sorted(sorted(items, key=lambda item: abs(dates[item] - target_date))[:max_candidates])
+    return items
+
+
+def find_group_matches(unpaid_invoices, available_payments, tolerance_days, window_days, primary_threshold,
+                       secondary_threshold, max_items, max_candidates, scorer=None, suppliers=None):
+    """
+    Matches the invoices that no single payment matches (see find_matches()):
+    an invoice paid in instalments, whose payments add up to its total, or
+    several invoices paid together, whose totals add up to one payment. Only
+    invoices and payments of the same supplier (by the name check) are grouped,
+    a payment can be dated from 'tolerance_days' before to 'window_days' after
+    each of its invoices, and a group holds at most 'max_items' invoices or
+    payments. Invoices are handled in sheet order, instalments first.
+
+    Returns a list of (invoice_labels, payment_labels, GROUP_MATCH_SCORE) tuples,
+    with the labels of each group in sheet order.
+    """
+    if unpaid_invoices.empty or available_payments.empty:
+        return []
+
+    if scorer is None:
+        scorer = NameScorer()
+    index = PaymentIndex(available_payments, scorer)
+    tolerance = pd.Timedelta(days=tolerance_days).value
+    window = pd.Timedelta(days=window_days).value
+
+    invoice_labels = list(unpaid_invoices.index)
+    invoice_cents = to_cents(unpaid_invoices['Total Amount']).tolist()
+    invoice_dates = _to_int_dates(unpaid_invoices['Invoice Date']).tolist()
+    supplier_names = unpaid_invoices['Supplier Name'].astype(str).str.lower().tolist()
+
+    # The invoices of each supplier (by canonical name when the supplier is known).
+    invoices_by_supplier = {}
+    for i, supplier_name in enumerate(supplier_names):
+        if invoice_cents[i] <= 0:
+            continue
+        supplier_name = scorer.normalize(supplier_name)
+        supplier = suppliers.get(supplier_name) if suppliers else None
+        if supplier:
+            supplier_name = scorer.normalize(supplier.name)
+        entry = invoices_by_supplier.setdefault(supplier_name, ([], set()))
+        entry[0].append(i)
+        if supplier:
+            entry[1].update(supplier.bank_aliases)
+
+    words = _WordIndex(index, [position for position, cents in enumerate(index.cents) if cents > 0],
+                       invoices_by_supplier)
+    invoice_used = [False] * len(invoice_labels)
+
+    matches = []
+    for supplier_name, (invoices, bank_aliases) in invoices_by_supplier.items():
+        earliest = min(invoice_dates[i] for i in invoices) - tolerance
+        latest = max(invoice_dates[i] for i in invoices) + window
+        positions = sorted(position for position in words.candidates(supplier_name, bank_aliases)
+                           if earliest <= index.dates[position] <= latest)
+        if not positions:
+            continue
+        payments = _supplier_payments(supplier_name, index, positions, primary_threshold, secondary_threshold,
+                                      bank_aliases)
+        if not payments:
+            continue
+        payments_by_date = sorted((index.dates[p], p) for p in payments)
+        payment_dates = [date for date, _ in payments_by_date]
+        invoices_by_date = sorted((invoice_dates[i], i) for i in invoices)
+        dates_of_invoices = [date for date, _ in invoices_by_date]
+
+        # One invoice, several payments.
+        for i in invoices:
+            in_window = payments_by_date[bisect_left(payment_dates, invoice_dates[i] - tolerance):
+                                         bisect_right(payment_dates, invoice_dates[i] + window)]
+            candidates = sorted(p for _, p in in_window if not index.used[p] and index.cents[p] < invoice_cents[i])
+            if len(candidates) < 2:
+                continue
+            candidates = _closest(candidates, index.dates, invoice_dates[i], max_candidates)
+            subset = subset_with_sum([index.cents[p] for p in candidates], invoice_cents[i], max_items)
+            if subset:
+                group = [candidates[k] for k in subset]
+                for p in group:
+                    index.mark_used(p)
+                invoice_used[i] = True
+                count("reconcile_group_matches", kind="split")
+                matches.append(([invoice_labels[i]], [index.labels[p] for p in group], GROUP_MATCH_SCORE))
+
+        # One payment, several invoices.
+        for p in payments:
+            if index.used[p]:
+                continue
+            in_window = invoices_by_date[bisect_left(dates_of_invoices, index.dates[p] - window):
+                                         bisect_right(dates_of_invoices, index.dates[p] + tolerance)]
+            candidates = sorted(i for _, i in in_window if not invoice_used[i] and invoice_cents[i] < index.cents[p])
+            if len(candidates) < 2:
+                continue
+            candidates = _closest(candidates, invoice_dates, index.dates[p], max_candidates)
+            subset = subset_with_sum([invoice_cents[i] for i in candidates], index.cents[p], max_items)
+            if subset:
+                group = [candidates[k] for k in subset]
+                for i in group:
+                    invoice_used[i] = True
+                index.mark_used(p)
+                count("reconcile_group_matches", kind="combined")
+                matches.append(([invoice_labels[i] for i in group], [index.labels[p]], GROUP_MATCH_SCORE))
+
+    return matches
@@ -0,0 +1,159 @@
+# name_scoring.py
+# Fuzzy supplier-name scoring for the reconciliation engine.
+#
+# Every name and bank description is normalized once (exactly the way
+# thefuzz.fuzz.token_set_ratio does it), candidates are scored in bulk with
+# rapidfuzz, and every score is kept in a persistent cache, because the same
+# supplier/description pairs come back month after month. Only the entries
+# for this run's descriptions are read from the cache, and entries that are
+# no longer used are discarded (see NameScorer.save()).
+
+import sqlite3
+import time
+
+import numpy as np
+from rapidfuzz import fuzz, process
+from thefuzz import utils
+
+import config
+
+
+# Descriptions are read from the cache this many at a time.
+MAX_DESCRIPTIONS_PER_QUERY = 500
+
+
+def normalize_name(text):
+    """Lower-cases the text and strips everything but ASCII letters, digits and spaces."""
+    return utils.full_process(text, force_ascii=True)
+
+
+class NameScorer:
+    """
+    Scores a supplier name against many bank descriptions at once.
+
+    Scores are identical to thefuzz.fuzz.token_set_ratio(supplier, description).
+    Call 'load()' before and 'save()' after scoring to keep the score cache
+    between runs.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self._connection = None
+        self._scores = {}
+        self._new_scores = {}
+        self._used_scores = set()
+        # Descriptions whose cached scores have been read (or are not in the cache).
+        self._loaded = set()
+        self._normalized = {}
+        self.pairs_scored = 0
+        self.pairs_from_cache = 0
+        self.seconds_spent = 0.0
+
+    def load(self):
+        """Opens the cache file (if one is configured). Scores are read as their descriptions come up."""
+        if not self.cache_file or self._connection is not None:
+            return
+        self._connection = sqlite3.connect(self.cache_file)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS name_scores (
+                supplier TEXT NOT NULL,
+                description TEXT NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (supplier, description)
+            )
+        """)
+        # Caches written before scores were dated: their entries count as used now.
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(name_scores)")]
+        if "last_used_at" not in columns:
+            self._connection.execute("ALTER TABLE name_scores ADD COLUMN last_used_at REAL NOT NULL DEFAULT 0")
+            self._connection.execute("UPDATE name_scores SET last_used_at = ?", (time.time(),))
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_name_scores_description ON name_scores (description)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_name_scores_last_used ON name_scores (last_used_at)")
+        self._connection.commit()
+
+    def _load_descriptions(self, descriptions):
+        """Reads the cached scores of these (normalized) descriptions, for every supplier."""
+        descriptions = [description for description in descriptions if description not in self._loaded]
+        self._loaded.update(descriptions)
+        if self._connection is None:
+            return
+        for chunk_start in range(0, len(descriptions), MAX_DESCRIPTIONS_PER_QUERY):
+            chunk = descriptions[chunk_start:chunk_start + MAX_DESCRIPTIONS_PER_QUERY]
+            for supplier, description, score in self._connection.execute(
+                    f"SELECT supplier, description, score FROM name_scores "
+                    f"WHERE description IN ({', '.join('?' * len(chunk))})", chunk):
+                self._scores.setdefault((supplier, description), score)
+
+    def save(self):
+        """
+        Writes the scores computed during this run to the cache file, marks the
+        ones read from it as used, and discards the ones not used for
+        config.NAME_SCORE_CACHE_MAX_AGE_DAYS or over NAME_SCORE_CACHE_MAX_ENTRIES.
+        """
+        if self._connection is None:
+            return
+        now = time.time()
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO name_scores VALUES (?, ?, ?, ?)",
+            [(supplier, description, score, now) for (supplier, description), score in self._new_scores.items()])
+        self._connection.executemany(
+            "UPDATE name_scores SET last_used_at = ? WHERE supplier = ? AND description = ?",
+            [(now, supplier, description) for supplier, description in self._used_scores])
+        cutoff = now - config.NAME_SCORE_CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+        self._connection.execute("DELETE FROM name_scores WHERE last_used_at < ?", (cutoff,))
+        # Least recently used scores go first when the cache is over its size limit.
+        self._connection.execute("""
+            DELETE FROM name_scores WHERE rowid IN (
+                SELECT rowid FROM name_scores ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (config.NAME_SCORE_CACHE_MAX_ENTRIES,))
+        self._connection.commit()
+        self._new_scores = {}
+        self._used_scores = set()
+
+    def normalize(self, text):
+        """Normalizes a string once, then remembers the result."""
+        normalized = self._normalized.get(text)
+        if normalized is None:
+            normalized = normalize_name(text)
+            self._normalized[text] = normalized
+        return normalized
+
+    def score_many(self, supplier, descriptions):
+        """
+        Scores one normalized supplier name against a list of normalized
+        descriptions. Returns a list of integer scores (0-100) in the same order.
+        """
+        started_at = time.perf_counter()
+        self._load_descriptions(descriptions)
+        scores = [self._scores.get((supplier, description)) for description in descriptions]
+        to_score = sorted({description for description, score in zip(descriptions, scores) if score is None})
+        self.pairs_from_cache += len(descriptions) - len(to_score)
+        if self._connection is not None:
+            self._used_scores.update((supplier, description)
+                                     for description, score in zip(descriptions, scores) if score is not None)
+
+        if to_score:
+            # One bulk call for every pair we have not seen before.
+            matrix = process.cdist([supplier], to_score, scorer=fuzz.token_set_ratio, dtype=np.float64)
+            for description, raw_score in zip(to_score, matrix[0]):
+                score = int(round(raw_score))
+                self._scores[(supplier, description)] = score
+                self._new_scores[(supplier, description)] = score
+            self.pairs_scored += len(to_score)
+            scores = [self._scores[(supplier, description)] for description in descriptions]
+
+        self.seconds_spent += time.perf_counter() - started_at
+        return scores
+
+    def summary(self):
+        """A one-line report of how much work the scorer did."""
+        return (f"Name scoring: {self.pairs_scored} pair(s) scored, {self.pairs_from_cache} from cache, "
+                f"{self.seconds_spent:.3f}s spent scoring.")
+
+
+def create_name_scorer():
+    """Creates a NameScorer backed by the configured score cache, with the cache loaded."""
+    scorer = NameScorer(config.NAME_SCORE_CACHE_FILE if config.NAME_SCORE_CACHE_ENABLED else None)
+    scorer.load()
+    return scorer
@@ -0,0 +1,69 @@
+# pdf_renderer.py
+# Turns a PDF invoice into the page images we send to the vision model.
+#
+# Only the pages that matter are rendered: the first page (supplier, client and
+# invoice number) plus the page(s) holding the totals, found through the PDF's
+# text layer or, for scanned PDFs, assumed to be the last page. Each page is
+# rendered at a configurable DPI, capped to what the vision model actually
+# looks at, and encoded as a compact JPEG.
+
+import config
+from providers import lazy_import
+
+# PyMuPDF, only imported when the first PDF is rendered.
+fitz = lazy_import("fitz")
+
+# Phrases that mark the page with the invoice totals (compared in lower case).
+TOTALS_SEARCH_TERMS = ["total factura", "total a pagar", "importe total"]
+
+# GPT-4o scales every image to fit 2048x2048 and then to at most 768px on the
+# short side, so rendering anything bigger only costs upload bytes.
+VISION_MAX_LONG_SIDE = 2048
+VISION_MAX_SHORT_SIDE = 768
+
+
+def select_pages(doc):
+    """
+    Returns the (sorted) indexes of the pages to send: the first page plus the
+    pages mentioning the invoice total, or the last page if none do.
+    """
+    max_pages = max(1, config.PDF_MAX_PAGES_PER_INVOICE)
+    pages = [0]
+    if doc.page_count > 1 and max_pages > 1:
+        totals_pages = []
+        for page_index in range(1, doc.page_count):
+            page_text = doc.load_page(page_index).get_text().lower()
+            if any(term in page_text for term in TOTALS_SEARCH_TERMS):
+                totals_pages.append(page_index)
+        # If several pages mention the total, the last one holds the final summary.
+        pages.extend(totals_pages[-(max_pages - 1):] if totals_pages else [doc.page_count - 1])
+    return sorted(set(pages))
+
+
+def _zoom_for_page(page):
+    """The render scale for a page: the configured DPI, capped to the vision model's image size."""
+    width, height = page.rect.width, page.rect.height
+    zoom = config.PDF_RENDER_DPI / 72
+    zoom = min(zoom, VISION_MAX_SHORT_SIDE / min(width, height), VISION_MAX_LONG_SIDE / max(width, height))
+    return zoom
+
+
+def render_page(page):
+    """Renders one page and returns (image_bytes, mime_type)."""
+    zoom = _zoom_for_page(page)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    if config.PDF_IMAGE_FORMAT == "png":
+        return pix.tobytes("png"), "image/png"
+    return pix.tobytes("jpeg", jpg_quality=config.PDF_JPEG_QUALITY), "image/jpeg"
+
+
+def render_invoice_pages(file_content):
+    """
+    Opens a PDF from memory and renders its relevant pages.
+    Returns a list of (image_bytes, mime_type) tuples, in page order.
+    """
+    doc = fitz.open(stream=file_content, filetype="pdf")
+    try:
+        return [render_page(doc.load_page(page_index)) for page_index in select_pages(doc)]
+    finally:
+        doc.close()
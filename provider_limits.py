@@ -0,0 +1,281 @@
+# provider_limits.py
+# The shared gatekeeper for every call to an external provider (OpenAI, Google
+# Document AI and Google Sheets).
+#
+# For each provider it caps:
+#   - how many calls run at the same time (so running many invoices in parallel
+#     never opens more connections than a provider allows),
+#   - how many calls start per second (a token bucket, which slows down by itself
+#     when the provider answers "429 Too Many Requests" and speeds up again on success).
+# Transient errors (429, 5xx, timeouts, dropped connections) are retried with
+# exponential backoff and jitter, honouring the provider's Retry-After header.
+# After too many failures in a row, a circuit breaker pauses all calls to that
+# provider for a while, so a burst of uploads waits out an outage instead of failing.
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import config
+from instrumentation import logger
+
+# Used when a provider is not listed in config.PROVIDER_CONCURRENCY_LIMITS / PROVIDER_RATE_LIMITS.
+DEFAULT_PROVIDER_LIMIT = 4
+DEFAULT_PROVIDER_RATE = 2
+# HTTP status codes worth retrying.
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# On a 429, the rate is multiplied by this factor; every success adds back a small step.
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_STEP = 0.05
+MIN_RATE_PER_SECOND = 0.05
+
+
+class TokenBucket:
+    """A thread-safe token bucket: acquire() blocks until a call may start."""
+
+    def __init__(self, rate_per_second):
+        self.max_rate = float(rate_per_second)
+        self.rate = self.max_rate
+        self.capacity = max(1.0, self.max_rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def slow_down(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(MIN_RATE_PER_SECOND, self.rate * RATE_DECREASE_FACTOR)
+
+    def speed_up(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE_STEP)
+
+
+class ProviderLimiter:
+    """The concurrency limit, rate limit, pause and circuit breaker of one provider."""
+
+    def __init__(self, provider):
+        self.provider = provider
+        limit = config.PROVIDER_CONCURRENCY_LIMITS.get(provider, DEFAULT_PROVIDER_LIMIT)
+        self.semaphore = threading.BoundedSemaphore(max(1, int(limit)))
+        self.bucket = TokenBucket(config.PROVIDER_RATE_LIMITS.get(provider, DEFAULT_PROVIDER_RATE))
+        self._condition = threading.Condition()
+        # No calls start before this time (set by Retry-After headers and by the circuit breaker).
+        self.paused_until = 0
+        self.consecutive_failures = 0
+        self.circuit_open = False
+        self.probe_in_flight = False
+        # 'waiting' is the queue depth: calls waiting for a pause, a token or a free slot.
+        self.counters = {"waiting": 0, "in_flight": 0, "calls": 0, "retries": 0, "rate_limited": 0, "failures": 0}
+
+    def wait_for_turn(self):
+        """
+        Blocks while the provider is paused or its circuit is open. Once the
+        cool-down is over, a single probe call is let through; the others wait
+        for its result.
+        """
+        with self._condition:
+            while True:
+                remaining = self.paused_until - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                elif self.circuit_open and self.probe_in_flight:
+                    self._condition.wait()
+                else:
+                    self.probe_in_flight = self.circuit_open
+                    return
+
+    def count(self, counter, change=1):
+        with self._condition:
+            self.counters[counter] += change
+
+    def pause(self, seconds):
+        with self._condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def record_success(self):
+        self.bucket.speed_up()
+        with self._condition:
+            self.consecutive_failures = 0
+            self.circuit_open = False
+            self.probe_in_flight = False
+            self._condition.notify_all()
+
+    def record_failure(self, rate_limited):
+        if rate_limited:
+            self.bucket.slow_down()
+        with self._condition:
+            self.counters["failures"] += 1
+            self.counters["rate_limited"] += rate_limited
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= config.CIRCUIT_BREAKER_FAILURE_THRESHOLD or self.probe_in_flight:
+                if not self.circuit_open:
+                    logger.warning("  --> %s: %d failures in a row. Pausing calls for %ss.", self.provider,
+                                   self.consecutive_failures, config.CIRCUIT_BREAKER_COOLDOWN_SECONDS)
+                self.circuit_open = True
+                self.probe_in_flight = False
+                self.paused_until = max(self.paused_until,
+                                        time.monotonic() + config.CIRCUIT_BREAKER_COOLDOWN_SECONDS)
+            self._condition.notify_all()
+
+    def status(self):
+        with self._condition:
+            paused_for = max(0.0, self.paused_until - time.monotonic())
+            if self.circuit_open:
+                circuit = "half-open" if paused_for == 0 else "open"
+            else:
+                circuit = "closed"
+            return dict(self.counters, rate_per_second=round(self.bucket.rate, 2),
+                        paused_for_seconds=round(paused_for, 1), circuit=circuit)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _get_limiter(provider):
+    """Returns the (shared) limiter for a provider, creating it on first use."""
+    with _limiters_lock:
+        if provider not in _limiters:
+            _limiters[provider] = ProviderLimiter(provider)
+        return _limiters[provider]
+
+
+@contextmanager
+def provider_slot(provider):
+    """
+    Blocks until a call slot for the given provider is free, then holds it
+    for the duration of the 'with' block. This only applies the concurrency
+    limit; use call_provider() for rate limiting and retries too.
+
+    Example:
+        with provider_slot("openai"):
+            response = client.chat.completions.create(...)
+    """
+    limiter = _get_limiter(provider)
+    limiter.semaphore.acquire()
+    try:
+        yield
+    finally:
+        limiter.semaphore.release()
+
+
+def _status_code(error):
+    """The HTTP status code of an API error from openai, google-api-core or gspread, if any."""
+    for status_code in (getattr(error, "status_code", None), getattr(error, "code", None),
+                        getattr(getattr(error, "response", None), "status_code", None)):
+        if isinstance(status_code, int):
+            return status_code
+    return None
+
+
+def _retry_after_seconds(error):
+    """Reads the Retry-After (or OpenAI's retry-after-ms) header of an API error, in seconds."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            # The header may also be an HTTP date.
+            return parsedate_to_datetime(retry_after).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    """Returns True for errors that are likely to go away: rate limits, server errors, timeouts, dropped connections."""
+    status_code = _status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    # Connection and timeout errors (including openai.APIConnectionError / APITimeoutError) carry no status code.
+    return isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in (
+        "APIConnectionError", "APITimeoutError", "ServiceUnavailable", "DeadlineExceeded")
+
+
+def _backoff_seconds(attempt):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(config.RETRY_MAX_DELAY_SECONDS, config.RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+
+def call_provider(provider, func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) within the provider's concurrency and rate
+    limits. Transient errors are retried (up to config.PROVIDER_MAX_RETRIES
+    times) with backoff; any other error, or the last one, is raised as usual.
+    """
+    limiter = _get_limiter(provider)
+    attempt = 0
+    while True:
+        limiter.count("waiting")
+        try:
+            limiter.wait_for_turn()
+            limiter.bucket.acquire()
+            limiter.semaphore.acquire()
+        finally:
+            limiter.count("waiting", -1)
+        limiter.count("in_flight")
+        limiter.count("calls")
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            error = e
+        else:
+            limiter.record_success()
+            return result
+        finally:
+            limiter.count("in_flight", -1)
+            limiter.semaphore.release()
+
+        if not is_retryable(error):
+            # The provider is up; the request itself was rejected.
+            limiter.record_success()
+            raise error
+        rate_limited = _status_code(error) == 429
+        limiter.record_failure(rate_limited)
+        if attempt >= config.PROVIDER_MAX_RETRIES:
+            raise error
+
+        delay = max(_retry_after_seconds(error) or 0, _backoff_seconds(attempt))
+        if rate_limited:
+            # Everyone waits: more calls now would only be rejected too.
+            limiter.pause(delay)
+        logger.warning("  --> %s call failed (%s). Retrying in %.1fs (attempt %d of %d).", provider, error, delay,
+                       attempt + 2, config.PROVIDER_MAX_RETRIES + 1)
+        limiter.count("retries")
+        attempt += 1
+        time.sleep(delay)
+
+
+def get_provider_status():
+    """
+    Returns, per provider used so far, the current queue depth ('waiting'),
+    calls in flight, rate, pause, circuit breaker state and call counters.
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.provider: limiter.status() for limiter in limiters}
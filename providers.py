@@ -0,0 +1,84 @@
+# providers.py
+# Lazily created API clients, and lazily imported libraries.
+#
+# openai, google-cloud-documentai, gspread and PyMuPDF take seconds to import,
+# and creating their clients needs keys and credentials. Each connector
+# registers a factory for its client here instead of creating it at import
+# time, so a reconciliation-only run, a fully cached run or a Streamlit rerun
+# never pays for (or fails on) a provider it does not use.
+#
+# Example:
+#     register_provider("openai", lambda: openai.OpenAI(max_retries=0))
+#     response = get_client("openai").chat.completions.create(...)
+
+import importlib
+import threading
+
+_factories = {}
+_clients = {}
+# One lock per provider, so a slow connection to one provider never holds up the others.
+_locks = {}
+_registry_lock = threading.Lock()
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported when one of its attributes is
+    first used, e.g. 'fitz = LazyModule("fitz")' and later 'fitz.open(...)'.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            # import_module() holds the import lock, so concurrent first uses import the module only once.
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}' ({'imported' if self._module else 'not imported yet'})>"
+
+
+def lazy_import(name):
+    """Returns a LazyModule for 'name' (a module name like "fitz" or "google.cloud.documentai")."""
+    return LazyModule(name)
+
+
+def register_provider(name, factory):
+    """Registers the function that creates a provider's client. It is only called on first use."""
+    with _registry_lock:
+        _factories[name] = factory
+        _locks.setdefault(name, threading.Lock())
+
+
+def get_client(name):
+    """Returns the shared client of a provider, creating it on first use."""
+    with _registry_lock:
+        lock = _locks[name]
+    with lock:
+        client = _clients.get(name)
+        if client is None:
+            client = _clients[name] = _factories[name]()
+        return client
+
+
+def use_client(name, client):
+    """
+    Replaces a provider's shared client, e.g. with a local stand-in for tests
+    and benchmarks. Pass None to create a real client again on the next use.
+    Returns the previous client (None if none had been created yet).
+    """
+    with _registry_lock:
+        lock = _locks.setdefault(name, threading.Lock())
+    with lock:
+        previous_client = _clients.get(name)
+        _clients[name] = client
+        return previous_client
+
+
+def created_clients():
+    """The names of the providers whose client exists in this process."""
+    with _registry_lock:
+        return sorted(name for name, client in _clients.items() if client is not None)
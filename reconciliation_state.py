@@ -0,0 +1,143 @@
+# reconciliation_state.py
+# A small local state store that lets reconcile_sheets() run incrementally.
+#
+# After every run we remember, for each sheet, its header, the last row we have
+# seen, and which rows are still unmatched. The next run then only fetches those
+# unmatched rows plus anything appended since, with 'batch_get' requests,
+# instead of downloading the whole history with 'get_all_values()'.
+
+import json
+import os
+
+import config
+from instrumentation import logger
+from provider_limits import call_provider
+from providers import lazy_import
+
+gspread = lazy_import("gspread")
+
+# Unmatched rows closer together than this are fetched as one range (fetching a
+# few already-matched rows in between is cheaper than an extra range).
+MERGE_GAP_ROWS = 10
+# The Sheets API takes the ranges in the URL, so we split very long lists.
+MAX_RANGES_PER_REQUEST = 100
+
+
+def load_state():
+    """Loads the saved reconciliation state, or returns an empty state if there is none."""
+    if not os.path.exists(config.RECONCILIATION_STATE_FILE):
+        return {}
+    try:
+        with open(config.RECONCILIATION_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("  --> Could not read the reconciliation state (%s). Doing a full reconciliation.", e)
+        return {}
+
+
+def save_state(state):
+    """Saves the reconciliation state (written to a temporary file first, so it is never half-written)."""
+    temp_path = config.RECONCILIATION_STATE_FILE + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(temp_path, config.RECONCILIATION_STATE_FILE)
+
+
+def _row_fingerprint(header, row, key_columns):
+    """A short string identifying a row, used to notice when the sheet was re-ordered or edited."""
+    return "|".join(row[header.index(column)] for column in key_columns if column in header)
+
+
+def group_into_ranges(row_numbers):
+    """Turns sorted row numbers into (first, last) pairs of (nearly) consecutive rows."""
+    ranges = []
+    for row_number in row_numbers:
+        if ranges and row_number <= ranges[-1][1] + MERGE_GAP_ROWS:
+            ranges[-1][1] = row_number
+        else:
+            ranges.append([row_number, row_number])
+    return ranges
+
+
+def _pad_row(row, width):
+    """The Sheets API leaves out trailing empty cells; put them back."""
+    return (list(row) + [''] * width)[:width]
+
+
+def _fetch_all_rows(worksheet):
+    values = call_provider("sheets", worksheet.get_all_values)
+    if not values:
+        return [], []
+    header = values[0]
+    return header, [(index + 2, _pad_row(row, len(header))) for index, row in enumerate(values[1:])]
+
+
+def _fetch_changed_rows(worksheet, sheet_state, key_columns):
+    """
+    Fetches the header, the still-unmatched rows and all rows appended since the
+    last run. Returns None if the sheet no longer looks like it
+    did last time (so the caller should fall back to a full fetch).
+    """
+    header = sheet_state["header"]
+    last_column = gspread.utils.rowcol_to_a1(1, len(header)).rstrip("0123456789")
+    unmatched = {int(row_number): fingerprint for row_number, fingerprint in sheet_state["unmatched"].items()}
+
+    starts = []
+    ranges = [f"A1:{last_column}1"]
+    for first, last in group_into_ranges(sorted(unmatched)):
+        starts.append(first)
+        ranges.append(f"A{first}:{last_column}{last}")
+    # Reading past the end of the grid is an API error, so only ask for new rows if there can be any.
+    if sheet_state["last_row"] < worksheet.row_count:
+        starts.append(sheet_state["last_row"] + 1)
+        ranges.append(f"A{sheet_state['last_row'] + 1}:{last_column}")
+
+    value_ranges = []
+    for chunk_start in range(0, len(ranges), MAX_RANGES_PER_REQUEST):
+        value_ranges.extend(call_provider("sheets", worksheet.batch_get,
+                                          ranges[chunk_start:chunk_start + MAX_RANGES_PER_REQUEST]))
+    if _pad_row(value_ranges[0][0] if value_ranges[0] else [], len(header)) != header:
+        return None
+
+    rows = []
+    for start, values in zip(starts, value_ranges[1:]):
+        for offset, row in enumerate(values):
+            rows.append((start + offset, _pad_row(row, len(header))))
+
+    for row_number, row in rows:
+        if row_number in unmatched and _row_fingerprint(header, row, key_columns) != unmatched[row_number]:
+            return None
+    return rows
+
+
+def fetch_sheet_rows(worksheet, sheet_state, key_columns):
+    """
+    Returns (header, rows, is_incremental) for a worksheet, where rows is a list
+    of (sheet_row_number, values). With a saved 'sheet_state' only the unmatched
+    and newly appended rows are fetched; otherwise the whole sheet is.
+    """
+    if sheet_state:
+        rows = _fetch_changed_rows(worksheet, sheet_state, key_columns)
+        if rows is not None:
+            logger.info("  --> '%s': fetched %d new or unmatched row(s) since the last run.", worksheet.title, len(rows))
+            return sheet_state["header"], rows, True
+        logger.info("  --> '%s' changed since the last run. Fetching all rows.", worksheet.title)
+    header, rows = _fetch_all_rows(worksheet)
+    return header, rows, False
+
+
+def build_sheet_state(header, rows, unmatched_row_numbers, key_columns, previous_state=None):
+    """
+    Builds the state to remember for one sheet after a reconciliation run.
+    Pass the 'previous_state' only if the rows were fetched incrementally.
+    """
+    last_row = previous_state["last_row"] if previous_state else 1
+    if rows:
+        last_row = max(last_row, max(row_number for row_number, _ in rows))
+    rows_by_number = dict(rows)
+    return {
+        "header": header,
+        "last_row": last_row,
+        "unmatched": {str(row_number): _row_fingerprint(header, rows_by_number[row_number], key_columns)
+                      for row_number in sorted(unmatched_row_numbers)},
+    }
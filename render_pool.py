@@ -0,0 +1,201 @@
+# render_pool.py
+# Renders PDF pages in a pool of separate processes, one per CPU core.
+#
+# PyMuPDF holds Python's GIL while it renders, so rendering in the worker
+# threads lets only one page be drawn at a time, however many cores the machine
+# has. Here every render runs in its own process and only the compressed page
+# images (small JPEGs) come back, straight through the pool's pipe: nothing is
+# written to temporary files.
+#
+# process_all_invoices() also starts the render of each scanned PDF just before
+# handing the file to a worker thread (render_ahead), so the pages are usually
+# ready by the time the worker needs them. At most config.RENDER_AHEAD_LIMIT
+# renders are started ahead; past that, the caller waits for a worker to pick
+# one up, which keeps memory flat on a folder of thousands of scans.
+#
+# Example:
+#     render_ahead(file_content)           # in the thread that submits the work
+#     images = render_pages(file_content)  # in the worker: [(image_bytes, mime_type), ...]
+#     shutdown()                           # once the run is over
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+from extraction_cache import compute_file_hash
+from instrumentation import logger, count
+from pdf_renderer import render_invoice_pages
+from text_layer_parser import extract_text_lines
+
+# The settings the render processes copy from this process's config (which may have been changed at run time).
+RENDER_SETTINGS = ("PDF_RENDER_DPI", "PDF_MAX_PAGES_PER_INVOICE", "PDF_IMAGE_FORMAT", "PDF_JPEG_QUALITY",
+                   "TEXT_LAYER_FAST_PATH", "TEXT_LAYER_SEND_TEXT_ONLY")
+
+_pool = None
+_pool_lock = threading.Lock()
+# {file hash: Future} of the renders started ahead and not picked up yet.
+_ahead = {}
+_ahead_lock = threading.Lock()
+_ahead_slots = None
+
+
+# --- IN THE RENDER PROCESSES ---
+
+def _init_render_process(settings):
+    """Runs once in each render process: applies the parent's render settings."""
+    for name, value in settings.items():
+        setattr(config, name, value)
+
+
+def _render_scanned_pages(file_content):
+    """
+    Renders a PDF's pages, unless the text-layer fast path will read it without
+    images (then returns None, as those invoices never need rendering). When an
+    incomplete text layer is sent with images, the pages are always rendered.
+    """
+    if config.TEXT_LAYER_FAST_PATH and config.TEXT_LAYER_SEND_TEXT_ONLY and extract_text_lines(file_content):
+        return None
+    return render_invoice_pages(file_content)
+
+
+# --- IN THE MAIN PROCESS ---
+
+def _get_pool():
+    """Starts the process pool on first use. Returns None if rendering in processes is disabled."""
+    global _pool
+    if not config.RENDER_IN_SEPARATE_PROCESSES:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            processes = config.RENDER_PROCESSES or os.cpu_count() or 1
+            # "spawn" starts clean processes: forking a process with running threads (and open
+            # SQLite connections) is unsafe.
+            _pool = ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_render_process,
+                initargs=({name: getattr(config, name) for name in RENDER_SETTINGS},))
+            logger.debug("Started %d render process(es).", processes)
+        return _pool
+
+
+def _reset_pool(pool):
+    """Drops a broken pool, so the next render starts a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _get_ahead_slots():
+    global _ahead_slots
+    with _ahead_lock:
+        if _ahead_slots is None:
+            _ahead_slots = threading.BoundedSemaphore(max(1, config.RENDER_AHEAD_LIMIT))
+        return _ahead_slots
+
+
+def _take_ahead(file_hash):
+    """Removes the render started ahead for this file (if any) and frees its slot. Returns its Future or None."""
+    with _ahead_lock:
+        future = _ahead.pop(file_hash, None)
+    if future is not None:
+        _ahead_slots.release()
+    return future
+
+
+def render_ahead(file_content, block=True):
+    """
+    Starts rendering a PDF in the process pool, to be picked up later by
+    render_pages(). Waits for a free slot when RENDER_AHEAD_LIMIT renders are
+    already waiting (with block=False, returns None instead). Returns the file's
+    hash if the render was started (see release_ahead), None otherwise.
+    """
+    pool = _get_pool()
+    if pool is None:
+        return None
+    file_hash = compute_file_hash(file_content)
+    with _ahead_lock:
+        if file_hash in _ahead:
+            return file_hash
+    if not _get_ahead_slots().acquire(blocking=block):
+        return None
+    try:
+        future = pool.submit(_render_scanned_pages, file_content)
+    except (BrokenProcessPool, RuntimeError) as e:
+        _ahead_slots.release()
+        logger.warning("Could not start a render ahead (%s).", e)
+        _reset_pool(pool)
+        return None
+    with _ahead_lock:
+        if file_hash in _ahead:
+            # Another thread started the same file in the meantime.
+            _ahead_slots.release()
+            return file_hash
+        _ahead[file_hash] = future
+    return file_hash
+
+
+def release_ahead(file_hash):
+    """
+    Forgets the render started ahead under this hash (as returned by
+    render_ahead) if it was not picked up, e.g. for a cached invoice or a file
+    that could no longer be read, and frees its slot.
+    """
+    future = _take_ahead(file_hash)
+    if future is not None:
+        future.cancel()
+
+
+def discard_ahead(file_content):
+    """Forgets the render started ahead for a file that no longer needs it (see release_ahead)."""
+    release_ahead(compute_file_hash(file_content))
+
+
+def render_pages(file_content):
+    """
+    Returns a PDF's relevant pages as a list of (image_bytes, mime_type) tuples:
+    from the render started ahead if there is one, otherwise rendered in the
+    process pool (or in this thread when processes are disabled or fail).
+    """
+    future = _take_ahead(compute_file_hash(file_content))
+    if future is not None:
+        try:
+            images = future.result()
+        except BrokenProcessPool as e:
+            logger.warning("  --> The render processes stopped (%s). Rendering in this thread instead.", e)
+            images = None
+        if images is not None:
+            count("pdf_renders", mode="ahead")
+            return images
+
+    pool = _get_pool()
+    if pool is not None:
+        try:
+            images = pool.submit(render_invoice_pages, file_content).result()
+            count("pdf_renders", mode="process")
+            return images
+        except (BrokenProcessPool, RuntimeError) as e:
+            logger.warning("  --> The render processes stopped (%s). Rendering in this thread instead.", e)
+            _reset_pool(pool)
+
+    count("pdf_renders", mode="thread")
+    return render_invoice_pages(file_content)
+
+
+def shutdown():
+    """Stops the render processes and forgets any renders started ahead."""
+    global _pool
+    with _ahead_lock:
+        futures = list(_ahead.values())
+        _ahead.clear()
+    for future in futures:
+        future.cancel()
+        _ahead_slots.release()
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -1,46 +1,476 @@
 # Import the libraries we need
-import gspread
+import re
+import threading
+import time
+from types import SimpleNamespace
+
 import config
+import job_journal
+import ledger_store
+import providers
+from instrumentation import logger, timed, count
+from invoice_model import Invoice
+from provider_limits import call_provider
+from providers import lazy_import
+from reconciliation_state import MAX_RANGES_PER_REQUEST, fetch_sheet_rows, group_into_ranges
+
+# gspread is only imported (and we only authenticate) when the sheet is first used.
+gspread = lazy_import("gspread")
 
 # -----------------------------------------
 
-def append_to_sheet(data_dict):
+
+def _create_client():
+    """Authenticates with Google Sheets, using the service account and the JSON key file."""
+    logger.info("Connecting to Google Sheets...")
+    return gspread.service_account(filename=config.CREDENTIALS_FILE)
+
+
+providers.register_provider("sheets", _create_client)
+
+
+def _build_row(data_dict):
+    """
+    Prepares the data row in the correct order of your columns.
+    Make sure this order matches your Google Sheet columns exactly!
+    The values are formatted through the typed Invoice model, so amounts and
+    dates always reach the sheet in the same format.
+    """
+    invoice = Invoice.from_dict(data_dict)
+    return [
+        invoice.supplier,  # Column A: Supplier Name
+        invoice.date_string(),  # Column B: Invoice Date
+        invoice.invoice_id,  # Column C: Invoice Number
+        invoice.tax_string(),  # Column D: Tax
+        invoice.total_string(),  # Column E: Total Amount
+        "",  # Column F: Paid On (always blank on creation)
+        invoice.filename or "NO_FILENAME_PASSED",  # Column G: Filename
+        ""  # Column H: Match Percentage (always blank on creation)
+    ]
+
+
+class SheetsSession:
+    """
+    A long-lived connection to the invoice Google Sheet.
+
+    It authenticates once, keeps the worksheet handle, and buffers new invoice
+    rows so they can be written with a single 'append_rows' request. If a write
+    fails, the rows stay in the buffer and are retried on the next flush.
+    Flush listeners are called with the idempotency keys of the rows written.
+    """
+
+    def __init__(self, sheet_name=None, max_buffered_rows=None, flush_interval_seconds=None):
+        self.sheet_name = sheet_name or config.INVOICE_SHEET_NAME
+        self.max_buffered_rows = max_buffered_rows or config.SHEETS_FLUSH_MAX_ROWS
+        self.flush_interval_seconds = flush_interval_seconds or config.SHEETS_FLUSH_INTERVAL_SECONDS
+        self._client = None
+        self._worksheet = None
+        # Buffered (row, idempotency_key) pairs.
+        self._buffer = []
+        self._oldest_buffered_at = None
+        self._flush_listeners = []
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+
+    def get_client(self):
+        """Returns the authenticated gspread client (shared through the "sheets" provider), authenticating on first use."""
+        with self._connect_lock:
+            if self._client is None:
+                self._client = providers.get_client("sheets")
+            return self._client
+
+    def use_client(self, client):
+        """
+        Replaces the gspread client (e.g. with a FakeSheetsClient for tests and
+        benchmarks); the worksheet is opened again through it on next use.
+        """
+        with self._connect_lock:
+            self._client = client
+            self._worksheet = None
+
+    def get_worksheet(self):
+        """Returns the first worksheet of the invoice spreadsheet, opening it on first use."""
+        client = self.get_client()
+        with self._connect_lock:
+            if self._worksheet is None:
+                # Open the spreadsheet by its name and select the first worksheet.
+                self._worksheet = client.open(self.sheet_name).sheet1
+                logger.info("Successfully connected to worksheet: '%s'", self._worksheet.title)
+            return self._worksheet
+
+    @property
+    def pending_rows(self):
+        """The number of rows waiting to be written."""
+        with self._buffer_lock:
+            return len(self._buffer)
+
+    def add_flush_listener(self, listener):
+        """Registers a function that is called with the idempotency keys of every batch of rows written."""
+        self._flush_listeners.append(listener)
+
+    def append(self, data_dict, idempotency_key=None):
+        """
+        Buffers one invoice row. The buffer is flushed automatically once it
+        holds 'max_buffered_rows' rows or its oldest row is older than
+        'flush_interval_seconds'. A row whose idempotency key is already
+        buffered is ignored.
+        """
+        with self._buffer_lock:
+            if idempotency_key and any(key == idempotency_key for _, key in self._buffer):
+                return True
+            if not self._buffer:
+                self._oldest_buffered_at = time.monotonic()
+            self._buffer.append((_build_row(data_dict), idempotency_key))
+
+        if self.flush_is_due():
+            self.flush()
+        return True
+
+    def flush_is_due(self):
+        """Returns True if the buffer has reached its size or time threshold."""
+        with self._buffer_lock:
+            if not self._buffer:
+                return False
+            buffer_age = time.monotonic() - self._oldest_buffered_at
+            return len(self._buffer) >= self.max_buffered_rows or buffer_age >= self.flush_interval_seconds
+
+    def flush(self):
+        """
+        Writes all buffered rows with a single 'append_rows' request.
+        Returns True if the buffer is empty afterwards, False if the write failed
+        (in which case the rows are kept for the next flush).
+        """
+        with self._flush_lock:
+            with self._buffer_lock:
+                rows_to_write = self._buffer
+                oldest_buffered_at = self._oldest_buffered_at
+                self._buffer = []
+            if not rows_to_write:
+                return True
+
+            try:
+                worksheet = self.get_worksheet()
+                with timed("sheet_write"):
+                    call_provider("sheets", worksheet.append_rows, [row for row, _ in rows_to_write])
+                count("sheet_rows_written", len(rows_to_write))
+                logger.info("Successfully appended %d row(s) to the sheet!", len(rows_to_write))
+            except Exception as e:
+                logger.error("An error occurred while writing to Google Sheets: %s", e)
+                logger.warning("  --> Keeping %d row(s) buffered for retry.", len(rows_to_write))
+                # Reconnect on the next attempt, in case the session itself went bad.
+                with self._connect_lock:
+                    self._worksheet = None
+                # Put the failed rows back in front of anything buffered meanwhile.
+                with self._buffer_lock:
+                    self._buffer = rows_to_write + self._buffer
+                    self._oldest_buffered_at = oldest_buffered_at
+                return False
+
+            # The rows are in the sheet now; let the listeners (e.g. the job journal) record that.
+            written_keys = [key for _, key in rows_to_write if key]
+            for listener in self._flush_listeners:
+                try:
+                    listener(written_keys)
+                except Exception as e:
+                    logger.warning("  --> Warning: a flush listener failed: %s", e)
+            return True
+
+
+class FakeWorksheet:
+    """
+    An in-memory stand-in for a gspread Worksheet, for tests and benchmarks.
+    It supports the calls this project makes (get_all_values, batch_get,
+    batch_update, append_rows and row_count) and can wait 'latency_seconds'
+    per request like a real API call.
+    """
+
+    def __init__(self, values=None, title="Sheet1", latency_seconds=0):
+        self.values = [list(row) for row in values or []]
+        self.title = title
+        self.latency_seconds = latency_seconds
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        self.request_count += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    @property
+    def row_count(self):
+        return len(self.values)
+
+    def _range_bounds(self, a1_range):
+        """The (first row, first column, last row, last column) of an A1 range like "A2:H10", "A5:H" or "F3"."""
+        start, _, end = a1_range.partition(":")
+        first_row, first_column = gspread.utils.a1_to_rowcol(start)
+        if not end:
+            return first_row, first_column, first_row, first_column
+        if end.isalpha():
+            # An open-ended range ("A5:H") runs to the last row.
+            return first_row, first_column, len(self.values), gspread.utils.a1_to_rowcol(end + "1")[1]
+        return (first_row, first_column) + gspread.utils.a1_to_rowcol(end)
+
+    def get_all_values(self):
+        self._request()
+        with self._lock:
+            return [list(row) for row in self.values]
+
+    def batch_get(self, ranges):
+        self._request()
+        value_ranges = []
+        with self._lock:
+            for a1_range in ranges:
+                first_row, first_column, last_row, last_column = self._range_bounds(a1_range)
+                value_ranges.append([list(row[first_column - 1:last_column])
+                                     for row in self.values[first_row - 1:last_row]])
+        return value_ranges
+
+    def batch_update(self, updates):
+        self._request()
+        with self._lock:
+            for update in updates:
+                first_row, first_column, _, _ = self._range_bounds(update["range"])
+                for row_offset, row_values in enumerate(update["values"]):
+                    row = self.values[first_row - 1 + row_offset]
+                    for column_offset, value in enumerate(row_values):
+                        column_index = first_column - 1 + column_offset
+                        row.extend([""] * (column_index + 1 - len(row)))
+                        row[column_index] = value
+
+    def append_rows(self, rows, **kwargs):
+        self._request()
+        with self._lock:
+            first_row = len(self.values) + 1
+            self.values.extend(list(row) for row in rows)
+            # The same response as the Sheets API ("updates.updatedRange" says where the rows went).
+            return {"updates": {"updatedRange": f"'{self.title}'!A{first_row}:H{len(self.values)}",
+                                "updatedRows": len(rows)}}
+
+
+class FakeSheetsClient:
+    """
+    An in-memory stand-in for an authenticated gspread client: open(name)
+    returns a spreadsheet whose 'sheet1' is the FakeWorksheet given for that name.
     """
-    Appends a new row to the specified Google Sheet with invoice data.
+
+    def __init__(self, worksheets):
+        self.worksheets = worksheets
+
+    def open(self, sheet_name):
+        return SimpleNamespace(sheet1=self.worksheets[sheet_name])
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_sheets_session():
+    """Returns the shared SheetsSession for the invoice sheet, creating it on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = SheetsSession()
+            # Record written rows in the job journal, so a rerun never appends them twice.
+            _session.add_flush_listener(job_journal.mark_written)
+        return _session
+
+
+def append_to_sheet(data_dict, idempotency_key=None):
+    """
+    Queues a new row for the invoice Google Sheet. Rows are written in bulk by
+    the shared SheetsSession; call flush_sheet() at the end of a batch.
+    Rows whose idempotency key is already in the sheet (according to the job
+    journal) are skipped.
 
     Args:
         data_dict (dict): A dictionary containing the invoice data.
+        idempotency_key (str): See job_journal.make_idempotency_key().
     """
-    try:
-        print("Connecting to Google Sheets...")
-        # Authenticate using the service account and the JSON key file.
-        gc = gspread.service_account(filename=config.CREDENTIALS_FILE)
-
-        # Open the spreadsheet by its name.
-        spreadsheet = gc.open(config.INVOICE_SHEET_NAME)
-
-        # Select the first worksheet.
-        worksheet = spreadsheet.sheet1
-        print(f"Successfully connected to worksheet: '{worksheet.title}'")
-
-        # Prepare the data row in the correct order of your columns.
-        # Make sure this order matches your Google Sheet columns exactly!
-        row_to_add = [
-            data_dict.get("supplier", ""),  # Column A: Supplier Name
-            data_dict.get("date", ""),  # Column B: Invoice Date
-            data_dict.get("invoice_id", ""),  # Column C: Invoice Number
-            data_dict.get("tax", ""),  # Column D: Tax
-            data_dict.get("total", ""),  # Column E: Total Amount
-            "",  # Column F: Paid On (always blank on creation)
-            data_dict.get("filename", "NO_FILENAME_PASSED"),  # Column G: Filename
-            ""  # Column H: Match Percentage (always blank on creation)
-        ]
-
-        # Append the new row to the sheet.
-        worksheet.append_row(row_to_add)
-        print("Successfully appended a new row to the sheet!")
+    if idempotency_key and job_journal.is_written(idempotency_key):
+        logger.info("  --> Row for %s is already in the sheet. Skipping.", data_dict.get('filename'))
         return True
+    if config.LEDGER_STORE_ENABLED:
+        # The row is safe in the local ledger now; the background sync copies it to the sheet.
+        ledger_store.add_invoice(data_dict, idempotency_key)
+        if idempotency_key:
+            job_journal.mark_written([idempotency_key])
+        start_ledger_sync()
+        return True
+    return get_sheets_session().append(data_dict, idempotency_key)
+
+
+def flush_sheet(retries=3, retry_delay_seconds=5):
+    """
+    Writes any buffered rows to the invoice sheet (with the ledger store: brings
+    the sheets up to date with the ledger), retrying a few times if the write
+    fails. Returns True if every row was written.
+    """
+    session = get_sheets_session()
+    for attempt in range(retries + 1):
+        if sync_ledger() if config.LEDGER_STORE_ENABLED else session.flush():
+            return True
+        if attempt < retries:
+            time.sleep(retry_delay_seconds * (attempt + 1))
+    logger.warning("  --> WARNING: %d row(s) could not be written to Google Sheets.",
+                   len(ledger_store.rows_to_append(ledger_store.INVOICES)) if config.LEDGER_STORE_ENABLED
+                   else session.pending_rows)
+    return False
+
+
+# --- LEDGER MIRROR ---
+# With config.LEDGER_STORE_ENABLED, the local ledger (ledger_store.py) holds the
+# invoices and payments, and the two sheets mirror it. Each sync:
+#   1. appends the rows the sheets do not have yet, in one request per sheet;
+#   2. reads the rows added to the sheets since the last sync, and the rows still
+#      unpaid or unmatched (where people mark payments by hand), into the ledger
+#      (all rows the first time, or when a sheet no longer looks like it did);
+#   3. copies the cells reconciliation changed, checking first that every row
+#      is still where we think it is (if not, the whole sheet is read again).
+# A background thread syncs every config.LEDGER_SYNC_INTERVAL_SECONDS; a failed
+# sync (e.g. the Sheets quota ran out) changes nothing and is simply retried.
+
+# The cells reconciliation changes in each sheet, as (first, last) column numbers. The
+# invoice range includes the filename between 'Paid On' and 'Match Percentage': it is a
+# key column, checked to be unchanged right before writing.
+CHANGED_COLUMNS = {ledger_store.INVOICES: (6, 8), ledger_store.PAYMENTS: (4, 5)}
+KEY_COLUMNS = {ledger_store.INVOICES: ledger_store.INVOICE_KEY_COLUMNS,
+               ledger_store.PAYMENTS: ledger_store.BANK_KEY_COLUMNS}
+# At most this many rows are appended per request.
+MAX_ROWS_PER_APPEND = 5000
+# "'Sheet1'!A12:H14" -> the first row, 12.
+UPDATED_RANGE_PATTERN = re.compile(r"![A-Z]+(\d+)")
+
+_sync_lock = threading.Lock()
+_sync_thread = None
+_sync_thread_lock = threading.Lock()
+_sync_requested = threading.Event()
+
+
+def _ledger_worksheets():
+    """The worksheet of each ledger table."""
+    session = get_sheets_session()
+    return {
+        ledger_store.INVOICES: session.get_worksheet(),
+        ledger_store.PAYMENTS: session.get_client().open(config.BANK_SHEET_NAME).sheet1,
+    }
+
 
-    except Exception as e:
-        print(f"An error occurred while connecting to Google Sheets: {e}")
-        return False
+def _append_ledger_rows(table, worksheet):
+    """Appends the rows the sheet does not have yet. Returns how many were appended."""
+    rows = ledger_store.rows_to_append(table)
+    for chunk_start in range(0, len(rows), MAX_ROWS_PER_APPEND):
+        chunk = rows[chunk_start:chunk_start + MAX_ROWS_PER_APPEND]
+        with timed("sheet_write"):
+            response = call_provider("sheets", worksheet.append_rows, [values for _, values in chunk])
+        updated_range = response.get("updates", {}).get("updatedRange", "") if isinstance(response, dict) else ""
+        match = UPDATED_RANGE_PATTERN.search(updated_range)
+        ledger_store.mark_appended(table, [row_id for row_id, _ in chunk], int(match.group(1)) if match else None)
+        count("sheet_rows_written", len(chunk))
+    if rows:
+        logger.info("Successfully appended %d row(s) to '%s'!", len(rows), worksheet.title)
+    return len(rows)
+
+
+def _pull_ledger_rows(table, worksheet, full=False):
+    """
+    Reads the rows added to the sheet since the last sync, and the still unpaid
+    or unmatched rows (to bring in hand edits), into the ledger; with full=True,
+    all of them.
+    """
+    state = None if full else ledger_store.load_sync_state(table)
+    sheet_state = dict(state, unmatched=ledger_store.open_sheet_rows(table)) if state else None
+    with timed("sheet_read"):
+        header, rows, incremental = fetch_sheet_rows(worksheet, sheet_state, KEY_COLUMNS[table])
+    added = ledger_store.merge_sheet_rows(table, rows, full=not incremental)
+    if added is None:
+        logger.info("  --> '%s' was re-ordered since the last sync. Reading all rows.", worksheet.title)
+        with timed("sheet_read"):
+            header, rows, incremental = fetch_sheet_rows(worksheet, None, KEY_COLUMNS[table])
+        added = ledger_store.merge_sheet_rows(table, rows, full=True)
+    if header:
+        last_row = max([state["last_row"] if incremental else 1] + [row_number for row_number, _ in rows])
+        ledger_store.save_sync_state(table, {"header": header, "last_row": last_row})
+    if added:
+        logger.info("  --> %d new row(s) from '%s'.", added, worksheet.title)
+
+
+def _push_ledger_changes(table, worksheet):
+    """
+    Copies the changed cells to the sheet in one request. Returns False (writing
+    nothing) if a row is no longer where the ledger thinks it is.
+    """
+    rows = ledger_store.changed_rows(table)
+    if not rows:
+        return True
+    # Check the key columns of every row first, so we never write into the wrong row.
+    width = len(rows[0][3])
+    last_column = gspread.utils.rowcol_to_a1(1, width).rstrip("0123456789")
+    ranges = group_into_ranges([sheet_row for _, sheet_row, _, _ in rows])
+    sheet_rows = {}
+    with timed("sheet_read"):
+        for chunk_start in range(0, len(ranges), MAX_RANGES_PER_REQUEST):
+            chunk = ranges[chunk_start:chunk_start + MAX_RANGES_PER_REQUEST]
+            value_ranges = call_provider("sheets", worksheet.batch_get,
+                                         [f"A{first}:{last_column}{last}" for first, last in chunk])
+            for (first, _), values in zip(chunk, value_ranges):
+                for offset, row in enumerate(values):
+                    sheet_rows[first + offset] = (list(row) + [""] * width)[:width]
+    for _, sheet_row, sheet_key, _ in rows:
+        if ledger_store.sheet_key(table, sheet_rows.get(sheet_row, [""] * width)) != sheet_key:
+            return False
+
+    first_column, last_column = CHANGED_COLUMNS[table]
+    updates = [{
+        "range": f"{gspread.utils.rowcol_to_a1(sheet_row, first_column)}:"
+                 f"{gspread.utils.rowcol_to_a1(sheet_row, last_column)}",
+        "values": [values[first_column - 1:last_column]],
+    } for _, sheet_row, _, values in rows]
+    with timed("sheet_write"):
+        call_provider("sheets", worksheet.batch_update, updates)
+    ledger_store.mark_unchanged(table, [row_id for row_id, _, _, _ in rows])
+    logger.info("Updated %d row(s) in '%s'.", len(rows), worksheet.title)
+    return True
+
+
+def sync_ledger(full=False):
+    """
+    Brings the sheets and the local ledger up to date with each other (see
+    above). With full=True every row of both sheets is read again. Returns True
+    if the sync succeeded, False if it failed (it is retried on the next sync).
+    """
+    with _sync_lock:
+        try:
+            for table, worksheet in _ledger_worksheets().items():
+                _append_ledger_rows(table, worksheet)
+                _pull_ledger_rows(table, worksheet, full)
+                if not _push_ledger_changes(table, worksheet):
+                    logger.info("  --> Rows moved in '%s'. Reading all rows before updating.", worksheet.title)
+                    _pull_ledger_rows(table, worksheet, full=True)
+                    _push_ledger_changes(table, worksheet)
+            return True
+        except Exception as e:
+            logger.error("An error occurred while syncing the ledger with Google Sheets: %s", e)
+            return False
+
+
+def _ledger_sync_loop():
+    while True:
+        _sync_requested.wait(config.LEDGER_SYNC_INTERVAL_SECONDS)
+        _sync_requested.clear()
+        sync_ledger()
+
+
+def start_ledger_sync(now=False):
+    """
+    Starts the background sync (if it is not running yet). With now=True it
+    syncs right away instead of at the next interval.
+    """
+    global _sync_thread
+    with _sync_thread_lock:
+        if _sync_thread is None:
+            _sync_thread = threading.Thread(target=_ledger_sync_loop, name="ledger-sync", daemon=True)
+            _sync_thread.start()
+    if now:
+        _sync_requested.set()
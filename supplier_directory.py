@@ -0,0 +1,195 @@
+# supplier_directory.py
+# A local directory of the suppliers we have seen, keyed by their NIF/CIF.
+#
+# The same few hundred suppliers send invoices month after month. Every
+# verified invoice with a supplier NIF adds to (or updates) its entry: the
+# spellings of the name seen on verified invoices (the most frequent one is
+# the canonical name, so a misread name is outvoted by later invoices), and a
+# layout hint (what their invoice numbers look like). Matches made during
+# reconciliation add the bank descriptions the supplier's payments use
+# ("bank aliases").
+#
+# Extraction uses it to skip supplier identification when the NIF is already
+# known, and to keep one name per supplier in the sheet; reconciliation uses it
+# to match payments with a known bank alias without any fuzzy scoring.
+
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import config
+from instrumentation import count
+from invoice_model import normalize_tax_id
+from name_scoring import normalize_name
+
+# At most this many spellings (the most seen) and bank aliases (the most recent) are kept per supplier.
+MAX_NAMES_PER_SUPPLIER = 10
+MAX_BANK_ALIASES_PER_SUPPLIER = 20
+
+_connection = None
+_lock = threading.Lock()
+
+
+@dataclass
+class Supplier:
+    """One supplier in the directory."""
+    nif: str
+    # The canonical name: the spelling seen on the most verified invoices.
+    name: str
+    # {spelling of the name: number of verified invoices it was seen on}.
+    names: Dict[str, int] = field(default_factory=dict)
+    # Bank descriptions of payments matched to this supplier (see bank_alias()).
+    bank_aliases: List[str] = field(default_factory=list)
+    layout: Dict[str, str] = field(default_factory=dict)
+    invoice_count: int = 0
+
+
+def bank_alias(description):
+    """
+    The part of a bank description that stays the same from one payment to the
+    next: the normalized words without any digits (references, dates, amounts).
+    """
+    return " ".join(word for word in normalize_name(description).split() if not any(c.isdigit() for c in word))
+
+
+def _get_connection():
+    """Opens the directory database on first use (caller must hold the lock)."""
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(config.SUPPLIER_DIRECTORY_FILE, check_same_thread=False, timeout=30)
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS suppliers (
+                nif TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                names_json TEXT NOT NULL,
+                bank_aliases_json TEXT NOT NULL,
+                layout_json TEXT NOT NULL,
+                invoice_count INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        _connection.commit()
+    return _connection
+
+
+def _row_to_supplier(row):
+    nif, name, names_json, bank_aliases_json, layout_json, invoice_count = row
+    names = json.loads(names_json)
+    if isinstance(names, list):
+        # Entries written before the spellings were counted.
+        names = dict.fromkeys([name] + names, 1)
+    return Supplier(nif, name, names, json.loads(bank_aliases_json), json.loads(layout_json), invoice_count)
+
+
+def _fetch(connection, nif):
+    row = connection.execute(
+        "SELECT nif, name, names_json, bank_aliases_json, layout_json, invoice_count FROM suppliers WHERE nif = ?",
+        (nif,)).fetchone()
+    return _row_to_supplier(row) if row else None
+
+
+def _save(connection, supplier):
+    connection.execute(
+        "INSERT OR REPLACE INTO suppliers VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (supplier.nif, supplier.name, json.dumps(supplier.names), json.dumps(supplier.bank_aliases),
+         json.dumps(supplier.layout), supplier.invoice_count, time.time()))
+
+
+def lookup_supplier(nif):
+    """Returns the Supplier with this NIF/CIF (in any common format), or None if it is unknown."""
+    nif = normalize_tax_id(nif)
+    if not config.SUPPLIER_DIRECTORY_ENABLED or not nif:
+        return None
+    with _lock:
+        supplier = _fetch(_get_connection(), nif)
+    count("supplier_directory_lookups", outcome="hit" if supplier else "miss")
+    return supplier
+
+
+def known_spelling(supplier, name):
+    """True if 'name' (in any case) is a spelling already seen for this supplier."""
+    normalized = normalize_name(name)
+    return any(normalize_name(spelling) == normalized for spelling in supplier.names)
+
+
+def record_invoice(data_dict):
+    """
+    Adds a verified invoice's supplier to the directory, or updates its entry.
+    The invoice's spelling of the name counts as one vote: the most voted
+    spelling becomes the canonical name. Invoices without a valid supplier NIF
+    (or with our own) are ignored.
+    """
+    nif = normalize_tax_id(data_dict.get('supplier_nif'))
+    name = str(data_dict.get('supplier') or "").strip()
+    # A name that still has a label ("Nombre: ...") was misread.
+    if not config.SUPPLIER_DIRECTORY_ENABLED or not nif or not name or ":" in name or \
+            nif == normalize_tax_id(config.MY_COMPANY_CIF):
+        return
+    with _lock:
+        connection = _get_connection()
+        supplier = _fetch(connection, nif) or Supplier(nif, name)
+        supplier.names[name] = supplier.names.get(name, 0) + 1
+        # On a tie the current canonical name stays.
+        most_voted = max(supplier.names, key=supplier.names.get)
+        if supplier.names[most_voted] > supplier.names.get(supplier.name, 0):
+            supplier.name = most_voted
+        if len(supplier.names) > MAX_NAMES_PER_SUPPLIER:
+            others = sorted(supplier.names, key=supplier.names.get, reverse=True)
+            kept = [supplier.name] + [spelling for spelling in others if spelling != supplier.name]
+            kept = kept[:MAX_NAMES_PER_SUPPLIER]
+            supplier.names = {spelling: supplier.names[spelling] for spelling in kept}
+        if data_dict.get('invoice_id'):
+            supplier.layout['invoice_id_example'] = str(data_dict['invoice_id'])
+        supplier.invoice_count += 1
+        _save(connection, supplier)
+        connection.commit()
+
+
+def load_name_index():
+    """
+    Returns {normalized name: Supplier} for every canonical name and other
+    spelling in the directory, for looking suppliers up by the name in the sheet.
+    """
+    if not config.SUPPLIER_DIRECTORY_ENABLED:
+        return {}
+    with _lock:
+        rows = _get_connection().execute(
+            "SELECT nif, name, names_json, bank_aliases_json, layout_json, invoice_count FROM suppliers").fetchall()
+    index = {}
+    for row in rows:
+        supplier = _row_to_supplier(row)
+        for name in [supplier.name, *supplier.names]:
+            index.setdefault(normalize_name(name), supplier)
+    return index
+
+
+def learn_bank_aliases(suppliers_and_descriptions):
+    """
+    Remembers the bank descriptions of matched payments. Takes (Supplier,
+    description) pairs; returns the number of new aliases.
+    """
+    if not config.SUPPLIER_DIRECTORY_ENABLED:
+        return 0
+    new_aliases = {}
+    for supplier, description in suppliers_and_descriptions:
+        alias = bank_alias(description)
+        if alias:
+            new_aliases.setdefault(supplier.nif, []).append(alias)
+
+    added = 0
+    with _lock:
+        connection = _get_connection()
+        for nif, aliases in new_aliases.items():
+            supplier = _fetch(connection, nif)
+            if supplier is None:
+                continue
+            for alias in aliases:
+                if alias not in supplier.bank_aliases:
+                    supplier.bank_aliases = (supplier.bank_aliases + [alias])[-MAX_BANK_ALIASES_PER_SUPPLIER:]
+                    added += 1
+            _save(connection, supplier)
+        connection.commit()
+    return added
@@ -0,0 +1,95 @@
+import datetime
+import io
+import zipfile
+from decimal import Decimal
+
+import pytest
+
+from bank_importer import BankMovement, STATEMENT_EXTENSIONS, _find_columns, _norma43_movement, read_bank_statement
+
+
+def _movement_record(date="250114", concept="04", flag="1", cents=123456, reference1="", reference2=""):
+    """A Norma 43 movement record ("22"), laid out column by column."""
+    record = ("22" + "    " + "0001" + date + date + concept + "000" + flag + f"{cents:014d}"
+              + "0000000000" + reference1.ljust(12) + reference2.ljust(16))
+    assert len(record) == 80
+    return record
+
+
+def _concept_record(first, second=""):
+    return ("2301" + first.ljust(38) + second.ljust(38))[:80]
+
+
+def test_norma43_movement_fields_come_from_their_columns():
+    movement = _norma43_movement(_movement_record(reference1="REF000000123", reference2="ACME SUMINISTROS"), [])
+
+    assert movement == BankMovement(datetime.date(2025, 1, 14), Decimal("1234.56"), "ACME SUMINISTROS",
+                                    "REF000000123", "")
+
+
+def test_norma43_credits_are_negative_and_fall_back_to_the_common_concept():
+    movement = _norma43_movement(_movement_record(concept="02", flag="2", cents=5000), [])
+
+    assert movement.amount == Decimal("-50.00")
+    assert movement.description == "ABONARES - ENTREGAS - INGRESOS"
+
+
+def test_norma43_statement_joins_concept_records_to_their_movement():
+    statement = "\r\n".join([
+        "11" + "0" * 30 + " " * 48,
+        _movement_record(reference2="REF2"),
+        _concept_record("TRANSFERENCIA A", "ACME SUMINISTROS SL"),
+        _concept_record("FACTURA F-2025-001"),
+        _movement_record(date="250115", cents=990),
+        "33" + " " * 78,
+        "88" + " " * 78,
+    ]).encode("latin-1")
+
+    movements = list(read_bank_statement(io.BytesIO(statement), "extracto.n43"))
+
+    assert [(m.date.day, m.amount, m.description, m.details1, m.details2) for m in movements] == [
+        (14, Decimal("1234.56"), "TRANSFERENCIA A ACME SUMINISTROS SL", "FACTURA F-2025-001", "REF2"),
+        (15, Decimal("9.90"), "GIROS - TRANSFERENCIAS - TRASPASOS - CHEQUES", "", ""),
+    ]
+
+
+def test_header_synonyms_are_found_without_accents_or_currency():
+    columns = _find_columns(["F. Valor", "Fecha Operación", "Concepto", "Cargo (EUR)", "Abono (EUR)",
+                             "Observaciones", "Beneficiario"])
+
+    assert columns == {"date": 1, "description": 2, "amount": None, "debit": 3, "credit": 4,
+                       "details1": 5, "details2": 6}
+
+
+def test_a_row_without_an_amount_column_is_not_a_header():
+    assert _find_columns(["Fecha", "Concepto", "Saldo"]) is None
+
+
+def test_csv_statement_with_debit_and_credit_columns():
+    statement = ("Movimientos de la cuenta\n"
+                 "Fecha;Concepto;Cargo;Abono\n"
+                 "14/01/2025;RECIBO ACME SUMINISTROS;1.234,56;\n"
+                 "15/01/2025;TRANSFERENCIA RECIBIDA;;50,00\n"
+                 ";Saldo final;;\n").encode("cp1252")
+
+    movements = list(read_bank_statement(io.BytesIO(statement), "movimientos.csv"))
+
+    assert [(m.description, m.amount) for m in movements] == [
+        ("RECIBO ACME SUMINISTROS", Decimal("1234.56")), ("TRANSFERENCIA RECIBIDA", Decimal("-50.00"))]
+
+
+def _zip_without_a_workbook():
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w") as archive:
+        archive.writestr("readme.txt", "not a workbook")
+    return content.getvalue()
+
+
+@pytest.mark.parametrize("content", [b"PK\x03\x04 broken" * 10, _zip_without_a_workbook()])
+def test_a_damaged_workbook_raises_value_error(content):
+    with pytest.raises(ValueError, match="could not be read"):
+        list(read_bank_statement(io.BytesIO(content), "movimientos.xlsx"))
+
+
+def test_every_readable_extension_is_listed():
+    assert {".csv", ".xlsx", ".xlsm", ".n43", ".q43", ".c43", ".aeb", ".txt"} <= set(STATEMENT_EXTENSIONS)
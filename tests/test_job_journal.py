@@ -0,0 +1,48 @@
+import sqlite3
+
+import pytest
+
+import config
+import job_journal
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    """A fresh, empty journal database."""
+    monkeypatch.setattr(config, "JOB_JOURNAL_FILE", str(tmp_path / "journal.sqlite"))
+    monkeypatch.setattr(job_journal, "_connection", None)
+    yield job_journal
+    if job_journal._connection is not None:
+        job_journal._connection.close()
+    job_journal._connection = None
+
+
+def test_data_is_only_reused_by_the_same_version(journal):
+    journal.start_job("hash", "a.pdf", "v1")
+    journal.mark_extracted("hash", {"invoice_id": "F-1"}, "v1")
+
+    assert journal.start_job("hash", "a.pdf", "v1")["data"] == {"invoice_id": "F-1"}
+    assert journal.start_job("hash", "a.pdf", "v2")["data"] is None
+
+
+def test_data_extracted_again_replaces_unwritten_data(journal):
+    journal.start_job("hash", "a.pdf", "v1")
+    journal.mark_extracted("hash", {"invoice_id": "F-1"}, "v1")
+    journal.mark_extracted("hash", {"invoice_id": "F-2"}, "v2")
+
+    assert journal.start_job("hash", "a.pdf", "v2")["data"] == {"invoice_id": "F-2"}
+
+
+def test_journals_without_a_version_column_are_upgraded(journal):
+    connection = sqlite3.connect(config.JOB_JOURNAL_FILE)
+    connection.execute("CREATE TABLE jobs (file_hash TEXT PRIMARY KEY, filename TEXT NOT NULL, state TEXT NOT NULL, "
+                       "data_json TEXT, idempotency_key TEXT, error TEXT, extracted_at REAL, written_at REAL, "
+                       "archived_at REAL, updated_at REAL NOT NULL)")
+    connection.execute("INSERT INTO jobs (file_hash, filename, state, data_json, updated_at) "
+                       "VALUES ('hash', 'a.pdf', 'extracted', '{\"invoice_id\": \"F-1\"}', 0)")
+    connection.commit()
+    connection.close()
+
+    job = journal.start_job("hash", "a.pdf", "v1")
+    assert job["state"] == journal.EXTRACTED
+    assert job["data"] is None
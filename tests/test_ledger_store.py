@@ -0,0 +1,52 @@
+import pytest
+
+import ledger_store
+from sheets_connector import FakeWorksheet, _pull_ledger_rows
+
+INVOICE_ROWS = [
+    ["Acme Suministros SL", "02-01-2025", "F-1", "21.00", "121.00", "", "a.pdf", ""],
+    ["Papelera del Norte SA", "03-01-2025", "F-2", "42.00", "242.00", "", "b.pdf", ""],
+    ["Acme Suministros SL", "04-01-2025", "F-3", "10.50", "60.50", "", "c.pdf", ""],
+]
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    """A fresh, empty ledger."""
+    ledger_store.use_ledger_file(str(tmp_path / "ledger.sqlite"))
+    yield ledger_store
+    ledger_store.use_ledger_file(str(tmp_path / "closed.sqlite"))
+
+
+def _numbered(rows, first_row=2):
+    return list(enumerate(rows, first_row))
+
+
+def _unpaid_numbers(ledger):
+    return [row[4] for row in ledger.fetch_invoices(unpaid_only=True)]
+
+
+def test_rows_in_a_new_order_are_placed_again_by_their_key(ledger):
+    assert ledger.merge_sheet_rows(ledger.INVOICES, _numbered(INVOICE_ROWS), full=True) == 3
+
+    reordered = [INVOICE_ROWS[2], INVOICE_ROWS[0], INVOICE_ROWS[1]]
+    assert ledger.merge_sheet_rows(ledger.INVOICES, _numbered(reordered)) is None
+    assert ledger.merge_sheet_rows(ledger.INVOICES, _numbered(reordered), full=True) == 0
+    assert [row[4] for row in ledger.fetch_invoices()] == ["F-3", "F-1", "F-2"]
+
+
+def test_an_incremental_merge_adds_only_new_rows(ledger):
+    ledger.merge_sheet_rows(ledger.INVOICES, _numbered(INVOICE_ROWS[:2]), full=True)
+
+    assert ledger.merge_sheet_rows(ledger.INVOICES, [(4, INVOICE_ROWS[2])]) == 1
+    assert len(ledger.fetch_invoices()) == 3
+
+
+def test_hand_edits_to_unpaid_rows_are_pulled_incrementally(ledger):
+    worksheet = FakeWorksheet([ledger.INVOICE_COLUMNS] + INVOICE_ROWS, title="Invoices")
+    _pull_ledger_rows(ledger.INVOICES, worksheet)
+
+    worksheet.values[2][5] = "20-01-2025"
+    _pull_ledger_rows(ledger.INVOICES, worksheet)
+
+    assert _unpaid_numbers(ledger) == ["F-1", "F-3"]
@@ -0,0 +1,77 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+import main
+
+WORKERS = 8
+
+
+def _race_moves(tmp_path, monkeypatch):
+    """
+    Moves WORKERS files, all named 'factura.pdf', into one folder at the same
+    time, with every file move slowed down (so the moves overlap).
+    """
+    original_move = shutil.move
+
+    def slow_move(source, destination):
+        time.sleep(0.05)
+        return original_move(source, destination)
+    monkeypatch.setattr(shutil, "move", slow_move)
+    destination_folder = tmp_path / "archive"
+    destination_folder.mkdir()
+    sources = []
+    for worker in range(WORKERS):
+        source_folder = tmp_path / f"run-{worker}"
+        source_folder.mkdir()
+        source_path = source_folder / "factura.pdf"
+        source_path.write_bytes(f"invoice {worker}".encode())
+        sources.append(str(source_path))
+
+    barrier = threading.Barrier(WORKERS)
+    results = [None] * WORKERS
+
+    def move(worker):
+        barrier.wait()
+        results[worker] = main._move_without_overwrite(sources[worker], str(destination_folder), "factura.pdf")
+
+    threads = [threading.Thread(target=move, args=(worker,)) for worker in range(WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sources, results, destination_folder
+
+
+@pytest.mark.parametrize("hard_links", [True, False])
+def test_parallel_moves_of_the_same_name_never_overwrite(tmp_path, monkeypatch, hard_links):
+    if not hard_links:
+        def no_link(source, destination):
+            raise OSError("hard links are not supported")
+        monkeypatch.setattr(os, "link", no_link)
+
+    sources, results, destination_folder = _race_moves(tmp_path, monkeypatch)
+
+    assert len(set(results)) == WORKERS
+    assert sorted(path.read_bytes() for path in destination_folder.iterdir()) == \
+        sorted(f"invoice {worker}".encode() for worker in range(WORKERS))
+    assert not any(os.path.exists(source) for source in sources)
+
+
+def test_a_missing_source_leaves_no_placeholder(tmp_path, monkeypatch):
+    def no_link(source, destination):
+        raise OSError("hard links are not supported")
+    monkeypatch.setattr(os, "link", no_link)
+
+    with pytest.raises(FileNotFoundError):
+        main._move_without_overwrite(str(tmp_path / "gone.pdf"), str(tmp_path), "factura.pdf")
+    assert not (tmp_path / "factura.pdf").exists()
+
+
+def test_only_invoice_files_are_picked_up():
+    assert all(main.is_invoice_file(name) for name in ["factura.pdf", "FOTO.JPG", "ticket.jpeg", "scan.png"])
+    assert not any(main.is_invoice_file(name) for name in
+                   ["factura.pdf.part", "factura.pdf.crdownload", ".factura.pdf", "~$factura.pdf", "notas.txt"])
@@ -0,0 +1,65 @@
+import pandas as pd
+
+from matching_engine import GROUP_MATCH_SCORE, find_group_matches, subset_with_sum
+
+
+def _invoices(rows):
+    """Unpaid invoices as reconcile_sheets() prepares them: (supplier, date, total) rows."""
+    return pd.DataFrame({"Supplier Name": [supplier for supplier, _, _ in rows],
+                         "Invoice Date": pd.to_datetime([date for _, date, _ in rows]),
+                         "Total Amount": [total for _, _, total in rows]})
+
+
+def _payments(rows):
+    """Available payments: (date, amount, description) rows."""
+    return pd.DataFrame({"Date": pd.to_datetime([date for date, _, _ in rows]),
+                         "Amount": [amount for _, amount, _ in rows],
+                         "Description": [description for _, _, description in rows],
+                         "Bank Details 1": "", "Bank Details 2": ""})
+
+
+def _group_matches(invoices, payments, window_days=60, max_items=4):
+    return find_group_matches(_invoices(invoices), _payments(payments), tolerance_days=5, window_days=window_days,
+                              primary_threshold=85, secondary_threshold=90, max_items=max_items,
+                              max_candidates=20)
+
+
+def test_subset_with_sum_prefers_the_fewest_amounts():
+    assert subset_with_sum([500, 300, 200, 1000], 1000, 4) == [3]
+    assert subset_with_sum([500, 300, 200, 1000], 800, 4) == [0, 1]
+
+
+def test_subset_with_sum_respects_the_item_limit():
+    assert subset_with_sum([100, 200, 300, 400], 1000, 4) == [0, 1, 2, 3]
+    assert subset_with_sum([100, 200, 300, 400], 1000, 3) is None
+
+
+def test_subset_with_sum_without_an_exact_sum():
+    assert subset_with_sum([100, 200], 301, 4) is None
+    assert subset_with_sum([100, 200], 1000, 4) is None
+
+
+def test_an_invoice_paid_in_instalments():
+    matches = _group_matches(
+        [("Acme Suministros SL", "2025-01-10", 1000.00)],
+        [("2025-01-20", 400.00, "TRANSF ACME SUMINISTROS 1/2"), ("2025-02-20", 600.00, "TRANSF ACME SUMINISTROS 2/2"),
+         ("2025-01-25", 600.00, "RECIBO PAPELERA DEL NORTE")])
+
+    assert matches == [([0], [0, 1], GROUP_MATCH_SCORE)]
+
+
+def test_several_invoices_paid_together():
+    matches = _group_matches(
+        [("Papelera del Norte SA", "2025-01-05", 121.00), ("Acme Suministros SL", "2025-01-06", 121.00),
+         ("Papelera del Norte SA", "2025-01-12", 242.00)],
+        [("2025-01-31", 363.00, "TRANSFERENCIA PAPELERA DEL NORTE")])
+
+    assert matches == [([0, 2], [0], GROUP_MATCH_SCORE)]
+
+
+def test_payments_outside_the_window_are_not_grouped():
+    matches = _group_matches(
+        [("Acme Suministros SL", "2025-01-10", 1000.00)],
+        [("2025-01-20", 400.00, "TRANSF ACME SUMINISTROS"), ("2025-06-20", 600.00, "TRANSF ACME SUMINISTROS")])
+
+    assert matches == []
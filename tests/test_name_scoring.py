@@ -0,0 +1,56 @@
+import sqlite3
+
+from thefuzz import fuzz
+
+import config
+from name_scoring import NameScorer, normalize_name
+
+
+def _score(cache_file, supplier, descriptions):
+    scorer = NameScorer(cache_file)
+    scorer.load()
+    scores = scorer.score_many(normalize_name(supplier), [normalize_name(d) for d in descriptions])
+    scorer.save()
+    return scorer, scores
+
+
+def _cached_descriptions(cache_file):
+    with sqlite3.connect(cache_file) as connection:
+        return sorted(row[0] for row in connection.execute("SELECT description FROM name_scores"))
+
+
+def test_scores_match_thefuzz_for_names_with_digits(tmp_path):
+    pairs = [("Garaje 2000 SL", "RECIBO GARAJE 2000"), ("Casa Pepe", "CASA PEP 0012 33 55"),
+             ("Bar 7 SL", "TRANSF BAR 7 SL"), ("Hotel 3", "TRF HOTEL 3")]
+    cache_file = str(tmp_path / "scores.sqlite")
+    for supplier, description in pairs:
+        expected = fuzz.token_set_ratio(supplier, description)
+        # Scored the first time, then read back from the cache.
+        assert _score(cache_file, supplier, [description])[1] == [expected]
+        scorer, scores = _score(cache_file, supplier, [description])
+        assert scores == [expected] and scorer.pairs_from_cache == 1
+
+
+def test_descriptions_are_cached_in_full(tmp_path):
+    cache_file = str(tmp_path / "scores.sqlite")
+    _score(cache_file, "Acme Suministros SL", ["TRANSF 000123 ACME SUMINISTROS"])
+
+    assert _cached_descriptions(cache_file) == ["transf 000123 acme suministros"]
+
+
+def test_only_the_descriptions_of_the_run_are_read(tmp_path):
+    cache_file = str(tmp_path / "scores.sqlite")
+    _score(cache_file, "Acme Suministros SL", ["RECIBO ACME SUMINISTROS", "RECIBO PAPELERA DEL NORTE"])
+
+    scorer, _ = _score(cache_file, "Acme Suministros SL", ["RECIBO ACME SUMINISTROS"])
+    assert scorer.pairs_from_cache == 1
+    assert list(scorer._scores) == [("acme suministros sl", "recibo acme suministros")]
+
+
+def test_scores_over_the_size_limit_are_evicted_least_recently_used_first(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "scores.sqlite")
+    monkeypatch.setattr(config, "NAME_SCORE_CACHE_MAX_ENTRIES", 2)
+    _score(cache_file, "Acme Suministros SL", ["RECIBO UNO"])
+    _score(cache_file, "Acme Suministros SL", ["RECIBO DOS", "RECIBO TRES"])
+
+    assert _cached_descriptions(cache_file) == ["recibo dos", "recibo tres"]
@@ -0,0 +1,51 @@
+import pytest
+
+import config
+import supplier_directory
+
+
+@pytest.fixture
+def directory(tmp_path, monkeypatch):
+    """A fresh, empty directory database."""
+    monkeypatch.setattr(config, "SUPPLIER_DIRECTORY_FILE", str(tmp_path / "suppliers.sqlite"))
+    monkeypatch.setattr(config, "SUPPLIER_DIRECTORY_ENABLED", True)
+    monkeypatch.setattr(supplier_directory, "_connection", None)
+    yield supplier_directory
+    if supplier_directory._connection is not None:
+        supplier_directory._connection.close()
+    supplier_directory._connection = None
+
+
+def _record(directory, name, nif="B12345674"):
+    directory.record_invoice({"supplier": name, "supplier_nif": nif, "invoice_id": "F-1"})
+
+
+def test_a_misread_first_name_is_outvoted(directory):
+    _record(directory, "ACME SUMINISTR0S SL")
+    _record(directory, "Acme Suministros SL")
+    _record(directory, "Acme Suministros SL")
+
+    supplier = directory.lookup_supplier("B12345674")
+    assert supplier.name == "Acme Suministros SL"
+    assert supplier.names == {"ACME SUMINISTR0S SL": 1, "Acme Suministros SL": 2}
+
+
+def test_a_tie_keeps_the_canonical_name(directory):
+    _record(directory, "Acme Suministros SL")
+    _record(directory, "Acme Suministros, S.L.")
+
+    assert directory.lookup_supplier("B12345674").name == "Acme Suministros SL"
+
+
+def test_names_with_a_label_are_not_recorded(directory):
+    _record(directory, "Nombre: Acme Suministros SL")
+
+    assert directory.lookup_supplier("B12345674") is None
+
+
+def test_known_spelling_ignores_case(directory):
+    _record(directory, "Acme Suministros, S.L.")
+    supplier = directory.lookup_supplier("B12345674")
+
+    assert directory.known_spelling(supplier, "ACME SUMINISTROS, S.L.")
+    assert not directory.known_spelling(supplier, "Otra Empresa SL")
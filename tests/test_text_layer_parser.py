@@ -0,0 +1,67 @@
+import fitz
+
+from text_layer_parser import extract_text_lines, is_complete_and_verified, parse_invoice_lines, INVOICE_ID_PATTERN
+
+
+def _make_pdf(lines):
+    """A one-page PDF with a text layer: each line is a list of (x, text) pieces."""
+    doc = fitz.open()
+    page = doc.new_page()
+    for row, pieces in enumerate(lines):
+        for x, text in pieces:
+            page.insert_text((x, 60 + row * 20), text, fontsize=10)
+    content = doc.tobytes()
+    doc.close()
+    return content
+
+
+def _parse(lines):
+    return parse_invoice_lines(extract_text_lines(_make_pdf(lines)))
+
+
+AMOUNT_LINES = [
+    [(50, "Concepto: material de oficina y suministros varios para el local")],
+    [(50, "Base Imponible"), (400, "100,00")],
+    [(50, "Cuota IVA 21%"), (400, "21,00")],
+    [(50, "Total Factura"), (400, "121,00")],
+]
+
+
+def test_heading_above_a_name_label_is_not_an_invoice_number():
+    parsed = _parse([
+        [(50, "FACTURA")],
+        [(50, "Nombre: Suministros Baleares S.L.")],
+        [(50, "CIF: B12345674")],
+        [(50, "Fecha: 15/03/2024")],
+    ] + AMOUNT_LINES)
+    assert "invoice_id" not in parsed
+    assert parsed["supplier"] == "Suministros Baleares S.L."
+    assert not is_complete_and_verified(parsed)
+
+
+def test_labelled_invoice_is_read_without_the_model():
+    parsed = _parse([
+        [(50, "FACTURA")],
+        [(50, "Empresa: Suministros Baleares S.L.")],
+        [(50, "CIF: B-12345674")],
+        [(50, "Nº Factura: A-2024/15"), (300, "Fecha: 15/03/2024")],
+    ] + AMOUNT_LINES)
+    assert parsed["invoice_id"] == "A-2024/15"
+    assert parsed["supplier"] == "Suministros Baleares S.L."
+    assert parsed["supplier_nif"] == "B12345674"
+    assert parsed["date"] == "15-03-2024"
+    assert is_complete_and_verified(parsed)
+
+
+def test_invoice_number_markers():
+    found = {text: [match.group(1) for match in INVOICE_ID_PATTERN.finditer(text)] for text in [
+        "Factura normal", "FACTURA\nNOTAS", "Factura nº 123", "Factura n.º 77", "Número de factura: F-9",
+        "Factura Núm. 45", "FACTURA No. 2024-1"]}
+    assert found == {"Factura normal": [], "FACTURA\nNOTAS": [], "Factura nº 123": ["123"], "Factura n.º 77": ["77"],
+                     "Número de factura: F-9": ["F-9"], "Factura Núm. 45": ["45"], "FACTURA No. 2024-1": ["2024-1"]}
+
+
+def test_invoice_number_without_digits_is_not_verified():
+    parsed = {"supplier": "Suministros Baleares S.L.", "date": "15-03-2024", "invoice_id": "ABC",
+              "total": "121,00", "subtotal": "100,00", "total_tax": "21,00"}
+    assert not is_complete_and_verified(parsed)
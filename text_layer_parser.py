@@ -0,0 +1,253 @@
+# text_layer_parser.py
+# A deterministic parser for Spanish invoices that come with a text layer.
+#
+# Most supplier PDFs are generated by software, so every word (and its position
+# on the page) can be read with PyMuPDF without any AI. We rebuild the visual
+# lines of each page, then look for the usual labels ("Total Factura",
+# "Base Imponible", "Cuota IVA", the invoice date and number) and the supplier's
+# NIF/CIF. The result uses the same fields as the AI agents return.
+
+import re
+
+import config
+from helpers import verify_and_calculate_tax
+from invoice_model import TAX_ID_PATTERN, normalize_amount, normalize_tax_id, parse_amount
+from providers import lazy_import
+
+# PyMuPDF, only imported when the first PDF is read.
+fitz = lazy_import("fitz")
+
+# Below this many characters, we treat the PDF as a scan without a usable text layer.
+MIN_TEXT_LAYER_CHARS = 100
+
+# Labels for each financial field, in order of preference (compared in lower case).
+AMOUNT_LABELS = {
+    "total": ["total factura", "total a pagar", "importe total"],
+    "subtotal": ["base imponible", "subtotal"],
+    "total_tax": ["cuota iva", "total iva", "importe iva"],
+}
+
+# An amount as a single word, e.g. "1.234,56", "484,10€" or "-12.50".
+AMOUNT_WORD = re.compile(r"^-?\d[\d.,]*€?$")
+DATE_PATTERN = re.compile(r"\b(\d{1,2})[/.\-](\d{1,2})[/.\-](\d{4}|\d{2})\b")
+LABELLED_DATE_PATTERN = re.compile(
+    r"fecha(?:\s+de)?(?:\s+(?:factura|emisi[oó]n|expedici[oó]n))?\s*:?\s*(\d{1,2}[/.\-]\d{1,2}[/.\-](?:\d{4}|\d{2}))\b")
+# A number marker ("nº", "n.º", "n°", "no.", "núm.", "número"), never the start of a word like "Nombre".
+NUMBER_MARKER = r"(?:n[úu]mero|n[úu]m\.?|no\.|n\.?\s?[º°])(?![a-záéíóúñ])"
+# The invoice number after "Nº Factura", "Factura nº", "Número de factura"... on the same line.
+INVOICE_ID_PATTERN = re.compile(
+    rf"(?:{NUMBER_MARKER}[ \t]*(?:de[ \t]+)?factura\b|\bfactura[ \t]*{NUMBER_MARKER})"
+    r"[ \t]*[:#]?[ \t]*([a-z0-9][\w/\-.]*)", re.IGNORECASE)
+# A label in front of the supplier's name, e.g. "Razón social:", "Nombre:" or "Empresa:".
+NAME_LABEL_PATTERN = re.compile(r"^(?:raz[oó]n\s+social|[^\W\d_]+)\s*:\s*", re.IGNORECASE)
+# Words further apart than this (in points) belong to different columns.
+COLUMN_GAP = 25
+COMPANY_SUFFIX_PATTERN = re.compile(r"\b(S\.?\s?L\.?U?|S\.?\s?A\.?U?|S\.?\s?C\.?P?|S\.?\s?COOP|C\.?\s?B)\.?(\s|,|$)",
+                                    re.IGNORECASE)
+
+
+class TextLine:
+    """One visual line of a page: its words (with positions) from left to right."""
+
+    def __init__(self, page_index, words):
+        self.page_index = page_index
+        self.words = sorted(words, key=lambda word: word[0])
+        self.text = " ".join(word[4] for word in self.words)
+        self.lower = self.text.lower()
+
+    def word_at_offset(self, offset):
+        """Returns the index of the word containing the character at 'offset' in self.text."""
+        position = 0
+        for index, word in enumerate(self.words):
+            position += len(word[4]) + 1
+            if offset < position:
+                return index
+        return len(self.words) - 1
+
+
+def extract_text_lines(file_content):
+    """
+    Reads every word of a PDF with its position and groups the words into
+    visual lines (top to bottom, page by page). Returns an empty list if the
+    PDF has no usable text layer.
+    """
+    lines = []
+    character_count = 0
+    doc = fitz.open(stream=file_content, filetype="pdf")
+    try:
+        for page_index in range(doc.page_count):
+            # Each word is (x0, y0, x1, y1, text, block_no, line_no, word_no).
+            words = doc.load_page(page_index).get_text("words")
+            words.sort(key=lambda word: ((word[1] + word[3]) / 2, word[0]))
+            current_line, current_center = [], None
+            for word in words:
+                center = (word[1] + word[3]) / 2
+                tolerance = max(2.0, (word[3] - word[1]) * 0.5)
+                if current_line and abs(center - current_center) > tolerance:
+                    lines.append(TextLine(page_index, current_line))
+                    current_line = []
+                if not current_line:
+                    current_center = center
+                current_line.append(word)
+                character_count += len(word[4])
+            if current_line:
+                lines.append(TextLine(page_index, current_line))
+    finally:
+        doc.close()
+
+    return lines if character_count >= MIN_TEXT_LAYER_CHARS else []
+
+
+def lines_to_text(lines):
+    """Joins the visual lines back into plain text, with a marker between pages."""
+    text_lines = []
+    for index, line in enumerate(lines):
+        if index > 0 and line.page_index != lines[index - 1].page_index:
+            text_lines.append(f"--- Page {line.page_index + 1} ---")
+        text_lines.append(line.text)
+    return "\n".join(text_lines)
+
+
+def _amount_in_words(words):
+    """Returns the first amount among the given words (as a normalized string), or None."""
+    for word in words:
+        if AMOUNT_WORD.match(word[4]):
+            return normalize_amount(word[4])
+    return None
+
+
+def _find_labelled_amount(lines, labels):
+    """
+    Finds the amount for a label, searching from the bottom of the last page up.
+    The amount is either to the right of the label on the same line, or in the
+    same column on one of the next two lines (for table-style summaries).
+    """
+    for label in labels:
+        for line_index in range(len(lines) - 1, -1, -1):
+            line = lines[line_index]
+            offset = line.lower.rfind(label)
+            if offset == -1:
+                continue
+
+            label_start = line.word_at_offset(offset)
+            label_end = line.word_at_offset(offset + len(label) - 1)
+            amount = _amount_in_words(line.words[label_end + 1:])
+            if amount:
+                return amount
+
+            # Table layout: look for a value right below the label.
+            label_left, label_right = line.words[label_start][0], line.words[label_end][2]
+            for next_line in lines[line_index + 1:line_index + 3]:
+                if next_line.page_index != line.page_index:
+                    break
+                column_words = [word for word in next_line.words
+                                if word[2] >= label_left - 30 and word[0] <= label_right + 30]
+                amount = _amount_in_words(column_words)
+                if amount:
+                    return amount
+    return None
+
+
+def _format_date(day, month, year):
+    if len(year) == 2:
+        year = "20" + year
+    return f"{int(day):02d}-{int(month):02d}-{year}"
+
+
+def _find_date(text):
+    """The invoice date as DD-MM-YYYY: the labelled one if present, otherwise the first date found."""
+    labelled = LABELLED_DATE_PATTERN.search(text.lower())
+    match = DATE_PATTERN.search(labelled.group(1) if labelled else text)
+    return _format_date(*match.groups()) if match else None
+
+
+def _column_segments(line):
+    """
+    Splits a line into its columns (runs of words separated by a wide gap).
+    Returns a list of (left_x, text) tuples.
+    """
+    segments = []
+    for word in line.words:
+        if segments and word[0] - segments[-1][2] <= COLUMN_GAP:
+            segments[-1][1].append(word[4])
+            segments[-1][2] = word[2]
+        else:
+            segments.append([word[0], [word[4]], word[2]])
+    return [(left, " ".join(words)) for left, words, _ in segments]
+
+
+def _find_supplier(lines):
+    """
+    Finds the supplier's NIF/CIF (the first tax ID that is not ours) and the
+    company name next to it. Returns (name, tax_id); either may be None.
+    """
+    my_tax_id = normalize_tax_id(config.MY_COMPANY_CIF)
+    my_name = config.MY_COMPANY_NAME.lower()
+
+    for line_index, line in enumerate(lines):
+        for match in TAX_ID_PATTERN.finditer(line.text.upper()):
+            tax_id = normalize_tax_id(match.group(1))
+            if tax_id == my_tax_id:
+                continue
+            tax_id_x = line.words[line.word_at_offset(match.start())][0]
+
+            # The company name is normally in the same column, on the same line or one of the three lines above.
+            for candidate in [line] + lines[max(0, line_index - 3):line_index][::-1]:
+                segments = sorted(_column_segments(candidate), key=lambda segment: abs(segment[0] - tax_id_x))
+                for _, segment_text in segments:
+                    suffix = COMPANY_SUFFIX_PATTERN.search(segment_text)
+                    if suffix and my_name not in segment_text.lower():
+                        name = segment_text[:suffix.end()].strip(" ,")
+                        name = NAME_LABEL_PATTERN.sub("", name)
+                        return name, tax_id
+            return None, tax_id
+    return None, None
+
+
+def parse_invoice_lines(lines):
+    """
+    Parses the visual lines of an invoice into our standard dictionary
+    ('supplier', 'supplier_nif', 'date', 'invoice_id', 'total', 'subtotal',
+    'total_tax'). Fields that could not be found are left out.
+    """
+    text = "\n".join(line.text for line in lines)
+    parsed = {}
+
+    supplier, supplier_nif = _find_supplier(lines)
+    if supplier:
+        parsed['supplier'] = supplier
+    if supplier_nif:
+        parsed['supplier_nif'] = supplier_nif
+
+    date = _find_date(text)
+    if date:
+        parsed['date'] = date
+
+    # An invoice number has at least one digit (whatever follows "Factura nº" otherwise is not one).
+    invoice_id = next((match.group(1) for match in INVOICE_ID_PATTERN.finditer(text)
+                       if any(character.isdigit() for character in match.group(1))), None)
+    if invoice_id:
+        parsed['invoice_id'] = invoice_id
+
+    for field, labels in AMOUNT_LABELS.items():
+        amount = _find_labelled_amount(lines, labels)
+        if amount:
+            parsed[field] = amount
+    return parsed
+
+
+def is_complete_and_verified(parsed):
+    """
+    Returns True if a parse has every field we need and its numbers add up
+    (according to helpers.verify_and_calculate_tax), so no AI call is needed.
+    """
+    if not all(parsed.get(field) for field in ('supplier', 'date', 'invoice_id', 'total')):
+        return False
+    # A supplier that still has a label, or an invoice number without digits, was misread.
+    if ":" in parsed['supplier'] or not any(character.isdigit() for character in parsed['invoice_id']):
+        return False
+    total = parse_amount(parsed['total'])
+    if total is None or total <= 0:
+        return False
+    verified = verify_and_calculate_tax(dict(parsed))
+    return not verified['tax'].startswith("ERROR")
@@ -0,0 +1,193 @@
+# watcher.py
+# A long-running service that processes invoices as soon as they arrive.
+#
+# Instead of scanning config.INVOICE_FOLDER from cron, this keeps one process
+# (with its imports and API clients) alive and watches the folder: with
+# inotify/FSEvents through the 'watchdog' library when it is available, or by
+# polling otherwise. A new file is only picked up once its size has stopped
+# changing, so half-copied files are never processed. Each settled file is
+# claimed and handed to the same worker pool logic as main.process_all_invoices().
+#
+# Run it with: python watcher.py
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import google_ai_connector
+import render_pool
+from instrumentation import logger, write_metrics
+from main import (ARCHIVE_FOLDER, FAILED_FOLDER, RunFolder, _claim_file, _process_claimed_file, is_invoice_file,
+                  recover_interrupted_work)
+from sheets_connector import get_sheets_session, flush_sheet, start_ledger_sync
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    # Without watchdog we fall back to polling the folder.
+    FileSystemEventHandler, Observer = object, None
+
+# How often the main loop checks pending files and the sheet buffer.
+TICK_SECONDS = 0.5
+
+
+class _FolderEventHandler(FileSystemEventHandler):
+    """Passes the names of created, modified and moved-in files to the watcher."""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in ("created", "modified", "moved", "closed"):
+            return
+        path = event.dest_path if event.event_type == "moved" else event.src_path
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.watcher.folder):
+            self.watcher.notice(os.path.basename(path))
+
+
+class InvoiceWatcher:
+    """
+    Watches the invoice folder and processes each new invoice once it has been
+    completely written. Rows are written to the sheet as soon as the workers go idle.
+    """
+
+    def __init__(self, folder=None, max_workers=None, hedged=False):
+        self.folder = folder or config.INVOICE_FOLDER
+        self.max_workers = max_workers or config.MAX_CONCURRENT_INVOICES
+        self.hedged = hedged
+        self.use_polling = config.WATCHER_USE_POLLING or Observer is None
+        # filename -> (size, mtime, time the size or mtime last changed)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self._unflushed_results = False
+        self._stop_event = threading.Event()
+        self.run_folder = None
+
+    def notice(self, filename):
+        """Marks a file as (possibly) new. It is processed once it has settled."""
+        if not is_invoice_file(filename):
+            return
+        with self._pending_lock:
+            self._pending.setdefault(filename, (None, None, time.monotonic()))
+
+    def _scan_folder(self):
+        """Notices every invoice file currently in the folder (the polling mode, and a safety net for missed events)."""
+        for filename in os.listdir(self.folder):
+            if os.path.isfile(os.path.join(self.folder, filename)):
+                self.notice(filename)
+
+    def _settled_files(self):
+        """
+        Returns the pending files whose size and modification time have not
+        changed for config.WATCHER_SETTLE_SECONDS, and stops tracking them.
+        """
+        now = time.monotonic()
+        settled = []
+        with self._pending_lock:
+            for filename, (size, mtime, changed_at) in list(self._pending.items()):
+                try:
+                    stat = os.stat(os.path.join(self.folder, filename))
+                except FileNotFoundError:
+                    # Moved away or already claimed by another run.
+                    del self._pending[filename]
+                    continue
+                if (stat.st_size, stat.st_mtime) != (size, mtime):
+                    self._pending[filename] = (stat.st_size, stat.st_mtime, now)
+                elif stat.st_size > 0 and now - changed_at >= config.WATCHER_SETTLE_SECONDS:
+                    del self._pending[filename]
+                    settled.append(filename)
+        return settled
+
+    def _on_file_done(self, future):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+            self._unflushed_results = True
+
+    def _submit(self, executor, filename):
+        claimed_path = _claim_file(filename, self.run_folder)
+        if not claimed_path:
+            return
+        with self._in_flight_lock:
+            self._in_flight += 1
+        future = executor.submit(_process_claimed_file, filename, claimed_path, self.hedged)
+        future.add_done_callback(self._on_file_done)
+
+    def _flush_if_idle_or_due(self):
+        """Writes buffered rows once all workers are idle, or when the buffer is full or old enough."""
+        with self._in_flight_lock:
+            idle = self._in_flight == 0 and self._unflushed_results
+            if idle:
+                self._unflushed_results = False
+        if idle or get_sheets_session().flush_is_due():
+            if config.LEDGER_STORE_ENABLED:
+                # The new invoices are in the ledger already; copy them to the sheet in the background.
+                start_ledger_sync(now=True)
+            else:
+                get_sheets_session().flush()
+            write_metrics()
+
+    def _warm_up(self):
+        """Creates the API clients up front, so the first invoice does not pay for the connections."""
+        try:
+            get_sheets_session().get_worksheet()
+            google_ai_connector.get_client()
+        except Exception as e:
+            logger.warning("  --> Could not connect to every service yet (%s). Will retry on first use.", e)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        """Watches the folder until stop() is called or the process is interrupted (Ctrl+C)."""
+        if not os.path.exists(self.folder):
+            logger.error("The folder '%s' was not found.", self.folder)
+            return
+        os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+        os.makedirs(FAILED_FOLDER, exist_ok=True)
+        self._warm_up()
+        recover_interrupted_work()
+        with RunFolder() as self.run_folder:
+            self._watch()
+        flush_sheet()
+
+    def _watch(self):
+        """The main loop: notices new files, submits the settled ones and flushes the sheet."""
+        observer = None
+        if not self.use_polling:
+            observer = Observer()
+            observer.schedule(_FolderEventHandler(self), self.folder, recursive=False)
+            observer.start()
+        rescan_interval = config.WATCHER_POLL_INTERVAL_SECONDS if self.use_polling else \
+            config.WATCHER_RESCAN_INTERVAL_SECONDS
+        logger.info("Watching '%s' for new invoices (%s). Press Ctrl+C to stop.", self.folder,
+                    "polling" if self.use_polling else "file events")
+
+        executor = ThreadPoolExecutor(max_workers=max(1, self.max_workers))
+        last_scan = 0
+        try:
+            while not self._stop_event.is_set():
+                if time.monotonic() - last_scan >= rescan_interval:
+                    self._scan_folder()
+                    last_scan = time.monotonic()
+                for filename in self._settled_files():
+                    self._submit(executor, filename)
+                self._flush_if_idle_or_due()
+                self._stop_event.wait(TICK_SECONDS)
+        except KeyboardInterrupt:
+            logger.info("Stopping the watcher...")
+        finally:
+            if observer:
+                observer.stop()
+                observer.join()
+            executor.shutdown(wait=True)
+            render_pool.shutdown()
+
+
+# This special block is the entry point of the watcher service.
+if __name__ == "__main__":
+    InvoiceWatcher().run()